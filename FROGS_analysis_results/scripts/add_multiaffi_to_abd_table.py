@@ -7,23 +7,21 @@ __license__ = 'GNU General Public License'
 from argparse import ArgumentParser, ArgumentDefaultsHelpFormatter
 import logging
 
-from frogs_analysis_fct import process_frogs_affiliation, get_corresponding_species_mock, clean_mock_sp_relation
+# pandas and the modules using it are imported once the arguments are parsed,
+# so that the help and the argument errors come without their import time
+from stage_metrics import StageMetrics, measure_stage
+from table_formats import is_biom_file
 
 
-def load_mock_taxonomies(mock_taxonomies_file):
-    
-    with open(mock_taxonomies_file) as fl:
-        return {l.rstrip().split("\t")[1]:l.split("\t")[0] for l in fl if l.rstrip()}
-    
-
-def parse_arguments():
-    """Parse script arguments."""
-    parser = ArgumentParser(description="...",
+def parse_arguments(argv=None, prog=None):
+    """Parse script arguments, argv being sys.argv[1:] by default."""
+    parser = ArgumentParser(prog=prog, description="...",
                             formatter_class=ArgumentDefaultsHelpFormatter)
 
-    parser.add_argument('--abundance_table', required=True, help='Affiliation abundance table, output of Frogs affiliations_stat.py script followed by biom_to_tsv.py. ')
+    parser.add_argument('--abundance_table', required=True, help='Affiliation abundance table, output of Frogs affiliations_stat.py script followed by biom_to_tsv.py. '
+                        'The FROGS affiliation biom file (.biom) can be given directly instead, then --multiaffi_table is not needed.')
 
-    parser.add_argument('--multiaffi_table', required=True, help='Multi Affiliation table, output of Frogs affiliations_stat.py script followed by biom_to_tsv.py. ')
+    parser.add_argument('--multiaffi_table', required=False, help='Multi Affiliation table, output of Frogs affiliations_stat.py script followed by biom_to_tsv.py. ')
 
     parser.add_argument('--region', required=True, help='Name of the region analysed (ie 16S, 23S or 16Sv3v4).')
 
@@ -41,68 +39,197 @@ def parse_arguments():
                         'and the second column containing the taxonomy of this species based on the affiliation database used. '
                         'The taxonomy should be represented from Phylum to Species, separated by semicolons.')
 
-    parser.add_argument('-o', '--output', default='affi_tables_merged.tsv', help='output table name')
+    parser.add_argument('--mock_metrics', default=None, help='Write the recovery of the mock community in each sample (recall, precision, abundance of the other taxa, '
+                        'Bray-Curtis dissimilarity with the expected composition) in this TSV file. Needs --mock_taxonomies.')
+
+    parser.add_argument('--expected_composition', default=None, help='Expected relative abundances of the mock species used by --mock_metrics, '
+                        'see mock_evaluation.py. By default all mock species are expected with the same abundance.')
+
+    parser.add_argument('--mock_composition_output', default=None, help='Expected and observed composition of the mock in each sample, used with --mock_metrics.')
+
+    parser.add_argument('--sweep_identities', nargs="+", type=float, default=None, help='Identity thresholds of the sensitivity surface. '
+                        'When given with --sweep_coverages, the number and the abundance of valid clusters are reported for every identity and coverage pair, overall and per sample.')
+
+    parser.add_argument('--sweep_coverages', nargs="+", type=float, default=None, help='Coverage thresholds of the sensitivity surface.')
+
+    parser.add_argument('--sweep_output', default='threshold_sweep.tsv', help='output table of the sensitivity surface')
+
+    parser.add_argument('--chunksize', default=None, type=int, help='Process the abundance table by chunks of this number of clusters, writing the merged table incrementally. '
+                        'This bounds memory usage on very large tables. By default the whole table is loaded in memory.')
+
+    parser.add_argument('--cache', default=None, help='SQLite file caching the threshold independent affiliation of each cluster (multi-affiliation consensus, best hit and lineage). '
+                        'Later runs with other thresholds, or on tables where only some clusters changed, only compute the affiliation of the clusters missing from the cache.')
+
+    parser.add_argument('--skip_seed_sequence', action="store_true", help='Do not write the seed_sequence column in the merged table. '
+                        'Sequences are otherwise read apart from the other columns, right before writing each table or chunk.')
+
+    parser.add_argument('-o', '--output', default='affi_tables_merged.tsv', help='output table name. '
+                        'Use the .parquet or .feather extension to write a columnar table with taxonomy and rank columns stored as categories.')
+
+    parser.add_argument('--profile', action="store_true", help='Print the wall time, rows processed, rows/s and peak RSS of each processing stage.')
+
+    parser.add_argument('--metrics_json', '--metrics-json', dest='metrics_json', default=None,
+                        help='Write the wall time, rows processed, rows/s and peak RSS of each processing stage in this JSON file.')
 
     parser.add_argument("-v", "--verbose", help="increase output verbosity",
                         action="store_true")
 
-    args = parser.parse_args()
+    parser.add_argument("--debug", help="increase a lot output verbosity, down to each taxonomy processed",
+                        action="store_true")
+
+    args = parser.parse_args(argv)
+
+    if is_biom_file(args.abundance_table):
+        if args.chunksize:
+            parser.error('--chunksize is not available with a biom abundance table.')
+    elif not args.multiaffi_table:
+        parser.error('--multiaffi_table is required when the abundance table is not a biom file.')
+
+    if args.mock_metrics and not args.mock_taxonomies:
+        parser.error('--mock_metrics needs --mock_taxonomies.')
+
     return args
 
 
-def main():
+def main(argv=None, prog=None):
 
-    args = parse_arguments()
+    args = parse_arguments(argv, prog)
 
-    if args.verbose:
+    if args.debug:
         logging.basicConfig(format="%(levelname)s: %(message)s", level=logging.DEBUG)
+        logging.debug('Mode debug ON')
+    elif args.verbose:
+        logging.basicConfig(format="%(levelname)s: %(message)s", level=logging.INFO)
         logging.info('Mode verbose ON')
 
     else:
         logging.basicConfig(format="%(levelname)s: %(message)s")
 
-    affi_abundance_fl = args.abundance_table
-    multihit_fl = args.multiaffi_table
     taxonomic_ranks = args.taxonomic_ranks.split(' ')
-    
-    min_identity = args.min_identity
-    min_coverage = args.min_coverage
 
-    region  = args.region
-    affi_db_name = args.affi_db_name
-    mock_taxonomies_file = args.mock_taxonomies
+    metrics = StageMetrics('add_multiaffi_to_abd_table') if args.profile or args.metrics_json else None
+
+    taxonomies2mock_species = None
+    if args.mock_taxonomies:
+        logging.info(f'Linking cluster to their corresponding mock species using {args.mock_taxonomies}')
+        from frogs_analysis_fct import load_mock_taxonomies
+        with measure_stage(metrics, 'load_mock'):
+            taxonomies2mock_species = load_mock_taxonomies(args.mock_taxonomies)
+
+    add_multiaffi_to_abd_table(args.abundance_table, args.multiaffi_table, args.output, taxonomic_ranks,
+                               args.min_identity, args.min_coverage, args.region, args.affi_db_name,
+                               taxonomies2mock_species=taxonomies2mock_species, chunksize=args.chunksize,
+                               sweep_identities=args.sweep_identities, sweep_coverages=args.sweep_coverages,
+                               sweep_output=args.sweep_output, cache_file=args.cache,
+                               seed_sequence=not args.skip_seed_sequence, metrics=metrics,
+                               mock_metrics_output=args.mock_metrics, expected_composition=args.expected_composition,
+                               mock_composition_output=args.mock_composition_output)
+
+    if args.profile:
+        print(metrics.format_table())
+
+    if args.metrics_json:
+        metrics.write_json(args.metrics_json)
+
+
+def add_multiaffi_to_abd_table(affi_abundance_fl, multihit_fl, output, taxonomic_ranks,
+                               min_identity, min_coverage, region, affi_db_name,
+                               taxonomies2mock_species=None, chunksize=None,
+                               sweep_identities=None, sweep_coverages=None, sweep_output='threshold_sweep.tsv', cache_file=None,
+                               seed_sequence=True, metrics=None,
+                               mock_metrics_output=None, expected_composition=None, mock_composition_output=None):
+    """
+    Merge the multi-affiliations to the abundance table and write the merged table in output.
+
+    taxonomies2mock_species is the mock taxonomy mapping given by load_mock_taxonomies
+    and cache_file an optional SQLite file given to AffiliationCache.
+    The seed sequences of a TSV abundance table are not loaded for the processing
+    and are only added to the written table when seed_sequence is True.
+    metrics is an optional StageMetrics recording each stage of the run.
+    With taxonomies2mock_species, the recovery of the mock in each sample is
+    written in mock_metrics_output, see mock_evaluation.write_mock_metrics.
+    """
+    from affiliation_cache import AffiliationCache
+    from frogs_analysis_fct import process_frogs_affiliation, iter_frogs_affiliation_chunks, get_sample_columns
+    from frogs_analysis_fct import iter_seed_sequences, add_seed_sequences, add_analysis_info, MULTI_FLAG_COLUMNS
+    from mock_evaluation import get_mock_count_table, add_count_tables, write_mock_metrics
+    from table_io import AffiTableWriter, CATEGORICAL_COLUMNS
+    from threshold_sweep import sum_valid_clusters_and_sequences, get_threshold_sweep_table
+
+    cache = AffiliationCache(cache_file) if cache_file else None
+
+    seed_sequences = None
+    if seed_sequence and not is_biom_file(affi_abundance_fl):
+        seed_sequences = iter_seed_sequences(affi_abundance_fl, chunksize)
+
+    if chunksize:
+        logging.info(f'Processing {affi_abundance_fl} by chunks of {chunksize} clusters')
+        analysis_dfs = iter_frogs_affiliation_chunks(affi_abundance_fl, multihit_fl, taxonomic_ranks,
+                                                     min_ids = [min_identity], min_covs = [min_coverage], chunksize=chunksize, cache=cache,
+                                                     metrics=metrics)
+    else:
+        analysis_dfs = [process_frogs_affiliation(affi_abundance_fl, multihit_fl, taxonomic_ranks,
+                                                  min_ids = [min_identity], min_covs = [min_coverage], cache=cache, metrics=metrics)]
 
+    sweep_thresholds = sweep_identities and sweep_coverages
+    sweep_sums = None
 
-    analysis_df =  process_frogs_affiliation(affi_abundance_fl, multihit_fl, taxonomic_ranks,
-                                                                min_ids = [min_identity], min_covs = [min_coverage])
+    evaluate_mock = taxonomies2mock_species and mock_metrics_output
+    mock_counts = None
 
-    df_valid_affi = analysis_df.loc[analysis_df[f'id>{min_identity}_cov>{min_coverage}']]
-    logging.info(f"{len(df_valid_affi)}/{len(analysis_df)} clusters have a valid affiliation with identity > {min_identity} and coverage > {min_coverage}.")
+    nb_clusters, nb_valid_clusters = 0, 0
+    sum_seq, sum_seq_valid = 0, 0
 
-    sum_seq_valid = df_valid_affi['observation_sum'].sum()
-    abd_of_valid_affi = 100 * sum_seq_valid/analysis_df['observation_sum'].sum()
+    logging.info(f'Writting merged table in {output}')
+    affi_table_writer = AffiTableWriter(output, categorical_columns=CATEGORICAL_COLUMNS + taxonomic_ranks)
+    for analysis_df in analysis_dfs:
 
-    logging.info(f"They represent a total of {sum_seq_valid} sequences and a relative abundance of {abd_of_valid_affi:.3f}%")
+        df_valid_affi = analysis_df.loc[analysis_df[f'id>{min_identity}_cov>{min_coverage}']]
+
+        nb_clusters += len(analysis_df)
+        nb_valid_clusters += len(df_valid_affi)
+        sum_seq += analysis_df['observation_sum'].sum()
+        sum_seq_valid += df_valid_affi['observation_sum'].sum()
+
+        if sweep_thresholds:
+            samples = get_sample_columns(analysis_df)
+            with measure_stage(metrics, 'threshold_sweep', len(analysis_df)):
+                chunk_sweep_sums = sum_valid_clusters_and_sequences(analysis_df, sweep_identities, sweep_coverages, samples)
+            sweep_sums = chunk_sweep_sums if sweep_sums is None else [s + chunk_s for s, chunk_s in zip(sweep_sums, chunk_sweep_sums)]
 
+        add_analysis_info(analysis_df, min_identity, min_coverage, region, affi_db_name, taxonomies2mock_species, metrics)
 
-    analysis_df['valid_affiliation'] = analysis_df[f'id>{min_identity}_cov>{min_coverage}']
+        if evaluate_mock:
+            with measure_stage(metrics, 'mock_evaluation', len(analysis_df)):
+                mock_counts = add_count_tables(mock_counts, get_mock_count_table(analysis_df, get_sample_columns(analysis_df)))
 
-    analysis_df['region'] = region
-    analysis_df['db'] = affi_db_name
+        with measure_stage(metrics, 'write', len(analysis_df)):
+            analysis_df.drop(columns=MULTI_FLAG_COLUMNS, inplace=True)
+            if seed_sequences is not None:
+                add_seed_sequences(analysis_df, next(seed_sequences))
 
-    if mock_taxonomies_file:
-        logging.info(f'Linking cluster to their corresponding mock species using {mock_taxonomies_file}')
-        taxonomies2mock_species = load_mock_taxonomies(mock_taxonomies_file)
+            affi_table_writer.write(analysis_df)
 
-        analysis_df["sp_mock_taxonomy"] = analysis_df[["blast_taxonomy", "mutliaffiliation"]].apply(
-                get_corresponding_species_mock, args=(taxonomies2mock_species,), axis=1 )
+    affi_table_writer.close()
+    if cache is not None:
+        cache.close()
 
-        analysis_df["sp_mock_taxonomy"] = analysis_df["sp_mock_taxonomy"].apply(clean_mock_sp_relation)
-        analysis_df["mock_species"] = analysis_df["sp_mock_taxonomy"].apply(lambda x: x if x not in taxonomies2mock_species else taxonomies2mock_species[x] )
+    logging.info(f"{nb_valid_clusters}/{nb_clusters} clusters have a valid affiliation with identity > {min_identity} and coverage > {min_coverage}.")
+
+    abd_of_valid_affi = 100 * sum_seq_valid/sum_seq
+
+    logging.info(f"They represent a total of {sum_seq_valid} sequences and a relative abundance of {abd_of_valid_affi:.3f}%")
 
+    if evaluate_mock:
+        with measure_stage(metrics, 'mock_evaluation'):
+            mock_species = list(dict.fromkeys(taxonomies2mock_species.values()))
+            write_mock_metrics(mock_counts, mock_species, mock_metrics_output, mock_composition_output,
+                               expected_composition)
 
-    logging.info(f'Writting merged table in {args.output}')
-    analysis_df.to_csv(args.output, sep='\t', index=False)
+    if sweep_thresholds:
+        logging.info(f'Writting sensitivity surface for {len(sweep_identities)} identity and {len(sweep_coverages)} coverage thresholds in {sweep_output}')
+        df_sweep = get_threshold_sweep_table(*sweep_sums, sweep_identities, sweep_coverages, samples)
+        df_sweep.to_csv(sweep_output, sep='\t', index=False)
 
 
 if __name__ == '__main__':
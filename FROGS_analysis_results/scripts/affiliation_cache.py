@@ -0,0 +1,136 @@
+# Metadata
+__author__ = 'Mainguy Jean - Plateforme bioinformatique Toulouse'
+__copyright__ = 'Copyright (C) 2020 INRAE'
+__license__ = 'GNU General Public License'
+
+
+import json
+import logging
+import sqlite3
+import numpy as np
+import pandas as pd
+
+
+# bump it when the computation of the cached columns changes
+CACHE_VERSION = 2
+
+# columns of the abundance table and of the multihit table the affiliation of a cluster depends on
+CLUSTER_KEY_COLUMNS = ["observation_name", "blast_taxonomy", "blast_subject", "blast_perc_identity", "blast_perc_query_coverage",
+                       "multi_identity", "multi_coverage"]
+MULTIHIT_KEY_COLUMNS = ["blast_taxonomy", "blast_subject", "blast_perc_identity", "blast_perc_query_coverage"]
+
+# threshold independent columns set by the affiliation processing, followed by one column per rank
+AFFILIATION_COLUMNS = ["mutliaffiliation", "blast_taxonomy", "blast_taxonomy_original",
+                       "blast_perc_identity", "blast_perc_query_coverage",
+                       "taxon_affi", "rank_affi", "blast_taxonomy_cleaned"]
+
+
+def get_affiliation_columns(ranks):
+    # the default ranks hold Species twice while the table has a single Species column
+    return AFFILIATION_COLUMNS + list(dict.fromkeys(ranks))
+
+
+def select_affiliation_columns(df, ranks):
+    """Affiliation columns of df, selected by position."""
+    return df.iloc[:, df.columns.get_indexer(get_affiliation_columns(ranks))]
+
+
+def get_cluster_keys(df, df_multihit):
+    """
+    64 bits key of each cluster of df, as an int64 array.
+
+    The key hashes the columns of the cluster in the abundance table and its
+    hits in the multihit table, in order. Counts are not part of it, so a
+    cluster keeps its key when only its abundance changes.
+    """
+    row_hashes = pd.util.hash_pandas_object(df[CLUSTER_KEY_COLUMNS].astype(str), index=False).to_numpy()
+
+    df_multihit = df_multihit.loc[df_multihit["#observation_name"].isin(df["observation_name"])]
+    hit_clusters = df_multihit["#observation_name"].to_numpy()
+
+    df_hits = df_multihit[MULTIHIT_KEY_COLUMNS].astype(str)
+    df_hits["position"] = df_hits.groupby(hit_clusters, sort=False).cumcount().to_numpy()
+    hit_hashes = pd.util.hash_pandas_object(df_hits, index=False).to_numpy()
+
+    # hits of a cluster are combined with a wrapping sum, their position being part of their hash
+    cluster_codes, clusters = pd.factorize(hit_clusters)
+    multihit_hashes = np.zeros(len(clusters), dtype=np.uint64)
+    np.add.at(multihit_hashes, cluster_codes, hit_hashes)
+
+    cluster_indexer = pd.Index(clusters).get_indexer(df["observation_name"])
+    df_multihit_hashes = np.where(cluster_indexer >= 0, multihit_hashes[cluster_indexer], np.uint64(0))
+
+    keys = pd.util.hash_pandas_object(pd.DataFrame({"row": row_hashes, "multihit": df_multihit_hashes}), index=False)
+
+    return keys.to_numpy().view(np.int64)
+
+
+class AffiliationCache:
+    """
+    SQLite cache of the threshold independent affiliation of clusters.
+
+    Affiliations are stored per cluster key (see get_cluster_keys) and per rank
+    list, so that a run with other thresholds, or on tables where only some
+    clusters changed, only computes the affiliation of the clusters missing
+    from the cache.
+    """
+
+    def __init__(self, cache_file):
+        self.cache_file = cache_file
+        self.connection = sqlite3.connect(cache_file, timeout=60)
+        self.connection.execute("""CREATE TABLE IF NOT EXISTS affiliations (
+                                       context TEXT,
+                                       cluster_key INTEGER,
+                                       affiliation TEXT,
+                                       PRIMARY KEY (context, cluster_key))""")
+        self.connection.execute("CREATE TEMP TABLE requested_keys (cluster_key INTEGER PRIMARY KEY)")
+
+    @staticmethod
+    def get_context(ranks):
+        return json.dumps({"version": CACHE_VERSION, "ranks": list(ranks)})
+
+    def get(self, cluster_keys, ranks):
+        """
+        Cached affiliations of the given cluster keys.
+
+        Return a DataFrame indexed by cluster key with the affiliation columns,
+        holding only the keys found in the cache.
+        """
+        with self.connection:
+            self.connection.execute("DELETE FROM requested_keys")
+            self.connection.executemany("INSERT OR IGNORE INTO requested_keys VALUES (?)",
+                                        ((key,) for key in cluster_keys.tolist()))
+            rows = self.connection.execute("""SELECT a.cluster_key, a.affiliation FROM affiliations a
+                                              JOIN requested_keys r ON a.cluster_key = r.cluster_key
+                                              WHERE a.context = ?""", (self.get_context(ranks),)).fetchall()
+
+        keys = [key for key, _ in rows]
+        affiliations = [json.loads(affiliation) for _, affiliation in rows]
+
+        df_cached = pd.DataFrame(affiliations, index=keys, columns=get_affiliation_columns(ranks))
+        df_cached = df_cached.astype({"blast_perc_identity": "float32", "blast_perc_query_coverage": "float32"})
+
+        return df_cached.where(df_cached.notna(), np.nan)
+
+    def put(self, cluster_keys, df_affiliation, ranks):
+        """Store the affiliation columns of df_affiliation, whose rows match cluster_keys."""
+        context = self.get_context(ranks)
+        affiliations = select_affiliation_columns(df_affiliation, ranks)
+        affiliations = affiliations.astype({"blast_perc_identity": float, "blast_perc_query_coverage": float}).astype(object)
+        affiliations = affiliations.where(affiliations.notna(), None).to_numpy().tolist()
+
+        with self.connection:
+            self.connection.executemany("INSERT OR REPLACE INTO affiliations VALUES (?, ?, ?)",
+                                        ((context, key, json.dumps(affiliation))
+                                         for key, affiliation in zip(cluster_keys.tolist(), affiliations)))
+
+        logging.debug(f"{len(affiliations)} cluster affiliations stored in {self.cache_file}")
+
+    def close(self):
+        self.connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
@@ -0,0 +1,212 @@
+# Metadata
+__author__ = 'Mainguy Jean - Plateforme bioinformatique Toulouse'
+__copyright__ = 'Copyright (C) 2020 INRAE'
+__license__ = 'GNU General Public License'
+
+
+from argparse import ArgumentParser, ArgumentDefaultsHelpFormatter
+import logging
+import os
+import sys
+import time
+
+from add_multiaffi_to_abd_table import add_multiaffi_to_abd_table
+from plot_taxo_ranks import plot_taxo_ranks, parse_sample_names
+
+
+MANIFEST_COLUMNS = ['name', 'abundance_table', 'multiaffi_table', 'region', 'affi_db_name',
+                    'min_identity', 'min_coverage', 'taxonomic_ranks', 'samples', 'mock_taxonomies']
+
+# reference data parsed once in the main process and given to each worker
+shared_mock_taxonomies = {}
+
+
+def parse_arguments(argv=None, prog=None):
+    """Parse script arguments, argv being sys.argv[1:] by default."""
+    parser = ArgumentParser(prog=prog, description="Run add_multiaffi_to_abd_table.py and plot_taxo_ranks.py on all datasets of a manifest, in parallel.",
+                            formatter_class=ArgumentDefaultsHelpFormatter)
+
+    parser.add_argument('manifest', help='Manifest of the datasets in TSV or YAML (.yaml or .yml) format with one dataset per row. '
+                        f'Columns are {", ".join(MANIFEST_COLUMNS)}. '
+                        'name, abundance_table, region and affi_db_name are required, the other columns default to the arguments of this script. '
+                        'samples are separated by spaces and accept the 1:32 syntax of plot_taxo_ranks.py. '
+                        'Relative paths are relative to the manifest directory.')
+
+    parser.add_argument('-o', '--outdir', default='.', help='Output dir. The merged table and the plots of each dataset are written in a subdir named after the dataset.')
+
+    parser.add_argument('-f', '--outformat', nargs="+", default=['png'], choices=['png', 'jpg', 'jpeg', "webp", 'svg', "pdf", "html"],
+                        help='Format of the output plots.')
+
+    parser.add_argument('--min_identity', default=98, type=float, help='Identity threshold to consider an affilition as weak.')
+
+    parser.add_argument('--min_coverage', default=99, type=float, help='Coverage threshold to consider an affilition as weak.')
+
+    parser.add_argument('--taxonomic_ranks', default='Domain Phylum Class Order Family Genus Species', help='Taxonomic ranks of the affiliation')
+
+    parser.add_argument('-j', '--jobs', default=None, type=int, help='Number of datasets processed in parallel. By default the number of available cores.')
+
+    parser.add_argument('--force', action="store_true", help='Write all plots, even the ones whose data have not changed since the last run.')
+
+    parser.add_argument('--timings', default=None, help='Write the processing time of each dataset in this TSV file.')
+
+    parser.add_argument("-v", "--verbose", help="increase output verbosity",
+                        action="store_true")
+
+    args = parser.parse_args(argv)
+    return args
+
+
+def get_available_cores():
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+
+def read_manifest(manifest):
+    """
+    Read the manifest as a list of dataset dicts, in TSV or YAML format.
+
+    A YAML manifest is a list of datasets or a mapping with a 'datasets' list.
+    Empty fields are dropped and relative paths are made relative to the manifest directory.
+    A manifest without dataset raises a ValueError.
+    """
+    if manifest.endswith(('.yaml', '.yml')):
+        import yaml
+        with open(manifest) as fl:
+            datasets = yaml.safe_load(fl)
+        if isinstance(datasets, dict):
+            datasets = datasets['datasets']
+    else:
+        import pandas as pd
+        datasets = pd.read_csv(manifest, sep='\t', dtype=str, comment='#').to_dict('records')
+
+    if not datasets:
+        raise ValueError(f'No dataset found in the manifest {manifest}')
+
+    manifest_dir = os.path.dirname(os.path.abspath(manifest))
+
+    checked_datasets = []
+    for i, dataset in enumerate(datasets):
+        dataset = {key: value for key, value in dataset.items() if value is not None and value == value and value != ''}
+
+        unknown_columns = set(dataset) - set(MANIFEST_COLUMNS)
+        if unknown_columns:
+            raise ValueError(f'Unknown manifest columns for dataset {i + 1}: {unknown_columns}')
+
+        missing_columns = {'name', 'abundance_table', 'region', 'affi_db_name'} - set(dataset)
+        if missing_columns:
+            raise ValueError(f'Missing manifest columns for dataset {i + 1}: {missing_columns}')
+
+        for path_column in ['abundance_table', 'multiaffi_table', 'mock_taxonomies']:
+            if path_column in dataset:
+                dataset[path_column] = os.path.join(manifest_dir, dataset[path_column])
+
+        checked_datasets.append(dataset)
+
+    names = [dataset['name'] for dataset in checked_datasets]
+    if len(set(names)) != len(names):
+        raise ValueError('Dataset names of the manifest are not unique.')
+
+    return checked_datasets
+
+
+def init_worker(mock_taxonomies, log_level):
+    logging.basicConfig(format="%(levelname)s: %(message)s", level=log_level)
+    shared_mock_taxonomies.update(mock_taxonomies)
+
+
+def process_dataset(dataset, outdir, output_formats, force=False):
+    """
+    Merge the multi-affiliations of a dataset and plot its taxonomic ranks in outdir/name.
+
+    Return the processing time of each step.
+    """
+    name = dataset['name']
+    dataset_outdir = os.path.join(outdir, name)
+    os.makedirs(dataset_outdir, exist_ok=True)
+
+    merged_table = os.path.join(dataset_outdir, f"{name}_affi_tables_merged.tsv")
+
+    taxonomies2mock_species = None
+    if 'mock_taxonomies' in dataset:
+        taxonomies2mock_species = shared_mock_taxonomies[dataset['mock_taxonomies']]
+
+    start = time.perf_counter()
+    add_multiaffi_to_abd_table(dataset['abundance_table'], dataset.get('multiaffi_table'), merged_table,
+                               dataset['taxonomic_ranks'], dataset['min_identity'], dataset['min_coverage'],
+                               dataset['region'], dataset['affi_db_name'],
+                               taxonomies2mock_species=taxonomies2mock_species)
+    merge_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    plot_taxo_ranks([merged_table], [name], dataset['samples'], dataset_outdir, output_formats, force=force)
+    plot_time = time.perf_counter() - start
+
+    return {"merge_time": merge_time, "plot_time": plot_time}
+
+
+def main(argv=None, prog=None):
+
+    args = parse_arguments(argv, prog)
+
+    log_level = logging.INFO if args.verbose else logging.WARNING
+    logging.basicConfig(format="%(levelname)s: %(message)s", level=log_level)
+
+    from concurrent.futures import ProcessPoolExecutor, as_completed
+    import pandas as pd
+    from frogs_analysis_fct import load_mock_taxonomies
+
+    datasets = read_manifest(args.manifest)
+
+    default_ranks = args.taxonomic_ranks.split(' ')
+    for dataset in datasets:
+        # thresholds are only converted when given, like the defaults of the scripts, as they name the threshold columns
+        dataset['min_identity'] = float(dataset['min_identity']) if 'min_identity' in dataset else args.min_identity
+        dataset['min_coverage'] = float(dataset['min_coverage']) if 'min_coverage' in dataset else args.min_coverage
+        dataset['taxonomic_ranks'] = dataset['taxonomic_ranks'].split(' ') if 'taxonomic_ranks' in dataset else default_ranks
+        samples = dataset.get('samples', [])
+        dataset['samples'] = parse_sample_names(samples.split() if isinstance(samples, str) else [str(s) for s in samples])
+
+    # each mock file is parsed once for all the datasets using it
+    mock_taxonomies = {}
+    for mock_file in {dataset['mock_taxonomies'] for dataset in datasets if 'mock_taxonomies' in dataset}:
+        logging.info(f'Loading mock taxonomies {mock_file}')
+        mock_taxonomies[mock_file] = load_mock_taxonomies(mock_file)
+
+    jobs = min(args.jobs or get_available_cores(), len(datasets))
+    logging.info(f'Processing {len(datasets)} datasets with {jobs} processes')
+
+    timings = []
+    start = time.perf_counter()
+    with ProcessPoolExecutor(max_workers=jobs, initializer=init_worker, initargs=(mock_taxonomies, log_level)) as executor:
+        future2name = {executor.submit(process_dataset, dataset, args.outdir, args.outformat, args.force): dataset['name']
+                       for dataset in datasets}
+
+        for future in as_completed(future2name):
+            name = future2name[future]
+            try:
+                timing = future.result()
+            except Exception:
+                logging.exception(f'Dataset {name} failed')
+                timings.append({"name": name, "status": "failed"})
+                continue
+
+            logging.info(f'Dataset {name} done: merge {timing["merge_time"]:.2f}s, plot {timing["plot_time"]:.2f}s')
+            timings.append({"name": name, "status": "done", **timing})
+
+    df_timings = pd.DataFrame(timings, columns=["name", "status", "merge_time", "plot_time"])
+    df_timings['total_time'] = df_timings['merge_time'] + df_timings['plot_time']
+
+    print(df_timings.round(2).to_string(index=False))
+    print(f'{len(datasets)} datasets processed in {time.perf_counter() - start:.2f}s with {jobs} processes')
+
+    if args.timings:
+        df_timings.to_csv(args.timings, sep='\t', index=False)
+
+    if (df_timings['status'] == "failed").any():
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
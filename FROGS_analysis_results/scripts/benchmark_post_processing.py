@@ -0,0 +1,552 @@
+# Metadata
+__author__ = 'Mainguy Jean - Plateforme bioinformatique Toulouse'
+__copyright__ = 'Copyright (C) 2020 INRAE'
+__license__ = 'GNU General Public License'
+
+
+from argparse import ArgumentParser, ArgumentDefaultsHelpFormatter
+import gc
+import glob
+import json
+import logging
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+import numpy as np
+import pandas as pd
+
+from affiliation_cache import AffiliationCache
+from frogs_analysis_fct import (load_multihit_table, get_best_hit_index, add_multi_affi_to_df, improve_affi_with_multiaffi,
+                                add_best_covid_from_multihit, add_lineage_columns, add_threshold_columns, get_lineage_info,
+                                get_common_taxonomy_by_cluster, get_common_taxonomy, get_sample_columns,
+                                load_abundance_table, categorize_lineage_columns, process_frogs_affiliation,
+                                iter_frogs_affiliation_chunks, add_mock_species_to_df, clean_mock_sp_relation)
+from make_synthetic_frogs_tables import write_synthetic_frogs_tables
+from sample_groups import get_rank_abundance_by_sample
+
+
+RESULTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir)
+
+
+def parse_arguments():
+    """Parse script arguments."""
+    parser = ArgumentParser(description="Time and memory profile each stage of the post-processing of FROGS tables, "
+                            "after checking the results of the stages against the merged tables of the repository.",
+                            formatter_class=ArgumentDefaultsHelpFormatter)
+
+    parser.add_argument('--abundance_table', default=None, help='FROGS abundance table to benchmark. By default a synthetic table is generated.')
+
+    parser.add_argument('--multiaffi_table', default=None, help='Multihit table of --abundance_table.')
+
+    parser.add_argument('-c', '--nb_clusters', default=10000, type=int, help='Number of clusters of the synthetic table.')
+
+    parser.add_argument('-s', '--nb_samples', default=50, type=int, help='Number of samples of the synthetic table.')
+
+    parser.add_argument('-m', '--multi_affi_rate', default=0.3, type=float, help='Fraction of multi-affiliated clusters in the synthetic table.')
+
+    parser.add_argument('--seed', default=0, type=int, help='Seed of the synthetic table.')
+
+    parser.add_argument('--taxonomic_ranks', default='Domain Phylum Class Order Family Genus Species', help='Taxonomic ranks of the affiliation')
+
+    parser.add_argument('--min_identity', default=98, type=float, help='Identity threshold of the threshold flags.')
+
+    parser.add_argument('--min_coverage', default=99, type=float, help='Coverage threshold of the threshold flags.')
+
+    parser.add_argument('-r', '--repeat', default=3, type=int, help='Number of timed runs of the stages. The best time is reported.')
+
+    parser.add_argument('--results_dir', default=RESULTS_DIR, help='Directory holding the *_affi_tables_merged.tsv tables the stages are checked against.')
+
+    parser.add_argument('--skip_check', action="store_true", help='Do not check the stages against the merged tables.')
+
+    parser.add_argument('-o', '--output', default=None, help='Write the benchmark table in this TSV file.')
+
+    parser.add_argument("-v", "--verbose", help="increase output verbosity",
+                        action="store_true")
+
+    args = parser.parse_args()
+
+    if bool(args.abundance_table) != bool(args.multiaffi_table):
+        parser.error('--abundance_table and --multiaffi_table go together.')
+
+    return args
+
+
+def get_multihit_from_merged_table(df_merged):
+    """
+    Multihit table rebuilt from the mutliaffiliation column of a merged table.
+
+    Only the taxonomy of the hits is known, in their original order.
+    """
+    is_multi = df_merged["blast_subject"] == "multi-subject"
+    df_multihit = df_merged.loc[is_multi, ["observation_name", "mutliaffiliation"]]
+    df_multihit = df_multihit.assign(blast_taxonomy=df_multihit["mutliaffiliation"].str.split('|')).explode("blast_taxonomy")
+    df_multihit = df_multihit.rename(columns={"observation_name": "#observation_name"})[["#observation_name", "blast_taxonomy"]]
+
+    return df_multihit.set_index("#observation_name", drop=False)
+
+
+def count_mismatches(values, expected_values):
+    values = pd.Series(values).reset_index(drop=True)
+    expected_values = pd.Series(expected_values).reset_index(drop=True)
+
+    if pd.api.types.is_float_dtype(values) and pd.api.types.is_float_dtype(expected_values):
+        return int((~np.isclose(values, expected_values, equal_nan=True)).sum())
+
+    both_missing = values.isna() & expected_values.isna()
+
+    return int(((values.astype(object) != expected_values.astype(object)) & ~both_missing).sum())
+
+
+def check_merged_table(merged_table, ranks):
+    """
+    Recompute the columns of a merged table from its FROGS columns and count the differences.
+
+    The multi-affiliations are recomputed from the hit taxonomies given by the
+    mutliaffiliation column. The consensus taxonomy of multi-affiliated clusters
+    is compared with get_common_taxonomy, the per cluster implementation, as
+    some merged tables predate the trimming of strains in the consensus. The
+    threshold flags are recomputed with the thresholds found in their column
+    names and the per sample rank table, when found next to the merged table,
+    with get_rank_abundance_by_sample.
+
+    Return a list of (check, number of compared values, number of mismatches).
+    """
+    df_merged = pd.read_csv(merged_table, sep='\t')
+    df_multihit = get_multihit_from_merged_table(df_merged)
+    is_multi = (df_merged["blast_subject"] == "multi-subject").to_numpy()
+
+    checks = []
+
+    df = df_merged.loc[:, :"observation_sum"].join(df_merged[get_sample_columns(df_merged)])
+
+    add_multi_affi_to_df(df, df_multihit)
+    checks.append(("mutliaffiliation", len(df), count_mismatches(df["mutliaffiliation"], df_merged["mutliaffiliation"])))
+
+    multi_clusters = df_merged.loc[is_multi, "observation_name"]
+    common_taxonomies = multi_clusters.map(get_common_taxonomy_by_cluster(df_multihit, multi_clusters))
+    expected_taxonomies = [get_common_taxonomy(hits.split('|'), delete_strain_info=True) for hits in df_merged.loc[is_multi, "mutliaffiliation"]]
+    checks.append(("common_taxonomy", len(multi_clusters), count_mismatches(common_taxonomies, expected_taxonomies)))
+
+    # lineages and flags are computed on the taxonomies, identities and coverages of the merged table
+    df["blast_taxonomy"] = df_merged["blast_taxonomy"]
+    get_lineage_info.cache_clear()
+    add_lineage_columns(df, ranks)
+    for column in ["taxon_affi", "rank_affi", "blast_taxonomy_cleaned"] + ranks:
+        checks.append((column, len(df), count_mismatches(df[column], df_merged[column])))
+
+    df = df.astype({"blast_perc_identity": float, "blast_perc_query_coverage": float})
+    for column in [c for c in df_merged.columns if c.startswith("id>")]:
+        min_id, min_cov = (float(t) if '.' in t else int(t) for t in column[len("id>"):].split("_cov>"))
+        add_threshold_columns(df, [min_id], [min_cov])
+        for flag_column in [f"coverage_>=_{min_cov}", f"identity_>=_{min_id}", column]:
+            checks.append((flag_column, len(df), count_mismatches(df[flag_column], df_merged[flag_column])))
+
+    abundance = 100 * df["observation_sum"] / df["observation_sum"].sum()
+    checks.append(("abundance", len(df), count_mismatches(abundance, df_merged["abundance"])))
+
+    rank_table = merged_table.replace("_affi_tables_merged.tsv", "_taxonomic_ranks_per_target_and_per_sample_taxo_ranks.tsv")
+    if os.path.exists(rank_table):
+        df_expected_ranks = pd.read_csv(rank_table, sep='\t')
+
+        df_merged['name'] = df_expected_ranks['name'].iloc[0]
+        df_merged['Taxonomic rank'] = df_merged['rank_affi'].where(df_merged['valid_affiliation'], "weak affiliation")
+        samples = list(dict.fromkeys(df_expected_ranks['sample']))
+
+        df_ranks = get_rank_abundance_by_sample(df_merged, samples)
+        keys = ['Taxonomic rank', 'region', 'sample']
+        df_compared = df_ranks.merge(df_expected_ranks, on=keys, how='outer', suffixes=('', '_expected'), indicator=True)
+
+        checks.append(("rank_by_sample_rows", len(df_compared), int((df_compared['_merge'] != "both").sum())))
+        for column in ['sample_sum', 'abundance', 'observation_name']:
+            checks.append((f"rank_by_sample_{column}", len(df_compared),
+                           count_mismatches(df_compared[column].astype(float), df_compared[f"{column}_expected"].astype(float))))
+
+    return checks
+
+
+def get_best_covid_from_multihit(df_covid, df_multiaff):
+    """
+    Identity and coverage of the best hit of a cluster tagged multi-identity or multi-coverage.
+
+    Former per cluster implementation, scanning the whole multihit table for
+    each cluster, kept as the reference of get_best_hit_index.
+    """
+    cluster = df_covid["observation_name"]
+    blast_perc_identity = df_covid["blast_perc_identity"]
+    blast_perc_query_coverage = df_covid["blast_perc_query_coverage"]
+
+    if (
+        blast_perc_identity == "multi-identity"
+        or blast_perc_query_coverage == "multi-coverage"
+    ):
+        # select multiaffi of the cluster
+        filt = df_multiaff["#observation_name"] == cluster
+        cluster_multiaffi = df_multiaff.loc[filt]
+
+        # sort multiaffi on id and cov
+        cluster_multiaffi = cluster_multiaffi.sort_values(
+            by=["blast_perc_identity", "blast_perc_query_coverage"], ascending=False
+        )
+        # set best hit in df
+        df_covid["blast_perc_identity"] = cluster_multiaffi["blast_perc_identity"].iloc[
+            0
+        ]
+        df_covid["blast_perc_query_coverage"] = cluster_multiaffi[
+            "blast_perc_query_coverage"
+        ].iloc[0]
+
+    return df_covid
+
+
+def get_corresponding_species_mock(tax_and_multiaffi, mock_taxonomies):
+    """
+    Mock taxonomies a cluster starts with, one cluster and one mock taxonomy at a time.
+
+    Former implementation of the mock linking, kept as the reference of add_mock_species_to_df.
+    """
+    taxonomy_str = tax_and_multiaffi["blast_taxonomy"]
+    mutliaffiliation_str = tax_and_multiaffi["mutliaffiliation"]
+
+    sp_hits = set()
+    if taxonomy_str.endswith("Multi-affiliation"):
+        for affi in mutliaffiliation_str.split('|'):
+            sp_hits |= get_corresponding_species_mock({'blast_taxonomy':affi, 'mutliaffiliation':None}, mock_taxonomies)
+
+    else:
+        for mock_tax in mock_taxonomies:
+            if taxonomy_str.startswith(mock_tax):
+                sp_hits.add(mock_tax)
+
+    return sp_hits
+
+
+def check_mock_species(abundance_table, multiaffi_table, ranks, min_identity, min_coverage, nb_mock_species=20):
+    """
+    Compare add_mock_species_to_df with get_corresponding_species_mock followed by clean_mock_sp_relation.
+
+    The mock holds the species of the first clusters and the genus of some
+    of them, so that clusters may be linked to several mock species.
+    """
+    df = process_frogs_affiliation(abundance_table, multiaffi_table, ranks, min_ids=[min_identity], min_covs=[min_coverage])
+
+    species_taxonomies = df.loc[~df["blast_taxonomy"].str.endswith("Multi-affiliation"), "blast_taxonomy"].astype(str)
+    mock_taxonomies = list(dict.fromkeys(species_taxonomies.head(nb_mock_species)))
+    mock_taxonomies += [';'.join(taxonomy.split(';')[:-1]) for taxonomy in mock_taxonomies[::4]]
+    taxonomies2mock_species = {taxonomy: f"mock_species_{i}" for i, taxonomy in enumerate(mock_taxonomies)}
+
+    df_affiliation = df[["blast_taxonomy", "mutliaffiliation"]].astype(object)
+    # clusters of a mock species and of its genus are logged by clean_mock_sp_relation
+    logging.disable(logging.WARNING)
+    try:
+        expected = [clean_mock_sp_relation(get_corresponding_species_mock(cluster, taxonomies2mock_species))
+                    for cluster in df_affiliation.to_dict('records')]
+        add_mock_species_to_df(df, taxonomies2mock_species)
+    finally:
+        logging.disable(logging.NOTSET)
+
+    return [("mock_species_taxonomy", len(df), count_mismatches(df["sp_mock_taxonomy"], expected))]
+
+
+def check_best_hits(df_abundance, df_multihit, nb_clusters=1000):
+    """
+    Compare get_best_hit_index with get_best_covid_from_multihit, the per cluster implementation,
+    on the first multi-affiliated clusters of a table loaded by load_abundance_table.
+    """
+    covid_columns = ["observation_name", "blast_perc_identity", "blast_perc_query_coverage", "multi_identity", "multi_coverage"]
+    is_multi_covid = df_abundance["multi_identity"] | df_abundance["multi_coverage"]
+    df_covid = df_abundance.loc[is_multi_covid, covid_columns].head(nb_clusters)
+
+    # the per cluster implementation expects the multi-identity and multi-coverage tags of the FROGS table
+    df_tagged = df_covid.astype({"blast_perc_identity": object, "blast_perc_query_coverage": object})
+    df_tagged.loc[df_covid["multi_identity"], "blast_perc_identity"] = "multi-identity"
+    df_tagged.loc[df_covid["multi_coverage"], "blast_perc_query_coverage"] = "multi-coverage"
+    expected = df_tagged.apply(get_best_covid_from_multihit, args=(df_multihit,), axis=1)
+
+    df_best = df_covid.copy()
+    add_best_covid_from_multihit(df_best, get_best_hit_index(df_multihit))
+
+    return [(f"best_hit_{column}", len(df_covid), count_mismatches(df_best[column].astype(float), expected[column].astype(float)))
+            for column in ["blast_perc_identity", "blast_perc_query_coverage"]]
+
+
+def check_without_multi_affiliation(df_abundance, df_multihit, nb_clusters=10):
+    """
+    Run improve_affi_with_multiaffi on the first clusters of a table loaded by load_abundance_table
+    that have no multi-affiliation, whose taxonomy must be left unchanged.
+    """
+    df = df_abundance.loc[df_abundance["blast_subject"] != "multi-subject"].head(nb_clusters).copy()
+    improve_affi_with_multiaffi(df, df_multihit)
+
+    return [("no_multi_affiliation_taxonomy", len(df), count_mismatches(df["blast_taxonomy"], df["blast_taxonomy_original"]))]
+
+
+def check_small_chunks(abundance_table, multiaffi_table, ranks, min_identity, min_coverage, chunksize=5):
+    """
+    Compare the chunks of iter_frogs_affiliation_chunks with process_frogs_affiliation on the whole table.
+
+    Small chunks hold chunks without multi-affiliated cluster or without taxonomy
+    as long as the ranks, which must give the same rows as the whole table.
+    """
+    thresholds = {"min_ids": [min_identity], "min_covs": [min_coverage]}
+    df_whole = process_frogs_affiliation(abundance_table, multiaffi_table, ranks, **thresholds)
+    df_chunks = pd.concat(iter_frogs_affiliation_chunks(abundance_table, multiaffi_table, ranks, chunksize=chunksize, **thresholds))
+
+    return compare_tables("small_chunks", df_chunks, df_whole)
+
+
+def check_cache_runs(abundance_table, multiaffi_table, min_identity, min_coverage,
+                     ranks=['Domain', 'Phylum', 'Class', 'Order', 'Family', 'Genus', 'Species', 'Species']):
+    """
+    Compare two runs of process_frogs_affiliation with a new AffiliationCache, filling then reading it,
+    with a run without cache. The default ranks of add_multiaffi_to_abd_table.py hold Species twice.
+    """
+    thresholds = {"min_ids": [min_identity], "min_covs": [min_coverage]}
+    df_expected = process_frogs_affiliation(abundance_table, multiaffi_table, ranks, **thresholds)
+
+    checks = []
+    with tempfile.TemporaryDirectory() as cache_dir:
+        with AffiliationCache(os.path.join(cache_dir, "affiliations.sqlite")) as cache:
+            for run in ["cache_store", "cache_lookup"]:
+                df = process_frogs_affiliation(abundance_table, multiaffi_table, ranks, cache=cache, **thresholds)
+                checks += compare_tables(run, df, df_expected)
+
+    return checks
+
+
+def write_json_biom(abundance_table, multiaffi_table, biom_file):
+    """
+    Write the tables given by biom_to_tsv.py back as a FROGS affiliation biom file (BIOM 1.0 JSON).
+
+    The blast affiliations of a cluster are its hits in the multihit table, or
+    the blast columns of the abundance table when it has no multi-affiliation.
+    """
+    df = pd.read_csv(abundance_table, sep='\t', dtype=str, keep_default_na=False)
+    df_multihit = pd.read_csv(multiaffi_table, sep='\t', dtype=str, keep_default_na=False)
+    samples = get_sample_columns(df)
+
+    def get_blast_affiliation(hit):
+        return {"taxonomy": hit["blast_taxonomy"].split(';'), "subject": hit["blast_subject"],
+                "perc_identity": float(hit["blast_perc_identity"]), "perc_query_coverage": float(hit["blast_perc_query_coverage"]),
+                "evalue": float(hit["blast_evalue"]), "aln_length": int(hit["blast_aln_length"])}
+
+    cluster2hits = {cluster: [get_blast_affiliation(hit) for hit in df_hits.to_dict('records')]
+                    for cluster, df_hits in df_multihit.groupby("#observation_name", sort=False)}
+
+    rows = []
+    for cluster in df.to_dict('records'):
+        rdp_fields = cluster["rdp_tax_and_bootstrap"].rstrip(';').split(';')
+        affiliations = cluster2hits.get(cluster["observation_name"]) or [get_blast_affiliation(cluster)]
+        rows.append({"id": cluster["observation_name"],
+                     "metadata": {"seed_id": cluster["seed_id"], "blast_taxonomy": cluster["blast_taxonomy"].split(';'),
+                                  "blast_affiliations": affiliations, "rdp_taxonomy": rdp_fields[0::2],
+                                  "rdp_bootstrap": [bootstrap.strip('()') for bootstrap in rdp_fields[1::2]]}})
+
+    counts = df[samples].astype(np.int64).to_numpy()
+    data = [[int(i), int(j), int(counts[i, j])] for i, j in zip(*np.nonzero(counts))]
+
+    with open(biom_file, 'w') as fl:
+        json.dump({"format": "Biological Observation Matrix 1.0.0", "type": "OTU table", "matrix_type": "sparse",
+                   "shape": list(counts.shape), "rows": rows, "columns": [{"id": s, "metadata": None} for s in samples],
+                   "data": data}, fl)
+
+
+def check_biom_table(abundance_table, multiaffi_table, ranks, min_identity, min_coverage, nb_clusters=10):
+    """
+    Compare process_frogs_affiliation on the tables given by biom_to_tsv.py and on the same data as a biom file.
+
+    The hits of the first multi-affiliated clusters get different alignment
+    lengths, so that these clusters carry the multi-alignment-lg tag.
+    """
+    df = pd.read_csv(abundance_table, sep='\t', dtype=str, keep_default_na=False)
+    df_multihit = pd.read_csv(multiaffi_table, sep='\t', dtype=str, keep_default_na=False)
+
+    clusters = df.loc[df["blast_subject"] == "multi-subject", "observation_name"].head(nb_clusters)
+    df.loc[df["observation_name"].isin(clusters), "blast_aln_length"] = "multi-alignment-lg"
+    first_hits = df_multihit.loc[df_multihit["#observation_name"].isin(clusters)].drop_duplicates("#observation_name").index
+    df_multihit.loc[first_hits, "blast_aln_length"] = (df_multihit.loc[first_hits, "blast_aln_length"].astype(int) - 1).astype(str)
+
+    thresholds = {"min_ids": [min_identity], "min_covs": [min_coverage]}
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        tables = [os.path.join(tmp_dir, table) for table in ["abundance.tsv", "multihit.tsv", "affiliation.biom"]]
+        df.to_csv(tables[0], sep='\t', index=False)
+        df_multihit.to_csv(tables[1], sep='\t', index=False)
+        write_json_biom(tables[0], tables[1], tables[2])
+
+        df_expected = process_frogs_affiliation(tables[0], tables[1], ranks, **thresholds)
+        df_biom = process_frogs_affiliation(tables[2], None, ranks, **thresholds)
+
+    return compare_tables("biom", df_biom, df_expected)
+
+
+def compare_tables(name, df, df_expected):
+    """Mismatches of each column of df with df_expected, and of the number of rows and columns."""
+    checks = [(f"{name}_rows", len(df_expected), abs(len(df_expected) - len(df))),
+              (f"{name}_columns", len(df_expected.columns), int(list(df.columns) != list(df_expected.columns)))]
+    for column in df_expected.columns.drop_duplicates():
+        if column in df.columns and len(df) == len(df_expected):
+            values, expected_values = df[column], df_expected[column]
+            if isinstance(values, pd.DataFrame):
+                values, expected_values = values.iloc[:, 0], expected_values.iloc[:, 0]
+            if pd.api.types.is_numeric_dtype(expected_values) and not pd.api.types.is_bool_dtype(expected_values):
+                values, expected_values = values.astype(float), expected_values.astype(float)
+            checks.append((f"{name}_{column}", len(df_expected), count_mismatches(values, expected_values)))
+
+    return checks
+
+
+def get_benchmark_stages(ranks, min_identity, min_coverage):
+    """
+    Stages of the post-processing, in order, as (name, function) pairs.
+
+    Each function takes and updates a dict holding the tables of the run.
+    """
+    def read_tables(run):
+        run["df"] = load_abundance_table(run["abundance_table"])
+        run["df_multihit"] = load_multihit_table(run["multiaffi_table"])
+
+    def best_hit_index(run):
+        run["best_hit_index"] = get_best_hit_index(run["df_multihit"])
+
+    def multi_affiliation(run):
+        add_multi_affi_to_df(run["df"], run["df_multihit"])
+
+    def common_taxonomy(run):
+        improve_affi_with_multiaffi(run["df"], run["df_multihit"])
+
+    def best_hit(run):
+        add_best_covid_from_multihit(run["df"], run["best_hit_index"])
+
+    def rank_resolution(run):
+        get_lineage_info.cache_clear()
+        add_lineage_columns(run["df"], ranks)
+        categorize_lineage_columns(run["df"], ranks)
+
+    def threshold_flags(run):
+        df = run["df"]
+        add_threshold_columns(df, [min_identity], [min_coverage])
+        df["valid_affiliation"] = df[f"id>{min_identity}_cov>{min_coverage}"]
+        run["df"] = df
+
+    def rank_aggregation(run):
+        df = run["df"]
+        samples = get_sample_columns(df)
+        df["region"] = "synthetic"
+        df["name"] = "synthetic"
+        df["Taxonomic rank"] = df["rank_affi"].astype(object).where(df["valid_affiliation"], "weak affiliation")
+        run["df_ranks"] = get_rank_abundance_by_sample(df, samples)
+
+    return [("read_tables", read_tables), ("best_hit_index", best_hit_index), ("add_multi_affi_to_df", multi_affiliation),
+            ("improve_affi_with_multiaffi", common_taxonomy), ("add_best_covid_from_multihit", best_hit),
+            ("rank_resolution", rank_resolution), ("threshold_flags", threshold_flags), ("rank_aggregation", rank_aggregation)]
+
+
+def run_stages(stages, abundance_table, multiaffi_table, trace_memory=False):
+    """
+    Run all stages once and return the time and, with trace_memory, the peak of memory allocated by each stage.
+    """
+    run = {"abundance_table": abundance_table, "multiaffi_table": multiaffi_table}
+    stage_results = []
+    for name, stage in stages:
+        gc.collect()
+        if trace_memory:
+            tracemalloc.start()
+
+        start = time.perf_counter()
+        stage(run)
+        elapsed = time.perf_counter() - start
+
+        peak_memory = np.nan
+        if trace_memory:
+            _, peak_memory = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+
+        stage_results.append({"stage": name, "time": elapsed, "peak_memory_mb": peak_memory / 1e6})
+
+    return stage_results, run
+
+
+def benchmark_stages(abundance_table, multiaffi_table, ranks, min_identity, min_coverage, repeat=3):
+    """
+    Best time of each stage over repeat runs and the peak memory it allocates, measured in an additional traced run.
+    """
+    stages = get_benchmark_stages(ranks, min_identity, min_coverage)
+
+    timings = []
+    for i in range(repeat):
+        stage_results, run = run_stages(stages, abundance_table, multiaffi_table)
+        timings.append(pd.DataFrame(stage_results))
+        logging.info(f'Run {i + 1}/{repeat} done in {timings[-1]["time"].sum():.3f}s')
+
+    memory_results, _ = run_stages(stages, abundance_table, multiaffi_table, trace_memory=True)
+
+    df_benchmark = pd.concat(timings).groupby("stage", sort=False)["time"].min().reset_index()
+    df_benchmark["peak_memory_mb"] = pd.DataFrame(memory_results)["peak_memory_mb"].to_numpy()
+    df_benchmark["clusters"] = len(run["df"])
+    df_benchmark["clusters_per_s"] = df_benchmark["clusters"] / df_benchmark["time"]
+
+    return df_benchmark, run
+
+
+def main():
+
+    args = parse_arguments()
+
+    if args.verbose:
+        logging.basicConfig(format="%(levelname)s: %(message)s", level=logging.INFO)
+    else:
+        logging.basicConfig(format="%(levelname)s: %(message)s")
+
+    ranks = args.taxonomic_ranks.split(' ')
+
+    mismatches = 0
+    if not args.skip_check:
+        merged_tables = sorted(glob.glob(os.path.join(args.results_dir, "*_affi_tables_merged.tsv")))
+        if not merged_tables:
+            logging.warning(f'No merged table found in {args.results_dir}')
+
+        for merged_table in merged_tables:
+            for check, nb_values, nb_mismatches in check_merged_table(merged_table, ranks):
+                mismatches += nb_mismatches
+                if nb_mismatches:
+                    logging.error(f'{os.path.basename(merged_table)}: {nb_mismatches}/{nb_values} values of {check} differ')
+            logging.info(f'{merged_table} checked')
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        abundance_table, multiaffi_table = args.abundance_table, args.multiaffi_table
+        if abundance_table is None:
+            logging.info(f'Generating a synthetic table of {args.nb_clusters} clusters and {args.nb_samples} samples')
+            abundance_table, multiaffi_table = write_synthetic_frogs_tables(
+                os.path.join(tmp_dir, "synthetic"), args.nb_clusters, args.nb_samples, args.multi_affi_rate, seed=args.seed)
+
+        if not args.skip_check:
+            df_abundance = load_abundance_table(abundance_table)
+            df_multihit = load_multihit_table(multiaffi_table)
+            checks = check_best_hits(df_abundance, df_multihit) + check_without_multi_affiliation(df_abundance, df_multihit)
+            checks += check_small_chunks(abundance_table, multiaffi_table, ranks, args.min_identity, args.min_coverage)
+            checks += check_cache_runs(abundance_table, multiaffi_table, args.min_identity, args.min_coverage)
+            checks += check_biom_table(abundance_table, multiaffi_table, ranks, args.min_identity, args.min_coverage)
+            checks += check_mock_species(abundance_table, multiaffi_table, ranks, args.min_identity, args.min_coverage)
+            for check, nb_values, nb_mismatches in checks:
+                mismatches += nb_mismatches
+                if nb_mismatches:
+                    logging.error(f'{nb_mismatches}/{nb_values} values of {check} differ')
+            del df_abundance, df_multihit
+
+        df_benchmark, _ = benchmark_stages(abundance_table, multiaffi_table, ranks,
+                                           args.min_identity, args.min_coverage, args.repeat)
+
+    print(df_benchmark.to_string(index=False, float_format=lambda x: f"{x:.3f}"))
+    print(f'Total: {df_benchmark["time"].sum():.3f}s')
+
+    if args.output:
+        df_benchmark.to_csv(args.output, sep='\t', index=False)
+
+    if mismatches:
+        logging.error(f'{mismatches} values differ from the expected results')
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
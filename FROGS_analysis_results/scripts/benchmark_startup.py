@@ -0,0 +1,121 @@
+# Metadata
+__author__ = 'Mainguy Jean - Plateforme bioinformatique Toulouse'
+__copyright__ = 'Copyright (C) 2020 INRAE'
+__license__ = 'GNU General Public License'
+
+
+from argparse import ArgumentParser, ArgumentDefaultsHelpFormatter
+import logging
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+
+ENTRY_POINT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "frogs_post_process.py")
+
+# libraries the help and argument errors must not import
+HEAVY_MODULES = ["pandas", "numpy", "scipy", "plotly", "pyarrow"]
+
+MERGE_ARGS = ["--abundance_table", "table.tsv", "--multiaffi_table", "multihit.tsv", "--region", "rpoB", "--affi_db_name", "db"]
+
+# name, arguments of frogs_post_process.py and expected exit code. mock-eval and
+# direct-vs-nested are library modules importing pandas, so they are left out
+STARTUP_CASES = [
+    ("help", ["-h"], 0),
+    ("unknown_command", ["unknown"], 2),
+    ("merge_help", ["merge", "-h"], 0),
+    ("merge_missing_args", ["merge", "--region", "rpoB"], 2),
+    ("merge_mock_metrics_alone", ["merge"] + MERGE_ARGS + ["--mock_metrics", "mock_metrics.tsv"], 2),
+    ("merge_biom_chunksize", ["merge", "--abundance_table", "table.biom", "--region", "rpoB", "--affi_db_name", "db", "--chunksize", "1000"], 2),
+    ("plot_help", ["plot", "-h"], 0),
+    ("plot_missing_samples", ["plot", "--affi_tables", "table.tsv"], 2),
+    ("batch_help", ["batch", "-h"], 0),
+]
+
+
+def parse_arguments():
+    """Parse script arguments."""
+    parser = ArgumentParser(description="Time the help and argument error paths of frogs_post_process.py, "
+                            "check they stay under a time budget and import none of the heavy libraries.",
+                            formatter_class=ArgumentDefaultsHelpFormatter)
+
+    parser.add_argument('-r', '--repeat', default=10, type=int, help='Number of runs of each case. The median time is reported.')
+
+    parser.add_argument('--budget_ms', default=100, type=float,
+                        help='Maximum median time of a case above the startup of a bare interpreter, in milliseconds.')
+
+    parser.add_argument("-v", "--verbose", help="increase output verbosity",
+                        action="store_true")
+
+    args = parser.parse_args()
+    return args
+
+
+def time_command(cmd, repeat):
+    """Median wall time of cmd in milliseconds and its exit code."""
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        process = subprocess.run(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        times.append(1000 * (time.perf_counter() - start))
+
+    return statistics.median(times), process.returncode
+
+
+def get_imported_heavy_modules(cmd_args):
+    """Heavy modules imported by frogs_post_process.py run with cmd_args, read from the -X importtime report."""
+    process = subprocess.run([sys.executable, "-X", "importtime", ENTRY_POINT] + cmd_args,
+                             stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True)
+
+    imported = set()
+    for line in process.stderr.splitlines():
+        if line.startswith("import time:") and "|" in line:
+            module = line.rsplit("|", 1)[1].strip()
+            imported.add(module.split(".")[0])
+
+    return [module for module in HEAVY_MODULES if module in imported]
+
+
+def main():
+
+    args = parse_arguments()
+
+    if args.verbose:
+        logging.basicConfig(format="%(levelname)s: %(message)s", level=logging.INFO)
+    else:
+        logging.basicConfig(format="%(levelname)s: %(message)s")
+
+    interpreter_ms, _ = time_command([sys.executable, "-c", "pass"], args.repeat)
+    pandas_ms, _ = time_command([sys.executable, "-c", "import pandas"], args.repeat)
+    logging.info(f'Bare interpreter startup {interpreter_ms:.1f} ms, with the import of pandas {pandas_ms:.1f} ms')
+
+    print(f"{'case':<28}{'median_ms':>11}{'overhead_ms':>13}{'exit':>6}  heavy_imports")
+
+    failures = []
+    for name, cmd_args, expected_code in STARTUP_CASES:
+        median_ms, code = time_command([sys.executable, ENTRY_POINT] + cmd_args, args.repeat)
+        overhead_ms = median_ms - interpreter_ms
+        heavy_modules = get_imported_heavy_modules(cmd_args)
+
+        print(f"{name:<28}{median_ms:>11.1f}{overhead_ms:>13.1f}{code:>6}  {' '.join(heavy_modules) or '-'}")
+
+        if code != expected_code:
+            failures.append(f'{name} exited with {code} instead of {expected_code}')
+        if heavy_modules:
+            failures.append(f'{name} imports {", ".join(heavy_modules)}')
+        if overhead_ms > args.budget_ms:
+            failures.append(f'{name} takes {overhead_ms:.1f} ms above the interpreter startup, over the budget of {args.budget_ms} ms')
+
+    print(f"Interpreter startup {interpreter_ms:.1f} ms, budget {args.budget_ms} ms above it")
+
+    for failure in failures:
+        logging.error(failure)
+
+    if failures:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,172 @@
+# Metadata
+__author__ = 'Mainguy Jean - Plateforme bioinformatique Toulouse'
+__copyright__ = 'Copyright (C) 2020 INRAE'
+__license__ = 'GNU General Public License'
+
+
+import json
+import logging
+import numpy as np
+import pandas as pd
+from scipy import sparse
+
+
+HDF5_SIGNATURE = b'\x89HDF\r\n\x1a\n'
+
+# tag used by biom_to_tsv.py when the affiliations of a cluster disagree
+BLAST_FIELDS = {
+    "subject": ("blast_subject", "multi-subject"),
+    "perc_identity": ("blast_perc_identity", "multi-identity"),
+    "perc_query_coverage": ("blast_perc_query_coverage", "multi-coverage"),
+    "evalue": ("blast_evalue", "multi-evalue"),
+    "aln_length": ("blast_aln_length", "multi-alignment-lg"),
+}
+
+
+def is_hdf5_file(biom_file):
+    with open(biom_file, 'rb') as fl:
+        return fl.read(len(HDF5_SIGNATURE)) == HDF5_SIGNATURE
+
+
+def read_json_biom(biom_file):
+    """
+    Read a BIOM 1.0 (JSON) file.
+
+    Return observation ids, sample ids, observation metadata and the counts as a
+    CSR matrix of shape (observations, samples).
+    """
+    with open(biom_file) as fl:
+        biom = json.load(fl)
+
+    observation_ids = [row['id'] for row in biom['rows']]
+    sample_ids = [col['id'] for col in biom['columns']]
+    metadata = [row['metadata'] or {} for row in biom['rows']]
+
+    if biom['matrix_type'] == 'sparse':
+        data = np.array(biom['data'], dtype=float).reshape(-1, 3)
+        counts = sparse.csr_matrix((data[:, 2], (data[:, 0].astype(int), data[:, 1].astype(int))), shape=biom['shape'])
+    else:
+        counts = sparse.csr_matrix(np.array(biom['data'], dtype=float).reshape(biom['shape']))
+
+    return observation_ids, sample_ids, metadata, counts
+
+
+def decode_hdf5_metadata_value(value):
+    if isinstance(value, bytes):
+        value = value.decode()
+
+    if isinstance(value, np.ndarray):
+        # list of strings like the taxonomy, padded with empty strings
+        return [v.decode() if isinstance(v, bytes) else v for v in value if v not in (b'', '')]
+
+    if value == '':
+        return None
+
+    try:
+        return json.loads(value)
+    except ValueError:
+        return value
+
+
+def read_hdf5_biom(biom_file):
+    """
+    Read a BIOM 2.x (HDF5) file.
+
+    Return observation ids, sample ids, observation metadata and the counts as a
+    CSR matrix of shape (observations, samples).
+    """
+    import h5py
+
+    with h5py.File(biom_file, 'r') as biom:
+        observation_ids = [i.decode() if isinstance(i, bytes) else i for i in biom['observation/ids'][:]]
+        sample_ids = [i.decode() if isinstance(i, bytes) else i for i in biom['sample/ids'][:]]
+
+        matrix = biom['observation/matrix']
+        counts = sparse.csr_matrix((matrix['data'][:], matrix['indices'][:], matrix['indptr'][:]),
+                                   shape=(len(observation_ids), len(sample_ids)))
+
+        metadata = [{} for _ in observation_ids]
+        for key, values in biom['observation/metadata'].items():
+            for observation_metadata, value in zip(metadata, values[:]):
+                observation_metadata[key] = decode_hdf5_metadata_value(value)
+
+    return observation_ids, sample_ids, metadata, counts
+
+
+def get_blast_columns(affiliations):
+    """
+    Blast columns of a cluster as written by biom_to_tsv.py.
+
+    A field takes its multi- tag when the affiliations of the cluster do not agree on its value.
+    """
+    if not affiliations:
+        return {column: "no data" for column, _ in BLAST_FIELDS.values()}
+
+    blast_columns = {}
+    for field, (column, multi_tag) in BLAST_FIELDS.items():
+        values = {affi[field] for affi in affiliations}
+        blast_columns[column] = values.pop() if len(values) == 1 else multi_tag
+
+    return blast_columns
+
+
+def get_rdp_tax_and_bootstrap(observation_metadata):
+    rdp_taxonomy = observation_metadata.get('rdp_taxonomy')
+    rdp_bootstrap = observation_metadata.get('rdp_bootstrap')
+    if not rdp_taxonomy:
+        return "no data"
+
+    return ''.join(f"{taxon};({bootstrap});" for taxon, bootstrap in zip(rdp_taxonomy, rdp_bootstrap))
+
+
+def load_frogs_biom(biom_file):
+    """
+    Load a FROGS affiliation biom file (BIOM 1.0 JSON or BIOM 2.x HDF5).
+
+    Return the abundance table and the multihit table with the columns of the
+    tables given by biom_to_tsv.py, without seed_sequence which is not part of
+    the biom. Sample counts are kept as sparse columns and blast information and
+    multi-affiliations come from the observation metadata.
+    """
+    if is_hdf5_file(biom_file):
+        observation_ids, sample_ids, metadata, counts = read_hdf5_biom(biom_file)
+    else:
+        observation_ids, sample_ids, metadata, counts = read_json_biom(biom_file)
+
+    logging.info(f'{biom_file}: {len(observation_ids)} clusters and {len(sample_ids)} samples with {counts.nnz} non zero counts')
+
+    rows = []
+    multihit_rows = []
+    for observation_id, observation_metadata in zip(observation_ids, metadata):
+        affiliations = observation_metadata.get('blast_affiliations') or []
+        blast_taxonomy = observation_metadata.get('blast_taxonomy')
+
+        row = {"rdp_tax_and_bootstrap": get_rdp_tax_and_bootstrap(observation_metadata),
+               "blast_taxonomy": ';'.join(blast_taxonomy) if blast_taxonomy else "no data"}
+        row.update(get_blast_columns(affiliations))
+        row["seed_id"] = observation_metadata.get('seed_id', "no data")
+        row["observation_name"] = observation_id
+        rows.append(row)
+
+        if len(affiliations) > 1:
+            for affi in affiliations:
+                multihit_row = {"#observation_name": observation_id,
+                                "blast_taxonomy": ';'.join(affi['taxonomy'])}
+                multihit_row.update({column: affi[field] for field, (column, _) in BLAST_FIELDS.items()})
+                multihit_rows.append(multihit_row)
+
+    df = pd.DataFrame(rows)
+
+    # as in the table of biom_to_tsv.py read by pandas, blast columns holding a multi- tag or no data are strings
+    for column, _ in BLAST_FIELDS.values():
+        numbers = pd.to_numeric(df[column], errors='coerce')
+        df[column] = numbers if numbers.notna().all() else df[column].astype(str)
+
+    df["observation_sum"] = np.asarray(counts.sum(axis=1)).ravel().astype(np.int64)
+
+    df_counts = pd.DataFrame.sparse.from_spmatrix(counts.astype(np.uint32), index=df.index, columns=sample_ids)
+    df = pd.concat([df, df_counts], axis=1)
+
+    df_multihit = pd.DataFrame(multihit_rows, columns=["#observation_name", "blast_taxonomy"] + [column for column, _ in BLAST_FIELDS.values()])
+
+    return df, df_multihit
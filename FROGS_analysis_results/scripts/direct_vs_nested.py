@@ -0,0 +1,215 @@
+# Metadata
+__author__ = 'Mainguy Jean - Plateforme bioinformatique Toulouse'
+__copyright__ = 'Copyright (C) 2020 INRAE'
+__license__ = 'GNU General Public License'
+
+
+from argparse import ArgumentParser, ArgumentDefaultsHelpFormatter
+import logging
+import re
+import warnings
+
+import numpy as np
+import pandas as pd
+from scipy import sparse
+
+from frogs_analysis_fct import process_frogs_affiliation, add_analysis_info, get_sample_columns, get_sample_count_matrix
+from table_formats import is_biom_file
+from table_io import read_affi_table
+
+
+def parse_arguments(argv=None, prog=None):
+    """Parse script arguments, argv being sys.argv[1:] by default."""
+    parser = ArgumentParser(prog=prog, description="Compare the taxa found by direct and nested PCR in the paired samples of an affiliation table.",
+                            formatter_class=ArgumentDefaultsHelpFormatter)
+
+    parser.add_argument('--affi_table', required=True,
+                        help='Affiliation abundance table, output of add_multiaffi_to_abd_table.py in TSV, Parquet or Feather format, '
+                        'or FROGS affiliation biom file processed with the --min_identity, --min_coverage and --taxonomic_ranks arguments.')
+
+    parser.add_argument('--direct_pattern', default='^D_', help='Regex matching the direct PCR samples. '
+                        'A direct and a nested sample are paired when their names are identical once the patterns are removed.')
+
+    parser.add_argument('--nested_pattern', default='^N_', help='Regex matching the nested PCR samples.')
+
+    parser.add_argument('--min_identity', default=98, type=float, help='Identity threshold to consider an affilition as weak. Only used for biom tables.')
+
+    parser.add_argument('--min_coverage', default=99, type=float, help='Coverage threshold to consider an affilition as weak. Only used for biom tables.')
+
+    parser.add_argument('--taxonomic_ranks', default='Domain Phylum Class Order Family Genus Species', help='Taxonomic ranks compared.')
+
+    parser.add_argument('--all_affiliations', action="store_true", help='Compare all clusters. By default clusters without a valid affiliation are left out of the taxa.')
+
+    parser.add_argument('--pseudocount', default=0.5, type=float, help='Count added to the taxa counts of both samples of a pair before computing the log2 fold change.')
+
+    parser.add_argument('-o', '--output', default='direct_vs_nested.tsv', help='Table with one row per taxon and rank summarizing all the pairs.')
+
+    parser.add_argument('--pair_output', default=None, help='Table with one row per taxon, rank and pair with the counts, abundances and log2 fold change of the pair.')
+
+    parser.add_argument("-v", "--verbose", help="increase output verbosity",
+                        action="store_true")
+
+    args = parser.parse_args(argv)
+    return args
+
+
+def pair_samples(samples, direct_pattern='^D_', nested_pattern='^N_'):
+    """
+    Pair the direct and nested samples whose names are identical once their pattern is removed.
+
+    Return a DataFrame with the columns pair, direct and nested, ordered as the direct samples.
+    """
+    direct_samples = {re.sub(direct_pattern, '', s): s for s in samples if re.search(direct_pattern, s)}
+    nested_samples = {re.sub(nested_pattern, '', s): s for s in samples if re.search(nested_pattern, s)}
+
+    pairs = [(key, sample, nested_samples[key]) for key, sample in direct_samples.items() if key in nested_samples]
+
+    paired_samples = {s for _, direct, nested in pairs for s in (direct, nested)}
+    unpaired = sorted((set(direct_samples.values()) | set(nested_samples.values())) - paired_samples)
+    if unpaired:
+        logging.warning(f'{len(unpaired)} samples have no pair: {" ".join(unpaired)}')
+
+    return pd.DataFrame(pairs, columns=["pair", "direct", "nested"])
+
+
+def get_taxon_indicator(df, ranks):
+    """
+    Sparse indicator matrix of shape (taxa, clusters) of the taxa of all ranks.
+
+    Each (rank, taxon) found in the rank columns of df is a row, so that a
+    single product aggregates the clusters of all ranks. Return the matrix and
+    a DataFrame with the rank and taxon of each row.
+    """
+    taxon_codes, cluster_codes, df_taxa_list = [], [], []
+    offset = 0
+    for rank in dict.fromkeys(ranks):
+        codes, taxa = pd.factorize(df[rank])
+        is_known = codes >= 0
+
+        taxon_codes.append(codes[is_known] + offset)
+        cluster_codes.append(np.flatnonzero(is_known))
+        df_taxa_list.append(pd.DataFrame({"rank": rank, "taxon": np.asarray(taxa, dtype=object)}))
+        offset += len(taxa)
+
+    taxon_codes, cluster_codes = np.concatenate(taxon_codes), np.concatenate(cluster_codes)
+    indicator = sparse.csr_matrix((np.ones(len(taxon_codes)), (taxon_codes, cluster_codes)), shape=(offset, len(df)))
+
+    return indicator, pd.concat(df_taxa_list, ignore_index=True)
+
+
+def get_log2_fold_change(direct_counts, nested_counts, direct_totals, nested_totals, pseudocount=0.5):
+    """
+    log2 of the nested over direct relative abundance, counts being of shape (taxa, pairs) and totals of shape (pairs,).
+
+    The pseudocount is added to the counts of both samples so that taxa found in
+    only one of them get a finite fold change.
+    """
+    nested_abundance = (nested_counts + pseudocount) / (nested_totals + pseudocount)
+    direct_abundance = (direct_counts + pseudocount) / (direct_totals + pseudocount)
+
+    return np.log2(nested_abundance) - np.log2(direct_abundance)
+
+
+def compare_direct_and_nested(df, df_pairs, ranks, valid_only=True, pseudocount=0.5):
+    """
+    Compare the taxa of each rank between the direct and nested samples of every pair at once.
+
+    The counts of the taxa come from one product of the (taxa, clusters)
+    indicator with the (clusters, samples) count matrix, relative abundances
+    being computed on all the sequences of each sample. With valid_only, the
+    clusters without a valid affiliation are left out of the taxa.
+
+    Return a summary table with one row per rank and taxon and a table with
+    one row per rank, taxon and pair.
+    """
+    counts = get_sample_count_matrix(df, list(df_pairs["direct"]) + list(df_pairs["nested"]))
+    totals = np.asarray(counts.sum(axis=0)).ravel()
+
+    if valid_only:
+        is_valid = df["valid_affiliation"].to_numpy(dtype=bool)
+        df, counts = df.loc[is_valid], counts[is_valid]
+
+    indicator, df_taxa = get_taxon_indicator(df, ranks)
+    taxon_counts = indicator @ counts
+    taxon_counts = taxon_counts.toarray() if sparse.issparse(taxon_counts) else np.asarray(taxon_counts)
+
+    nb_pairs = len(df_pairs)
+    direct_counts, nested_counts = taxon_counts[:, :nb_pairs], taxon_counts[:, nb_pairs:]
+    direct_totals, nested_totals = totals[:nb_pairs], totals[nb_pairs:]
+
+    in_direct, in_nested = direct_counts > 0, nested_counts > 0
+    log2fc = get_log2_fold_change(direct_counts, nested_counts, direct_totals, nested_totals, pseudocount)
+
+    # fold changes of the pairs where the taxon is not found at all are meaningless
+    log2fc_found = np.where(in_direct | in_nested, log2fc, np.nan)
+
+    direct_abundance = np.divide(100 * direct_counts, direct_totals, out=np.zeros_like(direct_counts), where=direct_totals > 0)
+    nested_abundance = np.divide(100 * nested_counts, nested_totals, out=np.zeros_like(nested_counts), where=nested_totals > 0)
+
+    df_summary = df_taxa.copy()
+    df_summary["pairs"] = nb_pairs
+    df_summary["present_direct"] = in_direct.sum(axis=1)
+    df_summary["present_nested"] = in_nested.sum(axis=1)
+    df_summary["present_both"] = (in_direct & in_nested).sum(axis=1)
+    df_summary["gained_in_nested"] = (~in_direct & in_nested).sum(axis=1)
+    df_summary["lost_in_nested"] = (in_direct & ~in_nested).sum(axis=1)
+    df_summary["absent_both"] = (~in_direct & ~in_nested).sum(axis=1)
+    df_summary["mean_abundance_direct"] = direct_abundance.mean(axis=1)
+    df_summary["mean_abundance_nested"] = nested_abundance.mean(axis=1)
+
+    with warnings.catch_warnings():
+        # taxa found in no pair have only NaN fold changes
+        warnings.simplefilter("ignore", category=RuntimeWarning)
+        df_summary["mean_log2fc"] = np.nanmean(log2fc_found, axis=1)
+        df_summary["median_log2fc"] = np.nanmedian(log2fc_found, axis=1)
+
+    nb_taxa = len(df_taxa)
+    df_by_pair = df_taxa.loc[np.repeat(np.arange(nb_taxa), nb_pairs)].reset_index(drop=True)
+    for column in ["pair", "direct", "nested"]:
+        df_by_pair[column] = np.tile(df_pairs[column].to_numpy(), nb_taxa)
+    df_by_pair["direct_count"] = direct_counts.ravel()
+    df_by_pair["nested_count"] = nested_counts.ravel()
+    df_by_pair["direct_abundance"] = direct_abundance.ravel()
+    df_by_pair["nested_abundance"] = nested_abundance.ravel()
+    df_by_pair["log2fc"] = log2fc_found.ravel()
+
+    return df_summary, df_by_pair
+
+
+def main(argv=None, prog=None):
+
+    args = parse_arguments(argv, prog)
+
+    if args.verbose:
+        logging.basicConfig(format="%(levelname)s: %(message)s", level=logging.INFO)
+        logging.info('Mode verbose ON')
+    else:
+        logging.basicConfig(format="%(levelname)s: %(message)s")
+
+    ranks = args.taxonomic_ranks.split(' ')
+
+    if is_biom_file(args.affi_table):
+        df = process_frogs_affiliation(args.affi_table, None, ranks, min_ids=[args.min_identity], min_covs=[args.min_coverage])
+        add_analysis_info(df, args.min_identity, args.min_coverage, 'unknown', 'unknown')
+    else:
+        df = read_affi_table(args.affi_table)
+
+    df_pairs = pair_samples(get_sample_columns(df), args.direct_pattern, args.nested_pattern)
+    if df_pairs.empty:
+        raise ValueError(f'No direct sample matching {args.direct_pattern} has a nested sample matching {args.nested_pattern} in {args.affi_table}')
+
+    logging.info(f'Comparing {len(df_pairs)} pairs of direct and nested samples')
+
+    df_summary, df_by_pair = compare_direct_and_nested(df, df_pairs, ranks, valid_only=not args.all_affiliations,
+                                                       pseudocount=args.pseudocount)
+
+    logging.info(f'Writting the comparison of {len(df_summary)} taxa in {args.output}')
+    df_summary.to_csv(args.output, sep='\t', index=False)
+
+    if args.pair_output:
+        logging.info(f'Writting the comparison of each pair in {args.pair_output}')
+        df_by_pair.to_csv(args.pair_output, sep='\t', index=False)
+
+
+if __name__ == '__main__':
+    main()
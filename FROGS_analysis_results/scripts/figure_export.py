@@ -0,0 +1,131 @@
+# Metadata
+__author__ = 'Mainguy Jean - Plateforme bioinformatique Toulouse'
+__copyright__ = 'Copyright (C) 2020 INRAE'
+__license__ = 'GNU General Public License'
+
+
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import hashlib
+import json
+import logging
+import os
+import pandas as pd
+
+
+# cache of the content hash of each written figure file, stored in the output dir
+EXPORT_CACHE_FILE = ".figure_export_cache.json"
+
+
+def get_content_hash(df, **plot_params):
+    """
+    Hash of a table feeding a figure and of the parameters used to plot it.
+
+    The hash does not depend on the index of df.
+    """
+    hasher = hashlib.sha256()
+    hasher.update(json.dumps([str(c) for c in df.columns]).encode())
+    hasher.update(pd.util.hash_pandas_object(df, index=False).to_numpy().tobytes())
+    hasher.update(json.dumps(plot_params, sort_keys=True, default=str).encode())
+
+    return hasher.hexdigest()
+
+
+def load_export_cache(cache_file):
+    if not os.path.exists(cache_file):
+        return {}
+
+    try:
+        with open(cache_file) as fl:
+            return json.load(fl)
+    except ValueError:
+        logging.warning(f'Export cache {cache_file} is not valid, all figures are written.')
+        return {}
+
+
+def save_export_cache(cache_file, cache):
+    with open(cache_file, 'w') as fl:
+        json.dump(cache, fl, indent=2, sort_keys=True)
+
+
+def write_figure(fig_dict, output_file):
+    """
+    Write a figure given as a dict (Figure.to_dict()) in the format of the output file extension.
+
+    The figure is rebuilt from its dict so that it can be written in another process.
+    """
+    import plotly.graph_objects as go
+
+    fig = go.Figure(fig_dict)
+    if output_file.endswith(".html"):
+        fig.write_html(output_file)
+    else:
+        fig.write_image(output_file)
+
+    return output_file
+
+
+class FigureExporter:
+    """
+    Write figures in several formats, one task per (figure, format).
+
+    A figure is only built and written when the content hash given with it
+    differs from the one recorded for its output file at the last run, or when
+    the output file is missing. With jobs > 1 the files are written by a pool
+    of processes.
+    """
+
+    def __init__(self, outdir, output_formats, jobs=1, force=False):
+        self.output_formats = sorted(output_formats)
+        self.jobs = jobs
+        self.force = force
+        self.cache_file = os.path.join(outdir, EXPORT_CACHE_FILE)
+        self.cache = load_export_cache(self.cache_file)
+        self.tasks = []
+
+    def is_up_to_date(self, output_file, content_hash):
+        return not self.force and os.path.exists(output_file) and self.cache.get(os.path.basename(output_file)) == content_hash
+
+    def add_figure(self, output_base_name, content_hash, build_figure):
+        """
+        Schedule the outputs of a figure that are not up to date.
+
+        build_figure is called without argument to get the plotly figure, only
+        if at least one output has to be written.
+        """
+        output_files = [f"{output_base_name}.{extension}" for extension in self.output_formats]
+        outdated_files = [output_file for output_file in output_files if not self.is_up_to_date(output_file, content_hash)]
+
+        for output_file in set(output_files) - set(outdated_files):
+            logging.info(f'{output_file} is up to date')
+
+        if not outdated_files:
+            return
+
+        fig_dict = build_figure().to_dict()
+        for output_file in outdated_files:
+            self.tasks.append((fig_dict, output_file, content_hash))
+
+    def export(self):
+        """Write all scheduled outputs and update the export cache."""
+        try:
+            if self.jobs > 1 and len(self.tasks) > 1:
+                self.export_in_pool()
+            else:
+                for fig_dict, output_file, content_hash in self.tasks:
+                    logging.info(f'Writting {output_file}')
+                    write_figure(fig_dict, output_file)
+                    self.cache[os.path.basename(output_file)] = content_hash
+        finally:
+            save_export_cache(self.cache_file, self.cache)
+            self.tasks = []
+
+    def export_in_pool(self):
+        with ProcessPoolExecutor(max_workers=self.jobs) as executor:
+            future2task = {executor.submit(write_figure, fig_dict, output_file): (output_file, content_hash)
+                           for fig_dict, output_file, content_hash in self.tasks}
+
+            for future in as_completed(future2task):
+                output_file, content_hash = future2task[future]
+                future.result()
+                logging.info(f'{output_file} written')
+                self.cache[os.path.basename(output_file)] = content_hash
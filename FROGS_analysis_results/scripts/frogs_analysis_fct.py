@@ -5,9 +5,38 @@ __license__ = 'GNU General Public License'
 
 
 import pandas as pd
+import numpy as np
 import logging
+from functools import lru_cache
 from itertools import takewhile
 
+from affiliation_cache import get_cluster_keys, get_affiliation_columns, select_affiliation_columns
+from biom_loader import load_frogs_biom
+from stage_metrics import measure_stage, iter_measured
+from table_formats import is_biom_file
+from taxonomy_tree import build_taxonomy_tree
+
+
+# dtypes of the loaded FROGS tables: identity and coverage are float32 with a
+# flag telling if the cluster had several values (multi-identity, multi-coverage tags)
+COUNT_DTYPE = "uint32"
+SCORE_DTYPE = "float32"
+MULTI_SCORE_COLUMNS = {
+    "blast_perc_identity": ("multi_identity", "multi-identity"),
+    "blast_perc_query_coverage": ("multi_coverage", "multi-coverage"),
+}
+# these flags are only used by the processing and are not written in the merged table
+MULTI_FLAG_COLUMNS = [flag_column for flag_column, _ in MULTI_SCORE_COLUMNS.values()]
+
+# taxonomy columns stored as categories once the affiliation is processed, with one column per rank
+LINEAGE_COLUMNS = ["blast_taxonomy", "blast_taxonomy_original", "taxon_affi", "rank_affi", "blast_taxonomy_cleaned"]
+
+def load_mock_taxonomies(mock_taxonomies_file):
+    
+    with open(mock_taxonomies_file) as fl:
+        return {l.rstrip().split("\t")[1]:l.split("\t")[0] for l in fl if l.rstrip()}
+
+
 def clean_mock_sp_relation(mock_sp_relation):
     if len(mock_sp_relation) == 1:
         return mock_sp_relation.pop()
@@ -18,91 +47,388 @@ def clean_mock_sp_relation(mock_sp_relation):
         return 'multiple mock species'
     
     
-def get_corresponding_species_mock(tax_and_multiaffi, mock_taxonomies):
-    taxonomy_str = tax_and_multiaffi["blast_taxonomy"]
-                
-    mutliaffiliation_str = tax_and_multiaffi["mutliaffiliation"]
-    
-    
-    sp_hits = set()
-    if taxonomy_str.endswith("Multi-affiliation"):
-        # mutliaffiliation_str = mutliaffiliation_str.replace(
-        #    alternative_fermentum_taxon, "Lactobacillus" )
-        
-        for affi in mutliaffiliation_str.split('|'):
-            
-            sp_hits |= get_corresponding_species_mock({'blast_taxonomy':affi, 'mutliaffiliation':None}, mock_taxonomies)
-          
+def build_mock_taxonomy_trie(mock_taxonomies):
+    """
+    Index the mock taxonomies in a trie of taxa, one level per rank.
 
-    else:
-        for mock_tax in mock_taxonomies:
-            if taxonomy_str.startswith(mock_tax):
+    The last taxon of a mock taxonomy is not a child node but is stored in the
+    'mock_taxonomies' list of the node of its parent rank. A taxonomy starting
+    with a mock taxonomy has then the same taxa as the mock for all ranks but the last one, and its taxon at
+    the last rank starts with the last taxon of the mock.
+    """
+    trie = {"children": {}, "mock_taxonomies": []}
+
+    for mock_tax in mock_taxonomies:
+        *parent_taxa, last_taxon = mock_tax.split(";")
+        node = trie
+        for taxon in parent_taxa:
+            node = node["children"].setdefault(taxon, {"children": {}, "mock_taxonomies": []})
+        node["mock_taxonomies"].append((last_taxon, mock_tax))
+
+    return trie
+
+
+def get_mock_taxonomies_in_trie(taxonomy_str, mock_trie):
+    """Return the set of mock taxonomies that taxonomy_str starts with, walking the trie once."""
+    sp_hits = set()
+    node = mock_trie
+    for taxon in taxonomy_str.split(";"):
+        for last_taxon, mock_tax in node["mock_taxonomies"]:
+            if taxon.startswith(last_taxon):
                 sp_hits.add(mock_tax)
-    
+
+        node = node["children"].get(taxon)
+        if node is None:
+            break
+
     return sp_hits
 
 
+def add_mock_species_to_df(df, taxonomies2mock_species):
+    """
+    Add sp_mock_taxonomy and mock_species columns to df.
+
+    Gives the same result as the per cluster implementation of
+    benchmark_post_processing.py followed by clean_mock_sp_relation, but each
+    distinct taxonomy or multi-affiliation string is resolved only once using
+    a trie of the mock taxonomies.
+    """
+    mock_trie = build_mock_taxonomy_trie(taxonomies2mock_species)
+
+    # the multi-affiliation string is only used when the taxonomy is a multi-affiliation
+    is_multiaffi = df["blast_taxonomy"].str.endswith("Multi-affiliation")
+    affiliations = df["blast_taxonomy"].astype(object).where(~is_multiaffi, df["mutliaffiliation"])
+
+    codes, distinct_affiliations = pd.factorize(affiliations, use_na_sentinel=False)
+
+    taxonomy2mock_taxonomies = {}
+    sp_mock_taxonomies = []
+    for affiliation in distinct_affiliations:
+        sp_hits = set()
+        for taxonomy in affiliation.split("|"):
+            if taxonomy not in taxonomy2mock_taxonomies:
+                taxonomy2mock_taxonomies[taxonomy] = get_mock_taxonomies_in_trie(taxonomy, mock_trie)
+            sp_hits |= taxonomy2mock_taxonomies[taxonomy]
+
+        sp_mock_taxonomies.append(clean_mock_sp_relation(sp_hits))
+
+    logging.debug(f"{len(distinct_affiliations)} distinct affiliations linked to mock species")
+
+    mock_species = [taxonomies2mock_species.get(sp_mock_tax, sp_mock_tax) for sp_mock_tax in sp_mock_taxonomies]
+
+    df["sp_mock_taxonomy"] = np.array(sp_mock_taxonomies, dtype=object)[codes]
+    df["mock_species"] = np.array(mock_species, dtype=object)[codes]
+
+
+def add_analysis_info(analysis_df, min_identity, min_coverage, region, affi_db_name, taxonomies2mock_species=None, metrics=None):
+    """
+    Add the valid_affiliation, region and db columns to analysis_df, and its mock species when taxonomies2mock_species is given.
+    """
+    analysis_df['valid_affiliation'] = analysis_df[f'id>{min_identity}_cov>{min_coverage}']
+
+    analysis_df['region'] = region
+    analysis_df['db'] = affi_db_name
+
+    if taxonomies2mock_species:
+        with measure_stage(metrics, 'mock_linking', len(analysis_df)):
+            add_mock_species_to_df(analysis_df, taxonomies2mock_species)
+
+
+def get_sample_columns(df):
+    """
+    Sample columns of a FROGS abundance table.
+
+    In the table given by biom_to_tsv.py, samples are the columns following
+    observation_sum. Columns added by process_frogs_affiliation start with mutliaffiliation.
+    """
+    columns = list(df.columns)
+    start = columns.index("observation_sum") + 1
+    end = columns.index("mutliaffiliation") if "mutliaffiliation" in columns else len(columns)
+
+    return columns[start:end]
+
+
+def get_sample_count_matrix(df, samples):
+    """
+    Count matrix of shape (clusters, samples).
+
+    Sparse sample columns, as loaded from a biom file, give a CSR matrix and
+    other columns a dense array where missing counts are 0.
+    """
+    if samples and all(isinstance(df[s].dtype, pd.SparseDtype) and df[s].dtype.fill_value == 0 for s in samples):
+        return df[samples].sparse.to_coo().tocsr()
+
+    return np.nan_to_num(df[samples].to_numpy(dtype=float))
+
+
 def consider_only_selected_samples(df, all_sample, samples_to_keep):
+    """
+    Clusters of df found in samples_to_keep, with observation_sum and abundance computed on these samples only.
+
+    df is left untouched. See sample_groups to compute them for several sample subsets at once.
+    """
+    observation_sum = df[list(samples_to_keep)].sum(axis=1)
+    is_kept = observation_sum > 0
+
+    return df.loc[is_kept].assign(observation_sum=observation_sum[is_kept],
+                                  abundance=100 * observation_sum[is_kept] / observation_sum.sum())
 
-    samples_to_remove = all_sample - samples_to_keep
 
-    # df = df.drop(columns=samples_to_remove)
-    df["observation_sum"] = df[samples_to_keep].sum(axis=1)
-    df = df.loc[df["observation_sum"] > 0]
+def process_frogs_affiliation(
+    affi_abundance_file, multiaff_file, ranks, min_ids=[99], min_covs=[40, 99], cache=None, metrics=None
+):
+    """
+    Process FROGS affiliation tables.
+
+    affi_abundance_file is either the abundance table given by biom_to_tsv.py,
+    with multiaff_file its multihit table, or directly the FROGS affiliation biom
+    file, in which case multiaff_file is not used. cache is an optional
+    AffiliationCache holding the threshold independent affiliation of clusters
+    and metrics an optional StageMetrics recording each processing stage.
+    """
+    if is_biom_file(affi_abundance_file):
+        with measure_stage(metrics, "load") as stage:
+            df, df_multiaff = load_frogs_biom(affi_abundance_file)
+            df_multiaff = df_multiaff.set_index("#observation_name", drop=False)
+            add_multi_score_flags(df)
+            stage["rows"] = len(df)
+    else:
+        with measure_stage(metrics, "load") as stage:
+            df = load_abundance_table(affi_abundance_file)
+            stage["rows"] = len(df)
+
+        with measure_stage(metrics, "load_multihit") as stage:
+            df_multiaff = load_multihit_table(multiaff_file)
+            stage["rows"] = len(df_multiaff)
+
+    with measure_stage(metrics, "best_hit_index", len(df_multiaff)):
+        best_hit_index = get_best_hit_index(df_multiaff)
+
+    df = annotate_affiliation(df, df_multiaff, best_hit_index, ranks, min_ids, min_covs, cache, metrics)
+
     df["abundance"] = 100 * df["observation_sum"] / df["observation_sum"].sum()
 
     return df
 
 
-def process_frogs_affiliation(
-    affi_abundance_file, multiaff_file, ranks, min_ids=[99], min_covs=[40, 99]
+def iter_frogs_affiliation_chunks(
+    affi_abundance_file, multiaff_file, ranks, min_ids=[99], min_covs=[40, 99], chunksize=100000, cache=None, metrics=None
 ):
+    """
+    Streaming version of process_frogs_affiliation yielding the processed table chunk by chunk.
+
+    The multihit table and its best hit index are kept in memory while the
+    abundance table is read by chunks of chunksize clusters with the dtypes of
+    get_abundance_table_schema, other columns being read as strings.
+    The abundance of the clusters needs the total number of sequences of the
+    table, which is computed beforehand by reading only the observation_sum column.
+    """
+    with measure_stage(metrics, "total_sequences"):
+        total_sequences = sum(
+            chunk["observation_sum"].sum()
+            for chunk in pd.read_csv(affi_abundance_file, sep="\t", usecols=["observation_sum"], chunksize=chunksize)
+        )
+    logging.info(f"{affi_abundance_file} holds a total of {total_sequences} sequences")
+
+    with measure_stage(metrics, "load_multihit") as stage:
+        df_multiaff = load_multihit_table(multiaff_file)
+        stage["rows"] = len(df_multiaff)
+
+    with measure_stage(metrics, "best_hit_index", len(df_multiaff)):
+        best_hit_index = get_best_hit_index(df_multiaff)
+
+    columns, dtypes = get_abundance_table_schema(affi_abundance_file, other_columns_dtype=str)
+    chunks = pd.read_csv(affi_abundance_file, sep="\t", usecols=columns, dtype=dtypes, chunksize=chunksize)
+
+    for df in iter_measured(metrics, "load", chunks):
+        add_multi_score_flags(df)
+        df = annotate_affiliation(df, df_multiaff, best_hit_index, ranks, min_ids, min_covs, cache, metrics)
+
+        df["abundance"] = 100 * df["observation_sum"] / total_sequences
+
+        yield df
+
+
+def load_multihit_table(multiaff_file):
 
-    df = pd.read_csv(affi_abundance_file, sep="\t")
     df_multiaff = pd.read_csv(multiaff_file, sep="\t")
 
-    df_multiaff = df_multiaff.set_index("#observation_name", drop=False)
+    return df_multiaff.set_index("#observation_name", drop=False)
 
-    add_multi_affi_to_df(df, df_multiaff)
 
-    improve_affi_with_multiaffi(df, df_multiaff)
+def get_abundance_table_schema(affi_abundance_file, other_columns_dtype=None, seed_sequence=False):
+    """
+    Columns to read from a FROGS abundance table and their dtypes.
 
-    # Add coverage and identity value to the cluster with a multiaffi by taking the value in multiaffi table
-    cols_impacted_by_multihit = [
-        "observation_name",
-        "blast_perc_identity",
-        "blast_perc_query_coverage",
-    ]
-    df[cols_impacted_by_multihit] = df[cols_impacted_by_multihit].apply(
-        get_best_covid_from_multihit, args=(df_multiaff,), axis=1
-    )
+    Sample counts are uint32 and observation_sum int64. Identity and coverage
+    are read as strings as they may hold the multi-identity and multi-coverage
+    tags, and are then parsed by add_multi_score_flags. Other columns get
+    other_columns_dtype, or are left to pandas when it is None. seed_sequence
+    is only read when asked, see iter_seed_sequences.
+    """
+    columns = list(pd.read_csv(affi_abundance_file, sep="\t", nrows=0).columns)
 
-    # Add rank of the affiliation
-    df["taxon_affi"] = df["blast_taxonomy"].apply(lambda x: get_taxon_affi(x, ranks))
-    df["rank_affi"] = df["blast_taxonomy"].apply(lambda x: get_rank_affi(x, ranks))
+    dtypes = {} if other_columns_dtype is None else {col: other_columns_dtype for col in columns}
+    dtypes.update({col: COUNT_DTYPE for col in get_sample_columns(pd.DataFrame(columns=columns))})
+    dtypes.update({col: str for col in MULTI_SCORE_COLUMNS})
+    dtypes["observation_sum"] = "int64"
 
-    df["blast_taxonomy_cleaned"] = df["blast_taxonomy"].apply(
-        lambda x: clean_taxonomy(x, ranks)
-    )
+    if not seed_sequence:
+        columns = [col for col in columns if col != "seed_sequence"]
+
+    return columns, {col: dtype for col, dtype in dtypes.items() if col in columns}
+
+
+def load_abundance_table(affi_abundance_file, seed_sequence=False):
+    """
+    Load a FROGS abundance table with the compact dtypes of get_abundance_table_schema.
+    """
+    columns, dtypes = get_abundance_table_schema(affi_abundance_file, seed_sequence=seed_sequence)
+
+    df = pd.read_csv(affi_abundance_file, sep="\t", usecols=columns, dtype=dtypes)
+    add_multi_score_flags(df)
+
+    return df
+
+
+def add_multi_score_flags(df):
+    """
+    Parse identity and coverage as float32 and flag the clusters with multiple values.
+
+    The multi-identity and multi-coverage tags become NaN, and multi_identity and
+    multi_coverage columns, inserted after the coverage, tell which clusters had them.
+    """
+    flag_position = df.columns.get_loc("blast_perc_query_coverage") + 1
+
+    for column, (flag_column, multi_tag) in MULTI_SCORE_COLUMNS.items():
+        if flag_column in df.columns:
+            continue
+
+        is_multi = df[column].astype(str) == multi_tag
+        df[column] = pd.to_numeric(df[column].where(~is_multi)).astype(SCORE_DTYPE)
+        df.insert(flag_position, flag_column, is_multi.to_numpy())
+        flag_position += 1
+
+
+def iter_seed_sequences(affi_abundance_file, chunksize=None):
+    """
+    Read the seed sequences of an abundance table apart from the other columns.
+
+    Yield the seed_sequence column by chunks of chunksize clusters, or at once
+    when chunksize is None, so that sequences are only loaded when written.
+    """
+    chunks = pd.read_csv(affi_abundance_file, sep="\t", usecols=["seed_sequence"], dtype=str, chunksize=chunksize)
+    if chunksize is None:
+        chunks = [chunks]
+
+    for chunk in chunks:
+        yield chunk["seed_sequence"]
+
+
+def add_seed_sequences(df, seed_sequences):
+    df.insert(df.columns.get_loc("seed_id") + 1, "seed_sequence", seed_sequences.to_numpy())
+
+
+def annotate_affiliation(df, df_multiaff, best_hit_index, ranks, min_ids, min_covs, cache=None, metrics=None):
+    """
+    Add multi-affiliation, lineage and threshold columns to an abundance table or to a chunk of it.
+
+    With a cache, only the clusters missing from it get their affiliation computed.
+    """
+    if cache is None:
+        add_affiliation_columns(df, df_multiaff, best_hit_index, ranks, metrics)
+    else:
+        add_cached_affiliation_columns(df, df_multiaff, best_hit_index, ranks, cache, metrics)
 
     # df['blast_taxonomy'] = df['blast_taxonomy'].apply(rm_strain_from_lineage)
 
-    df[ranks] = df["blast_taxonomy"].str.split(pat=";", expand=True)
+    with measure_stage(metrics, "thresholds", len(df)):
+        df = df.astype({"blast_perc_identity": SCORE_DTYPE, "blast_perc_query_coverage": SCORE_DTYPE})
+
+        add_threshold_columns(df, min_ids, min_covs)
 
-    df = df.astype({"blast_perc_identity": float, "blast_perc_query_coverage": float})
+    with measure_stage(metrics, "categorize", len(df)):
+        categorize_lineage_columns(df, ranks)
+
+    return df
+
+
+def add_threshold_columns(df, min_ids, min_covs):
+    identity = df["blast_perc_identity"]
+    coverage = df["blast_perc_query_coverage"]
 
     for min_id in min_ids:
         for min_cov in min_covs:
+            # thresholds take the dtype of the scores so that a score equal to a threshold passes it
+            is_id_valid = identity >= np.asarray(min_id, dtype=identity.dtype)
+            is_cov_valid = coverage >= np.asarray(min_cov, dtype=coverage.dtype)
 
-            df[f"coverage_>=_{min_cov}"] = df["blast_perc_query_coverage"] >= min_cov
-            df[f"identity_>=_{min_id}"] = df["blast_perc_identity"] >= min_id
-            df[f"id>{min_id}_cov>{min_cov}"] = (df["blast_perc_identity"] >= min_id) & (
-                df["blast_perc_query_coverage"] >= min_cov
-            )
+            df[f"coverage_>=_{min_cov}"] = is_cov_valid
+            df[f"identity_>=_{min_id}"] = is_id_valid
+            df[f"id>{min_id}_cov>{min_cov}"] = is_id_valid & is_cov_valid
 
-    df["abundance"] = 100 * df["observation_sum"] / df["observation_sum"].sum()
 
-    return df
+def categorize_lineage_columns(df, ranks):
+    lineage_columns = set(LINEAGE_COLUMNS) | set(ranks)
+
+    # columns are set by position as the default ranks hold Species twice
+    for i, column in enumerate(df.columns):
+        if column in lineage_columns:
+            df.isetitem(i, df.iloc[:, i].astype("category"))
+
+
+def add_affiliation_columns(df, df_multiaff, best_hit_index, ranks, metrics=None):
+    """
+    Add the threshold independent affiliation columns to df.
+    """
+    with measure_stage(metrics, "multi_affi_merge", len(df)):
+        add_multi_affi_to_df(df, df_multiaff)
+
+        improve_affi_with_multiaffi(df, df_multiaff)
+
+    # Add coverage and identity value to the cluster with a multiaffi by taking the value in multiaffi table
+    with measure_stage(metrics, "best_hit", len(df)):
+        add_best_covid_from_multihit(df, best_hit_index)
+
+    # Add rank of the affiliation, cleaned taxonomy and taxon of each rank
+    with measure_stage(metrics, "lineage", len(df)):
+        add_lineage_columns(df, ranks)
+
+
+def add_cached_affiliation_columns(df, df_multiaff, best_hit_index, ranks, cache, metrics=None):
+    """
+    Add the threshold independent affiliation columns to df, reusing the affiliations of the cache.
+
+    Clusters are looked up by a key hashing their blast columns and hits, so
+    the clusters that are new or whose affiliation changed are computed and
+    then stored in the cache.
+    """
+    affiliation_columns = get_affiliation_columns(ranks)
+
+    with measure_stage(metrics, "cache_lookup", len(df)):
+        cluster_keys = get_cluster_keys(df, df_multiaff)
+        df_cached = cache.get(cluster_keys, ranks)
+
+    is_cached = np.isin(cluster_keys, df_cached.index.to_numpy())
+    logging.info(f"{is_cached.sum()}/{len(df)} cluster affiliations found in cache")
+
+    df_affiliation = df_cached.loc[cluster_keys[is_cached]].set_axis(df.index[is_cached])
+
+    if not is_cached.all():
+        df_new = df.loc[~is_cached].copy()
+        add_affiliation_columns(df_new, df_multiaff, best_hit_index, ranks, metrics)
+
+        df_new = select_affiliation_columns(df_new, ranks).astype({"blast_perc_identity": SCORE_DTYPE, "blast_perc_query_coverage": SCORE_DTYPE})
+        with measure_stage(metrics, "cache_store", len(df_new)):
+            cache.put(cluster_keys[~is_cached], df_new, ranks)
+
+        df_affiliation = pd.concat([df_affiliation, df_new]).loc[df.index]
+
+    for i, column in enumerate(affiliation_columns):
+        if column in df.columns:
+            df.isetitem(df.columns.get_loc(column), df_affiliation.iloc[:, i])
+        else:
+            df[column] = df_affiliation.iloc[:, i]
 
 
 # def get_taxon_affi(taxonomy_str):
@@ -118,17 +444,59 @@ def process_frogs_affiliation(
 
 def get_taxon_affi(taxonomy_str, ranks):
 
-    rank, taxon = get_rank_and_taxon_affi(taxonomy_str, ranks)
+    rank, taxon, _, _ = get_lineage_info(taxonomy_str, tuple(ranks))
     return taxon
 
 
 def get_rank_affi(taxonomy_str, ranks):
-    rank, taxon = get_rank_and_taxon_affi(taxonomy_str, ranks)
+    rank, taxon, _, _ = get_lineage_info(taxonomy_str, tuple(ranks))
     return rank
 
 
+@lru_cache(maxsize=None)
+def get_lineage_info(taxonomy_str, ranks):
+    """
+    Resolve a taxonomy string in one go.
+
+    Return the rank and the taxon of the affiliation, the cleaned taxonomy and
+    the taxonomy split by rank. Results are cached on (taxonomy_str, ranks),
+    hence ranks must be given as a tuple.
+    """
+    rank, taxon = get_rank_and_taxon_affi(taxonomy_str, ranks)
+    taxonomy_cleaned = clean_taxonomy(taxonomy_str, ranks)
+
+    return rank, taxon, taxonomy_cleaned, tuple(taxonomy_str.split(";"))
+
+
+def add_lineage_columns(df, ranks):
+    """
+    Add taxon_affi, rank_affi, blast_taxonomy_cleaned and one column per rank to df.
+
+    Each distinct blast_taxonomy is parsed only once and the results are
+    broadcast back to the clusters using the codes of the factorized taxonomies.
+    """
+    codes, taxonomies = pd.factorize(df["blast_taxonomy"], use_na_sentinel=False)
+
+    lineages = [get_lineage_info(taxonomy, tuple(ranks)) for taxonomy in taxonomies]
+    logging.debug(f"{len(taxonomies)} distinct taxonomies resolved for {len(df)} clusters")
+
+    rank_affi, taxon_affi, taxonomy_cleaned, taxonomy_split = (
+        zip(*lineages) if lineages else ((), (), (), ())
+    )
+
+    df["taxon_affi"] = np.array(taxon_affi, dtype=object)[codes]
+    df["rank_affi"] = np.array(rank_affi, dtype=object)[codes]
+    df["blast_taxonomy_cleaned"] = np.array(taxonomy_cleaned, dtype=object)[codes]
+
+    # a chunk may hold no taxonomy as long as the ranks, its missing ranks are then empty as in the whole table
+    df_taxonomy_split = pd.DataFrame(list(taxonomy_split))
+    df_taxonomy_split = df_taxonomy_split.reindex(columns=range(max(len(ranks), df_taxonomy_split.shape[1]))).take(codes)
+    df_taxonomy_split.index = df.index
+    df[ranks] = df_taxonomy_split
+
+
 def get_rank_and_taxon_affi(taxonomy_str, ranks):
-    print(taxonomy_str)
+    logging.debug("%s", taxonomy_str)
     if taxonomy_str == "no data":
         return ("unknown", "unknown")
 
@@ -148,7 +516,7 @@ def get_rank_and_taxon_affi(taxonomy_str, ranks):
             break
 
     # taxo_len = len(set(taxonomy))
-    print(rank, taxon)
+    logging.debug("%s %s", rank, taxon)
     return rank, taxon  # ranks[taxo_len-1]
 
 
@@ -171,7 +539,7 @@ def clean_taxonomy(taxonomy_str, ranks):
     for i, (rank, taxon) in enumerate(zip(ranks[::-1], taxo_split[::-1])):
         if any((w in taxon for w in uninformative_taxon_words)):
             logging.debug(
-                f"Cleaning taxonomy: '{taxon}' is trimmed off because it is not informative enough from {taxonomy_str}"
+                "Cleaning taxonomy: '%s' is trimmed off because it is not informative enough from %s", taxon, taxonomy_str
             )
             continue
         else:
@@ -181,142 +549,102 @@ def clean_taxonomy(taxonomy_str, ranks):
     return clean_taxo
 
 
-def get_sp_mock_relation(tax_and_multiaffi, mock_taxonomies):
-    # print('='*50)
+def group_multihit_by_cluster(df_multihit, clusters, column="blast_taxonomy"):
+    """
+    Group a column of the multihit table by cluster in one pass.
 
-    taxonomy_str = tax_and_multiaffi["blast_taxonomy"]
-    mutliaffiliation_str = tax_and_multiaffi["mutliaffiliation"]
+    Only the hits of the given clusters are kept and the order of the
+    hits within a cluster is the one of the multihit table.
+    """
+    df_multihit = df_multihit.loc[df_multihit["#observation_name"].isin(clusters)]
 
-    alternative_fermentum_taxon = "Limosilactobacillus"
-
-    if alternative_fermentum_taxon in taxonomy_str:
-        taxonomy_str = taxonomy_str.replace(
-            alternative_fermentum_taxon, "Lactobacillus"
-        )
-
-    # taxonomy = [t for t in taxonomy_str.split(';') if t != 'Multi-affiliation']
+    # group on the column values as '#observation_name' is also the index name of the table
+    return df_multihit[column].groupby(df_multihit["#observation_name"].to_numpy(), sort=False)
 
-    if taxonomy_str.endswith("Multi-affiliation"):
-        mutliaffiliation_str = mutliaffiliation_str.replace(
-            alternative_fermentum_taxon, "Lactobacillus"
-        )
-        sp_mock = get_sp_mock_relation_in_multiaffi(
-            mutliaffiliation_str, mock_taxonomies
-        )
 
-        return sp_mock
+def add_multi_affi_to_df(df, df_multihit):
+    is_multi_subject = df["blast_subject"] == "multi-subject"
+    multi_clusters = df.loc[is_multi_subject, "observation_name"]
 
-    if taxonomy_str == "no data":
-        return "unknown"
+    multiaffi_by_cluster = group_multihit_by_cluster(df_multihit, multi_clusters).agg("|".join)
 
-    # print(taxonomy_str)
-    sp_hit = "other"
-    for mock_tax in mock_taxonomies:
-        # print('->', mock_tax)
-        if taxonomy_str.startswith(mock_tax):
-            # print(f'HITS')
-            sp_hit = mock_tax.split(";")[-1]
-            if sp_hit == "Escherichia_coli":
-                break
-        else:
-            pass
-            # print('      --> not in taxo')
+    df["mutliaffiliation"] = df["observation_name"].map(multiaffi_by_cluster).where(is_multi_subject)
 
-    return sp_hit
 
+def get_best_hit_index(df_multihit):
+    """
+    Index the best hit of each cluster of the multihit table.
 
-def get_sp_mock_relation_in_multiaffi(mutliaffiliation_str, mock_taxonomies):
+    The best hit is the one with the highest identity and then the highest coverage,
+    as in the per cluster implementation of benchmark_post_processing.py. The returned
+    table is indexed by cluster name so the best hit of a cluster is retrieved with
+    best_hit_index.loc[cluster].
+    """
+    best_hits = df_multihit.sort_values(
+        by=["blast_perc_identity", "blast_perc_query_coverage"], ascending=False, kind="mergesort"
+    )
+    best_hits = best_hits.loc[~best_hits["#observation_name"].duplicated().to_numpy()]
 
-    mutliaffiliations = mutliaffiliation_str.split("|")
-    for mock_tax in mock_taxonomies:
+    return best_hits.set_index("#observation_name")
 
-        for affi in mutliaffiliations:
-            if len(affi.split(";")) == 8:
-                affi = ";".join(affi.split(";")[:-1])  # remove strain
-            # print(affi)
-            if affi == mock_tax:
-                # print('multi affi is found in mock_tax')
-                return mock_tax.split(";")[-1]
 
-    # print('multiaffi is not in mock')
-    # [print('    ', a) for a in mutliaffiliations]
-    return "other"
+def add_best_covid_from_multihit(df, best_hit_index):
+    cols_impacted_by_multihit = ["blast_perc_identity", "blast_perc_query_coverage"]
 
+    is_multi_covid = df["multi_identity"] | df["multi_coverage"]
 
-def improve_affiliation_df(df, mock_taxonomies, ranks):
-    # df['is_in_mock'] = df['mutliaffiliation'].apply(is_multiaffi_in_mock, args=(mock_taxonomies,))
+    best_covid = df.loc[is_multi_covid, ["observation_name"]].join(
+        best_hit_index[cols_impacted_by_multihit], on="observation_name"
+    )
 
-    df["taxon_affi"] = df["blast_taxonomy"].apply(lambda x: get_taxon_affi(x, ranks))
-    df["rank_affi"] = df["blast_taxonomy"].apply(lambda x: get_rank_affi(x, ranks))
+    df.loc[is_multi_covid, cols_impacted_by_multihit] = best_covid[cols_impacted_by_multihit].astype(SCORE_DTYPE)
 
-    df["sp_mock_related"] = df[["blast_taxonomy", "mutliaffiliation"]].apply(
-        get_sp_mock_relation, args=(mock_taxonomies,), axis=1
-    )
 
-    df["species_mock"] = df["sp_mock_related"].str.replace("_", " ")
+def improve_affi_with_multiaffi(df, df_multihit):
 
+    df['blast_taxonomy_original'] = df['blast_taxonomy']
 
-def add_multi_affi_to_df(df, df_multihit):
-    for index, row in df.iterrows():
-        if row["blast_subject"] == "multi-subject":
+    is_multi_subject = df["blast_subject"] == "multi-subject"
+    if not is_multi_subject.any():
+        return
 
-            cluster = row["observation_name"]
+    multi_clusters = df.loc[is_multi_subject, "observation_name"]
 
-            multiaffi_list = list(df_multihit.loc[cluster, "blast_taxonomy"])
+    common_taxonomy_by_cluster = get_common_taxonomy_by_cluster(df_multihit, multi_clusters)
+    common_taxonomies = multi_clusters.map(common_taxonomy_by_cluster)
 
-            df.loc[index, "mutliaffiliation"] = "|".join(multiaffi_list)
+    logging.debug(f"Common taxonomy computed for {len(common_taxonomy_by_cluster)} multi-affiliated clusters")
 
+    not_seven_ranks = common_taxonomies.str.count(";") != 6
+    assert not not_seven_ranks.any(), common_taxonomies[not_seven_ranks].tolist()
 
+    df.loc[is_multi_subject, 'blast_taxonomy'] = common_taxonomies
 
+def get_common_taxonomy_by_cluster(df_multihit, clusters):
+    """
+    Consensus taxonomy of the hits of each cluster, as given by get_common_taxonomy.
 
-def get_best_covid_from_multihit(df_covid, df_multiaff):
-    cluster = df_covid["observation_name"]
-    blast_perc_identity = df_covid["blast_perc_identity"]
-    blast_perc_query_coverage = df_covid["blast_perc_query_coverage"]
+    The hit taxonomies are stored in a taxonomy tree so that strain trimming is done
+    once per distinct taxonomy and the consensus of all clusters is computed with one
+    lowest common ancestor query.
+    """
+    df_multihit = df_multihit.loc[df_multihit["#observation_name"].isin(clusters)]
 
-    if (
-        blast_perc_identity == "multi-identity"
-        or blast_perc_query_coverage == "multi-coverage"
-    ):
-        # select multiaffi of the cluster
-        filt = df_multiaff["#observation_name"] == cluster
-        cluster_multiaffi = df_multiaff.loc[filt]
+    tree, taxonomy_codes = build_taxonomy_tree(
+        df_multihit["blast_taxonomy"],
+        lambda taxonomy: manage_strain_in_taxo(taxonomy.split(";"), delete_strain_info=True),
+    )
 
-        # sort multiaffi on id and cov
-        cluster_multiaffi = cluster_multiaffi.sort_values(
-            by=["blast_perc_identity", "blast_perc_query_coverage"], ascending=False
-        )
-        # set best hit in df
-        df_covid["blast_perc_identity"] = cluster_multiaffi["blast_perc_identity"].iloc[
-            0
-        ]
-        df_covid["blast_perc_query_coverage"] = cluster_multiaffi[
-            "blast_perc_query_coverage"
-        ].iloc[0]
+    cluster_codes, multihit_clusters = pd.factorize(df_multihit["#observation_name"])
+    common_ancestors = tree.get_common_ancestors(taxonomy_codes, cluster_codes)
 
-    return df_covid
+    common_taxonomies = [tree.get_lineage(node, nb_ranks=7) for node in common_ancestors]
 
-def improve_affi_with_multiaffi(df, df_multihit):
-    
-    df['blast_taxonomy_original'] = df['blast_taxonomy']
+    return pd.Series(common_taxonomies, index=multihit_clusters, dtype=object)
 
-    for index, row in df.iterrows():
-        # print(index, row['blast_taxonomy'])
-        
 
-        if row["blast_subject"] == "multi-subject":
-            
-            cluster = row["observation_name"]
-            print('___', cluster)
-            multiaffi_list = list(df_multihit.loc[cluster, "blast_taxonomy"])
-            [print(t) for t in multiaffi_list]
-            common_taxonomy = get_common_taxonomy(multiaffi_list, delete_strain_info=True)
-            df.loc[index, 'blast_taxonomy'] = common_taxonomy
-            print("COMMON",common_taxonomy)
-            assert len(df.loc[index, 'blast_taxonomy'].split(';')) == 7, df.loc[index, 'blast_taxonomy']
-            
 def manage_strain_in_taxo(taxonomy, delete_strain_info=False):
-    logging.debug(taxonomy)
+    logging.debug("%s", taxonomy)
     assert len(taxonomy) == 7
     if taxonomy[-1].count(' ') > 1 and 'metagenome' not in taxonomy[-1]:
         logging.debug('taxonomy species look like strain')
@@ -325,12 +653,12 @@ def manage_strain_in_taxo(taxonomy, delete_strain_info=False):
             taxonomy = taxonomy[:-1] + [sp]
         else:
             taxonomy = taxonomy[:-1] + [sp, taxonomy[-1]]
-    logging.debug(taxonomy)
+    logging.debug("%s", taxonomy)
     return taxonomy
 
 def get_common_taxonomy(taxonomies, delete_strain_info=False):
     for t in taxonomies:
-        logging.debug(t)
+        logging.debug("%s", t)
         
     taxonomies_list = (manage_strain_in_taxo(t.split(";"), delete_strain_info) for t in taxonomies)
     taxonomy =  common_prefix(taxonomies_list)
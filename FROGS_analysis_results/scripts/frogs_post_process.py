@@ -0,0 +1,49 @@
+# Metadata
+__author__ = 'Mainguy Jean - Plateforme bioinformatique Toulouse'
+__copyright__ = 'Copyright (C) 2020 INRAE'
+__license__ = 'GNU General Public License'
+
+
+from argparse import ArgumentParser, RawDescriptionHelpFormatter, REMAINDER
+import importlib
+
+
+# subcommand -> (script module, description). Modules are only imported when
+# their subcommand is run and they import pandas or plotly only past the
+# parsing of their arguments, so the help and argument errors stay fast.
+COMMANDS = {
+    "merge": ("add_multiaffi_to_abd_table", "Merge the multi-affiliations to the abundance table."),
+    "plot": ("plot_taxo_ranks", "Plot the taxonomic ranks of merged tables."),
+    "mock-eval": ("mock_evaluation", "Evaluate the recovery of the mock community in each sample."),
+    "direct-vs-nested": ("direct_vs_nested", "Compare the taxa of paired direct and nested PCR samples."),
+    "batch": ("batch_post_process", "Merge and plot all datasets of a manifest in parallel."),
+}
+
+
+def parse_arguments(argv=None):
+    """Parse the subcommand, the remaining arguments being left to the subcommand."""
+    commands_help = "\n".join(f"  {command:<18}{description}" for command, (_, description) in COMMANDS.items())
+
+    parser = ArgumentParser(description="Post-processing of FROGS affiliations.",
+                            epilog=f"commands:\n{commands_help}\n\nRun %(prog)s <command> -h for the arguments of a command.",
+                            formatter_class=RawDescriptionHelpFormatter)
+
+    parser.add_argument('command', choices=list(COMMANDS), metavar='command', help='Subcommand to run, see below.')
+
+    parser.add_argument('args', nargs=REMAINDER, help='Arguments of the subcommand.')
+
+    return parser, parser.parse_args(argv)
+
+
+def main(argv=None):
+
+    parser, args = parse_arguments(argv)
+
+    module_name, _ = COMMANDS[args.command]
+    command_module = importlib.import_module(module_name)
+
+    command_module.main(args.args, prog=f"{parser.prog} {args.command}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,251 @@
+# Metadata
+__author__ = 'Mainguy Jean - Plateforme bioinformatique Toulouse'
+__copyright__ = 'Copyright (C) 2020 INRAE'
+__license__ = 'GNU General Public License'
+
+
+from argparse import ArgumentParser, ArgumentDefaultsHelpFormatter
+import logging
+import numpy as np
+import pandas as pd
+
+
+RANK_PREFIXES = ["Bacteria", "Phylum", "Class", "Order", "Family", "Genus"]
+
+
+def parse_arguments():
+    """Parse script arguments."""
+    parser = ArgumentParser(description="Generate a synthetic FROGS affiliation table (05-affiliation.tsv) and its multihit table (05-affiliation.multihit.tsv).",
+                            formatter_class=ArgumentDefaultsHelpFormatter)
+
+    parser.add_argument('-o', '--output_prefix', default='synthetic', help='The tables are written in <prefix>.tsv and <prefix>.multihit.tsv.')
+
+    parser.add_argument('-c', '--nb_clusters', default=10000, type=int, help='Number of clusters.')
+
+    parser.add_argument('-s', '--nb_samples', default=50, type=int, help='Number of samples.')
+
+    parser.add_argument('-m', '--multi_affi_rate', default=0.3, type=float, help='Fraction of clusters with a multi-affiliation.')
+
+    parser.add_argument('--nb_species', default=2000, type=int, help='Number of species of the taxonomy the clusters are affiliated to.')
+
+    parser.add_argument('--sequence_length', default=420, type=int, help='Length of the seed sequences.')
+
+    parser.add_argument('--seed', default=0, type=int, help='Seed of the random generator.')
+
+    parser.add_argument("-v", "--verbose", help="increase output verbosity",
+                        action="store_true")
+
+    args = parser.parse_args()
+    return args
+
+
+def generate_taxonomy(nb_species, rng):
+    """
+    Random 7 ranks taxonomy of nb_species species.
+
+    Return the lineage of each species as an array of shape (nb_species, 7)
+    of taxon names, and the node id of each of these taxa, two species
+    sharing a taxon having the same node id at this rank. Some species are
+    strains (more than two words), unknown species or metagenomes, as in the
+    FROGS affiliations.
+    """
+    nb_taxa_by_rank = [2]
+    for divisor in [40, 15, 6, 3, 1]:
+        nb_taxa_by_rank.append(max(nb_species // divisor, nb_taxa_by_rank[-1]))
+    nb_taxa_by_rank[-1] = min(nb_taxa_by_rank[-1], max(nb_species // 2, 1))
+
+    # parent of each taxon in the rank above, from the genera up to the phyla
+    parents = [rng.integers(0, nb_parents, nb_taxa) for nb_parents, nb_taxa in zip(nb_taxa_by_rank[:-1], nb_taxa_by_rank[1:])]
+
+    species_genus = rng.integers(0, nb_taxa_by_rank[-1], nb_species)
+
+    nodes = np.empty((nb_species, 7), dtype=np.int64)
+    nodes[:, 5] = species_genus
+    for rank_index in range(4, -1, -1):
+        nodes[:, rank_index] = parents[rank_index][nodes[:, rank_index + 1]]
+
+    taxa = np.empty((nb_species, 7), dtype=object)
+    taxa[:, 0] = np.where(nodes[:, 0] == 0, "Bacteria", "Archaea")
+    for rank_index in range(1, 6):
+        taxa[:, rank_index] = [f"{RANK_PREFIXES[rank_index]}{node}" for node in nodes[:, rank_index]]
+
+    species_kind = rng.choice(["species", "strain", "unknown", "metagenome"], size=nb_species, p=[0.8, 0.1, 0.07, 0.03])
+    taxa[:, 6] = [
+        "unknown species" if kind == "unknown"
+        else "gut metagenome" if kind == "metagenome"
+        else f"{genus} species{i}" + (f" str. {i % 97}" if kind == "strain" else "")
+        for i, (genus, kind) in enumerate(zip(taxa[:, 5], species_kind))
+    ]
+
+    # species node ids follow the names, unknown species of a genus are the same taxon
+    nodes[:, 6] = pd.factorize(pd.Series(taxa[:, 5] + ";" + taxa[:, 6]))[0]
+
+    return taxa, nodes
+
+
+def join_lineages(taxa):
+    return np.array([';'.join(lineage) for lineage in taxa], dtype=object)
+
+
+def get_consensus_depth(hit_nodes, hit_starts):
+    """Number of leading ranks shared by all the hits of each cluster."""
+    same_node = np.minimum.reduceat(hit_nodes, hit_starts, axis=0) == np.maximum.reduceat(hit_nodes, hit_starts, axis=0)
+    return np.cumprod(same_node, axis=1).sum(axis=1)
+
+
+def draw_related_species(species, nodes, depth, rng):
+    """
+    Draw for each species another species sharing its first depth ranks.
+
+    Species are grouped by their node at rank depth and one species of the
+    group of each given species is drawn.
+    """
+    group_nodes = nodes[:, depth - 1]
+    order = np.argsort(group_nodes, kind="stable")
+    sorted_nodes = group_nodes[order]
+    group_starts = np.searchsorted(sorted_nodes, group_nodes[species], side="left")
+    group_sizes = np.searchsorted(sorted_nodes, group_nodes[species], side="right") - group_starts
+
+    return order[group_starts + (rng.random(len(species)) * group_sizes).astype(np.int64)]
+
+
+def generate_frogs_chunk(first_cluster, nb_clusters, samples, taxa, nodes, lineages, multi_affi_rate, sequence_length, rng):
+    """
+    Generate nb_clusters clusters of the abundance table and their hits in the multihit table.
+    """
+    cluster_names = np.array([f"Cluster_{i}" for i in range(first_cluster + 1, first_cluster + nb_clusters + 1)], dtype=object)
+
+    species = rng.integers(0, len(taxa), nb_clusters)
+    is_multi = rng.random(nb_clusters) < multi_affi_rate
+
+    identity = np.where(rng.random(nb_clusters) < 0.6, 100.0, np.round(rng.uniform(85, 100, nb_clusters), 3))
+    coverage = np.where(rng.random(nb_clusters) < 0.9, 100.0, np.round(rng.uniform(70, 100, nb_clusters), 2))
+
+    # hits of the multi-affiliated clusters: same species, same genus or same family as the first hit
+    multi_clusters = np.flatnonzero(is_multi)
+    nb_hits = rng.integers(2, 7, len(multi_clusters))
+    hit_clusters = np.repeat(multi_clusters, nb_hits)
+    hit_starts = np.r_[0, np.cumsum(nb_hits)[:-1]]
+    is_first_hit = np.zeros(len(hit_clusters), dtype=bool)
+    is_first_hit[hit_starts] = True
+
+    shared_depth = np.repeat(rng.choice([7, 6, 5], size=len(multi_clusters), p=[0.4, 0.4, 0.2]), nb_hits)
+    hit_species = species[hit_clusters]
+    for depth in [6, 5]:
+        drawn = ~is_first_hit & (shared_depth == depth)
+        hit_species[drawn] = draw_related_species(hit_species[drawn], nodes, depth, rng)
+
+    same_covid = np.repeat(rng.random(len(multi_clusters)) < 0.5, nb_hits)
+    hit_identity = np.where(same_covid | is_first_hit, identity[hit_clusters],
+                            np.maximum(identity[hit_clusters] - np.round(rng.uniform(0, 3, len(hit_clusters)), 3), 80))
+    hit_coverage = np.where(same_covid | is_first_hit, coverage[hit_clusters],
+                            np.maximum(coverage[hit_clusters] - np.round(rng.uniform(0, 5, len(hit_clusters)), 2), 50))
+
+    blast_taxonomy = lineages[species].copy()
+    blast_subject = np.array([f"SUBJ{s}" for s in species], dtype=object)
+    blast_identity = identity.astype(object)
+    blast_coverage = coverage.astype(object)
+
+    if len(multi_clusters):
+        # FROGS gives the common part of the hit lineages followed by Multi-affiliation
+        consensus_depth = get_consensus_depth(nodes[hit_species], hit_starts)
+        first_taxa = taxa[hit_species[hit_starts]]
+        blast_taxonomy[multi_clusters] = [';'.join(list(lineage[:depth]) + ["Multi-affiliation"] * (7 - depth))
+                                          for lineage, depth in zip(first_taxa, consensus_depth)]
+        blast_subject[multi_clusters] = "multi-subject"
+
+        varying_identity = np.minimum.reduceat(hit_identity, hit_starts) != np.maximum.reduceat(hit_identity, hit_starts)
+        varying_coverage = np.minimum.reduceat(hit_coverage, hit_starts) != np.maximum.reduceat(hit_coverage, hit_starts)
+        blast_identity[multi_clusters[varying_identity]] = "multi-identity"
+        blast_coverage[multi_clusters[varying_coverage]] = "multi-coverage"
+
+    # counts: abundant clusters are found in more samples
+    cluster_weights = rng.lognormal(mean=2, sigma=2, size=nb_clusters)
+    prevalence = np.clip(rng.beta(0.5, 2, nb_clusters) + np.log1p(cluster_weights) / 20, 0, 1)
+    presence = rng.random((nb_clusters, len(samples))) < prevalence[:, None]
+    counts = rng.poisson(cluster_weights[:, None] * presence).astype(np.int64)
+    counts[np.arange(nb_clusters), rng.integers(0, len(samples), nb_clusters)] += 1
+
+    sequences = np.frombuffer(b"ACGT", dtype="S1")[rng.integers(0, 4, (nb_clusters, sequence_length))]
+
+    df = pd.DataFrame({
+        "rdp_tax_and_bootstrap": [';'.join(f"{taxon};(1.0)" for taxon in lineage.split(';')) + ';' for lineage in lineages[species]],
+        "blast_taxonomy": blast_taxonomy,
+        "blast_subject": blast_subject,
+        "blast_perc_identity": blast_identity,
+        "blast_perc_query_coverage": blast_coverage,
+        "blast_evalue": 0.0,
+        "blast_aln_length": sequence_length,
+        "seed_id": [f"SEQ{i}" for i in range(first_cluster, first_cluster + nb_clusters)],
+        "seed_sequence": sequences.view(f"S{sequence_length}").ravel().astype(str),
+        "observation_name": cluster_names,
+        "observation_sum": counts.sum(axis=1),
+    })
+    df = pd.concat([df, pd.DataFrame(counts, columns=samples)], axis=1)
+
+    df_multihit = pd.DataFrame({
+        "#observation_name": cluster_names[hit_clusters],
+        "blast_taxonomy": lineages[hit_species],
+        "blast_subject": [f"SUBJ{s}.{i}" for i, s in enumerate(hit_species, start=first_cluster)],
+        "blast_perc_identity": hit_identity,
+        "blast_perc_query_coverage": hit_coverage,
+        "blast_evalue": 0.0,
+        "blast_aln_length": sequence_length,
+    })
+
+    return df, df_multihit
+
+
+def write_synthetic_frogs_tables(output_prefix, nb_clusters, nb_samples, multi_affi_rate=0.3,
+                                 nb_species=2000, sequence_length=420, seed=0):
+    """
+    Write a synthetic FROGS abundance table and its multihit table.
+
+    Tables are generated and written by chunks of clusters so that large
+    tables do not need to fit in memory. Return the paths of the two tables.
+    """
+    rng = np.random.default_rng(seed)
+
+    taxa, nodes = generate_taxonomy(nb_species, rng)
+    lineages = join_lineages(taxa)
+
+    samples = [f"sample_{i}" for i in range(1, nb_samples + 1)]
+
+    abundance_table = f"{output_prefix}.tsv"
+    multihit_table = f"{output_prefix}.multihit.tsv"
+
+    # chunks of about 5 millions counts
+    chunksize = max(1, min(100000, 5000000 // nb_samples))
+
+    for first_cluster in range(0, nb_clusters, chunksize):
+        chunk_nb_clusters = min(chunksize, nb_clusters - first_cluster)
+        df, df_multihit = generate_frogs_chunk(first_cluster, chunk_nb_clusters, samples, taxa, nodes, lineages,
+                                               multi_affi_rate, sequence_length, rng)
+
+        is_first_chunk = first_cluster == 0
+        df.to_csv(abundance_table, sep='\t', index=False, mode='w' if is_first_chunk else 'a', header=is_first_chunk)
+        df_multihit.to_csv(multihit_table, sep='\t', index=False, mode='w' if is_first_chunk else 'a', header=is_first_chunk)
+
+        logging.info(f'{first_cluster + chunk_nb_clusters}/{nb_clusters} clusters written')
+
+    return abundance_table, multihit_table
+
+
+def main():
+
+    args = parse_arguments()
+
+    if args.verbose:
+        logging.basicConfig(format="%(levelname)s: %(message)s", level=logging.INFO)
+    else:
+        logging.basicConfig(format="%(levelname)s: %(message)s")
+
+    abundance_table, multihit_table = write_synthetic_frogs_tables(
+        args.output_prefix, args.nb_clusters, args.nb_samples, args.multi_affi_rate,
+        args.nb_species, args.sequence_length, args.seed)
+
+    logging.info(f'Synthetic tables written in {abundance_table} and {multihit_table}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,212 @@
+# Metadata
+__author__ = 'Mainguy Jean - Plateforme bioinformatique Toulouse'
+__copyright__ = 'Copyright (C) 2020 INRAE'
+__license__ = 'GNU General Public License'
+
+
+from argparse import ArgumentParser, ArgumentDefaultsHelpFormatter
+import logging
+
+import numpy as np
+import pandas as pd
+from scipy import sparse
+
+from frogs_analysis_fct import get_sample_columns, get_sample_count_matrix, load_mock_taxonomies
+from table_io import read_affi_table
+
+
+# mock_species of the clusters linked to no mock species or to several of them, see clean_mock_sp_relation
+OTHER_MOCK_SPECIES = "Other"
+MULTIPLE_MOCK_SPECIES = "multiple mock species"
+
+# column of an expected composition table used for the samples without their own column
+DEFAULT_COMPOSITION_COLUMN = "expected"
+
+
+def parse_arguments(argv=None, prog=None):
+    """Parse script arguments, argv being sys.argv[1:] by default."""
+    parser = ArgumentParser(prog=prog, description="Evaluate the recovery of the mock community in each sample of a merged table.",
+                            formatter_class=ArgumentDefaultsHelpFormatter)
+
+    parser.add_argument('--affi_table', required=True,
+                        help='Output of add_multiaffi_to_abd_table.py run with --mock_taxonomies, in TSV, Parquet or Feather format.')
+
+    parser.add_argument('--mock_taxonomies', required=True, help='Mock species names and taxonomies, as given to add_multiaffi_to_abd_table.py.')
+
+    parser.add_argument('--expected_composition', default=None,
+                        help='TSV of the expected relative abundances of the mock species, with the species names in the first column '
+                        f'and one column per sample. A column named {DEFAULT_COMPOSITION_COLUMN} is used for the samples without their own column. '
+                        'By default all mock species are expected with the same abundance.')
+
+    parser.add_argument('--min_abundance', default=0, type=float, help='Relative abundance (in %%) above which a taxon is detected in a sample.')
+
+    parser.add_argument('-o', '--output', default='mock_metrics.tsv', help='Metrics table with one row per sample.')
+
+    parser.add_argument('--composition_output', default=None, help='Expected and observed composition of each sample, one row per sample and mock species.')
+
+    parser.add_argument("-v", "--verbose", help="increase output verbosity",
+                        action="store_true")
+
+    args = parser.parse_args(argv)
+    return args
+
+
+def get_mock_count_table(df, samples):
+    """
+    Counts of the mock species and of the other taxa of df in each sample.
+
+    Clusters are grouped by their mock_species, and the clusters linked to no
+    mock species by their blast_taxonomy. All groups are summed with one
+    product of a (groups, clusters) indicator with the count matrix. Return a
+    DataFrame of shape (groups, samples) indexed by (status, taxon), status
+    being mock, other or multiple. Tables of several chunks can be added.
+    """
+    mock_species = df["mock_species"].astype(object).to_numpy()
+    is_other = mock_species == OTHER_MOCK_SPECIES
+    is_multiple = mock_species == MULTIPLE_MOCK_SPECIES
+
+    status = np.where(is_other, "other", np.where(is_multiple, "multiple", "mock"))
+    taxa = np.where(is_other, df["blast_taxonomy"].astype(object).to_numpy(), mock_species)
+
+    group_codes, groups = pd.MultiIndex.from_arrays([status, taxa]).factorize()
+    groups = groups.set_names(["status", "taxon"])
+    indicator = sparse.csr_matrix((np.ones(len(df)), (group_codes, np.arange(len(df)))), shape=(len(groups), len(df)))
+
+    group_counts = indicator @ get_sample_count_matrix(df, samples)
+    if sparse.issparse(group_counts):
+        group_counts = group_counts.toarray()
+
+    return pd.DataFrame(np.asarray(group_counts), index=groups, columns=samples)
+
+
+def add_count_tables(df_counts, df_chunk_counts):
+    if df_counts is None:
+        return df_chunk_counts
+    return df_counts.add(df_chunk_counts, fill_value=0)
+
+
+def load_expected_composition(expected_composition_file, mock_species, samples):
+    """
+    Expected proportions of the mock species, of shape (mock species, samples), each column summing to 1.
+
+    Without file, all mock species are expected with the same abundance.
+    """
+    if expected_composition_file is None:
+        return pd.DataFrame(1 / len(mock_species), index=mock_species, columns=samples)
+
+    df_expected = pd.read_csv(expected_composition_file, sep='\t', index_col=0)
+
+    unknown_species = set(df_expected.index) - set(mock_species)
+    if unknown_species:
+        raise ValueError(f'Species of {expected_composition_file} are not mock species: {unknown_species}')
+
+    missing_samples = [s for s in samples if s not in df_expected.columns]
+    if missing_samples and DEFAULT_COMPOSITION_COLUMN not in df_expected.columns:
+        raise ValueError(f'{expected_composition_file} has no column for the samples {missing_samples} '
+                         f'and no {DEFAULT_COMPOSITION_COLUMN} column.')
+
+    columns = [s if s in df_expected.columns else DEFAULT_COMPOSITION_COLUMN for s in samples]
+    df_expected = df_expected.reindex(index=mock_species, columns=columns).fillna(0).set_axis(samples, axis=1)
+
+    return df_expected / df_expected.sum(axis=0)
+
+
+def get_mock_metrics(df_counts, mock_species, df_expected, min_abundance=0):
+    """
+    Recovery metrics of the mock community for every sample at once.
+
+    A taxon is detected in a sample when its relative abundance is above
+    min_abundance (in %). recall is the fraction of the mock species detected
+    and precision the fraction of the detected taxa that are mock species.
+    Abundances of the mock species, of the other taxa and of the clusters
+    linked to several mock species are relative to all the reads of the
+    sample. bray_curtis compares the observed proportions of the mock species
+    with their expected ones (0 for identical compositions).
+
+    Return the per sample metrics table and the long composition table.
+    """
+    samples = list(df_counts.columns)
+    status = df_counts.index.get_level_values("status")
+
+    mock_counts = df_counts.loc[status == "mock"].droplevel("status").reindex(mock_species, fill_value=0).to_numpy(dtype=float)
+    other_counts = df_counts.loc[status == "other"].to_numpy(dtype=float)
+    multiple_counts = df_counts.loc[status == "multiple"].to_numpy(dtype=float)
+
+    totals = df_counts.to_numpy(dtype=float).sum(axis=0)
+    safe_totals = np.where(totals > 0, totals, 1)
+
+    mock_detected = (100 * mock_counts / safe_totals > min_abundance) & (mock_counts > 0)
+    other_detected = (100 * other_counts / safe_totals > min_abundance) & (other_counts > 0)
+
+    nb_mock_detected = mock_detected.sum(axis=0)
+    nb_detected = nb_mock_detected + other_detected.sum(axis=0)
+
+    mock_sums = mock_counts.sum(axis=0)
+    observed = np.divide(mock_counts, mock_sums, out=np.zeros_like(mock_counts), where=mock_sums > 0)
+    expected = df_expected.loc[mock_species, samples].to_numpy(dtype=float)
+
+    df_metrics = pd.DataFrame({
+        "sample": samples,
+        "total_reads": totals,
+        "mock_species_expected": len(mock_species),
+        "mock_species_detected": nb_mock_detected,
+        "other_taxa_detected": other_detected.sum(axis=0),
+        "recall": nb_mock_detected / max(len(mock_species), 1),
+        "precision": np.divide(nb_mock_detected, nb_detected, out=np.full(len(samples), np.nan), where=nb_detected > 0),
+        "mock_abundance": 100 * mock_sums / safe_totals,
+        "other_abundance": 100 * other_counts.sum(axis=0) / safe_totals,
+        "multiple_mock_species_abundance": 100 * multiple_counts.sum(axis=0) / safe_totals,
+        "bray_curtis": np.where(mock_sums > 0, 0.5 * np.abs(observed - expected).sum(axis=0), np.nan),
+    })
+
+    df_composition = pd.DataFrame({
+        "sample": np.repeat(samples, len(mock_species)),
+        "mock_species": np.tile(mock_species, len(samples)),
+        "count": mock_counts.T.ravel(),
+        "expected_proportion": expected.T.ravel(),
+        "observed_proportion": observed.T.ravel(),
+    })
+
+    return df_metrics, df_composition
+
+
+def write_mock_metrics(df_counts, mock_species, output, composition_output=None,
+                       expected_composition_file=None, min_abundance=0):
+    """Compute the mock metrics of a count table given by get_mock_count_table and write them."""
+    df_expected = load_expected_composition(expected_composition_file, mock_species, list(df_counts.columns))
+    df_metrics, df_composition = get_mock_metrics(df_counts, mock_species, df_expected, min_abundance)
+
+    logging.info(f'Writting mock metrics of {len(df_metrics)} samples in {output}')
+    df_metrics.to_csv(output, sep='\t', index=False)
+
+    if composition_output:
+        logging.info(f'Writting expected and observed mock compositions in {composition_output}')
+        df_composition.to_csv(composition_output, sep='\t', index=False)
+
+    return df_metrics
+
+
+def main(argv=None, prog=None):
+
+    args = parse_arguments(argv, prog)
+
+    if args.verbose:
+        logging.basicConfig(format="%(levelname)s: %(message)s", level=logging.INFO)
+        logging.info('Mode verbose ON')
+    else:
+        logging.basicConfig(format="%(levelname)s: %(message)s")
+
+    mock_species = list(dict.fromkeys(load_mock_taxonomies(args.mock_taxonomies).values()))
+
+    df = read_affi_table(args.affi_table)
+    if "mock_species" not in df.columns:
+        raise ValueError(f'{args.affi_table} has no mock_species column, run add_multiaffi_to_abd_table.py with --mock_taxonomies.')
+
+    df_counts = get_mock_count_table(df, get_sample_columns(df))
+
+    write_mock_metrics(df_counts, mock_species, args.output, args.composition_output,
+                       args.expected_composition, args.min_abundance)
+
+
+if __name__ == '__main__':
+    main()
@@ -7,19 +7,27 @@ __license__ = 'GNU General Public License'
 
 from argparse import ArgumentParser, ArgumentDefaultsHelpFormatter
 import logging
-import pandas as pd
-import plotly.express as px
 import os
 import re
 
+# plotly and pandas are imported when plotting, not for the help or argument errors
+from stage_metrics import StageMetrics, measure_stage
+from table_formats import is_biom_file
 
-def parse_arguments():
-    """Parse script arguments."""
-    parser = ArgumentParser(description="...",
+
+# columns of the merged tables used for the plots, in addition to the sample columns
+AFFI_TABLE_COLUMNS = ['rank_affi', 'valid_affiliation', 'region', 'db',
+                      'observation_name', 'observation_sum', 'abundance']
+
+
+def parse_arguments(argv=None, prog=None):
+    """Parse script arguments, argv being sys.argv[1:] by default."""
+    parser = ArgumentParser(prog=prog, description="...",
                             formatter_class=ArgumentDefaultsHelpFormatter)
 
     parser.add_argument('--affi_tables', nargs="+", required=True, 
-                        help='Affiliation abundance table with multiaffi debug of the 16S23S db affiliation, output of the script add_multiaffi_to_abd_table.py ')
+                        help='Affiliation abundance table with multiaffi debug of the 16S23S db affiliation, output of the script add_multiaffi_to_abd_table.py, in TSV, Parquet or Feather format. '
+                        'FROGS affiliation biom files (.biom) can also be given, they are then processed with the --min_identity, --min_coverage, --taxonomic_ranks, --region and --affi_db_name arguments.')
     parser.add_argument('--labels', nargs="+", required=False, 
                         help='Name associated to table. order maters. Name of the table is used by default.')
 
@@ -32,21 +40,38 @@ def parse_arguments():
     parser.add_argument('-f', '--outformat', nargs="+", default={'html', 'svg'}, type=str, choices=['png', 'jpg', 'jpeg', "webp", 'svg', "pdf", "html"],
                         help='Format of the output plots.')
 
+    parser.add_argument('--min_identity',  default=98, type=float, help='Identity threshold to consider an affilition as weak. Only used for biom tables.')
+
+    parser.add_argument('--min_coverage', default=99, type=float, help='Coverage threshold to consider an affilition as weak. Only used for biom tables.')
+
+    parser.add_argument('--taxonomic_ranks', default='Domain Phylum Class Order Family Genus Species', help='Taxonomic ranks of the affiliation. Only used for biom tables.')
+
+    parser.add_argument('--region', default='unknown', help='Name of the region analysed (ie 16S, 23S or 16Sv3v4). Only used for biom tables.')
+
+    parser.add_argument('--affi_db_name', default='unknown', help='Name of the taxonomic affiliation database. Only used for biom tables.')
+
+    parser.add_argument('-j', '--jobs', default=1, type=int, help='Number of processes used to write the plots, one plot file per process.')
+
+    parser.add_argument('--force', action="store_true", help='Write all plots, even the ones whose data have not changed since the last run in the output dir.')
+
+    parser.add_argument('--profile', action="store_true", help='Print the wall time, rows processed, rows/s and peak RSS of each stage.')
+
+    parser.add_argument('--metrics_json', '--metrics-json', dest='metrics_json', default=None,
+                        help='Write the wall time, rows processed, rows/s and peak RSS of each stage in this JSON file.')
+
     parser.add_argument("-v", "--verbose", help="increase output verbosity",
                         action="store_true")
 
     parser.add_argument("--debug", help="increase a lot output verbosity",
                         action="store_true")
 
-    args = parser.parse_args()
+    args = parser.parse_args(argv)
     return args
 
 
+def main(argv=None, prog=None):
 
-
-def main():
-
-    args = parse_arguments()
+    args = parse_arguments(argv, prog)
 
     if args.debug:
         logging.basicConfig(format="%(levelname)s: %(message)s", level=logging.DEBUG)
@@ -58,6 +83,55 @@ def main():
     else:
         logging.basicConfig(format="%(levelname)s: %(message)s")
 
+    samples = parse_sample_names(args.samples)
+
+    metrics = StageMetrics('plot_taxo_ranks') if args.profile or args.metrics_json else None
+
+    plot_taxo_ranks(args.affi_tables, args.labels, samples, args.outdir, set(args.outformat),
+                    min_identity=args.min_identity, min_coverage=args.min_coverage,
+                    taxonomic_ranks=args.taxonomic_ranks.split(' '), region=args.region, affi_db_name=args.affi_db_name,
+                    jobs=args.jobs, force=args.force, metrics=metrics)
+
+    if args.profile:
+        print(metrics.format_table())
+
+    if args.metrics_json:
+        metrics.write_json(args.metrics_json)
+
+
+def parse_sample_names(sample_args):
+    """
+    Sample names given on the command line, where 1:32 stands for the samples 1 to 32 included.
+    """
+    samples = []
+    for s in sample_args:
+        if re.match("^\d+\:\d+$", s):
+            start, end = s.split(':')
+            samples_range = [str(i) for i in range(int(start), int(end)+1)]
+            samples += samples_range
+            logging.info(f'from {s} to {samples_range}')
+        else:
+            samples.append(s)
+
+    return samples
+
+
+def plot_taxo_ranks(affi_tables, labels, samples, outdir, output_formats,
+                    min_identity=98, min_coverage=99, taxonomic_ranks=['Domain', 'Phylum', 'Class', 'Order', 'Family', 'Genus', 'Species'],
+                    region='unknown', affi_db_name='unknown', jobs=1, force=False, metrics=None):
+    """
+    Plot the taxonomic ranks of the affiliations of the tables and write the rank table per sample in outdir.
+
+    min_identity, min_coverage, taxonomic_ranks, region and affi_db_name are only used for biom tables.
+    metrics is an optional StageMetrics recording the load, aggregate and render stages.
+    """
+    import pandas as pd
+    import plotly.express as px
+
+    from figure_export import FigureExporter, get_content_hash
+    from frogs_analysis_fct import process_frogs_affiliation, add_analysis_info
+    from sample_groups import get_rank_abundance_by_sample
+    from table_io import read_affi_table
 
     # rank2color = {'superkingdom': 'rgb(95, 70, 144)',
     #                 "Domain":'rgb(95, 70, 144)',
@@ -113,20 +187,7 @@ def main():
 # color  8-alt  9EFF37 158 255  55 french lime, lime, green yellow, green lizard, luminous vivid spring bud, spring frost, vivid spring bud, bright yellow green, spring bud, acid green
 
 
-    affi_tables =  args.affi_tables
-    labels =  args.labels 
-    output_formats = set(args.outformat)
-    outdir = args.outdir
-
-    samples = []
-    for s in args.samples:
-        if re.match("^\d+\:\d+$", s):
-            start, end = s.split(':')
-            samples_range = [str(i) for i in range(int(start), int(end)+1)]
-            samples += samples_range
-            logging.info(f'from {s} to {samples_range}')
-        else:
-            samples.append(s)
+    exporter = FigureExporter(outdir, output_formats, jobs=jobs, force=force)
 
     logging.info(f'Going to plot {len(samples)} samples : {samples}')    
 
@@ -139,132 +200,113 @@ def main():
     df_list = []
     for table, name in zip(affi_tables, labels):
         logging.info(f'Processing {table} labeled {name}')
-        df = pd.read_csv(table, sep='\t')
+        if is_biom_file(table):
+            df = process_frogs_affiliation(table, None, taxonomic_ranks,
+                                           min_ids=[min_identity], min_covs=[min_coverage], metrics=metrics)
+            add_analysis_info(df, min_identity, min_coverage, region, affi_db_name)
+        else:
+            with measure_stage(metrics, 'load') as stage:
+                df = read_affi_table(table, columns=AFFI_TABLE_COLUMNS + samples)
+                stage['rows'] = len(df)
         df['name'] = name
         df_list.append(df)
 
-    df = pd.concat(df_list)
+    with measure_stage(metrics, 'aggregate') as stage:
+        df = pd.concat(df_list)
+        stage['rows'] = len(df)
     
 
-    # give a 'weak affiliation' label to the cluster that are have not a valid affi
-    filt = df['valid_affiliation']
-    df.loc[:, 'Taxonomic rank'] = df['rank_affi']
-    df.loc[~filt, 'Taxonomic rank'] = f"weak affiliation"
+        # give a 'weak affiliation' label to the cluster that are have not a valid affi
+        filt = df['valid_affiliation']
+        df.loc[:, 'Taxonomic rank'] = df['rank_affi'].astype(object)
+        df.loc[~filt, 'Taxonomic rank'] = f"weak affiliation"
 
 
 
-    ### PLOT ALL SAMPLES IN ONE BAR
-    # Group by rank 
+        ### PLOT ALL SAMPLES IN ONE BAR
+        # Group by rank 
 
-    df_rank = df.groupby(['Taxonomic rank', "region", "db", "name"
-                        ]).agg({"observation_sum":"sum", 'abundance':"sum",
-                                                    "observation_name":"count", }).reset_index()
+        df_rank = df.groupby(['Taxonomic rank', "region", "db", "name"
+                            ], observed=True).agg({"observation_sum":"sum", 'abundance':"sum",
+                                                        "observation_name":"count", }).reset_index()
 
                                         
-    df_rank['abundance_all_sample_round']  = df_rank['abundance'].round(2).astype(str) +"%"
-    df_rank['abundance_all_sample_round'] = df_rank['abundance_all_sample_round'] + '<br>' + df_rank['observation_name'].astype(str) + ' clusters'
-
-    fig = px.bar(df_rank, x="name", y="abundance", color="Taxonomic rank", # facet_col="name",
-                 template="seaborn",
-                text="abundance_all_sample_round",
-                category_orders={"rank_affi":ranks, "name":labels, #"region":regions_analysed,
-                                'Taxonomic rank':ranks + ["ident or cov < 99%"] }, color_discrete_map=rank2color, )
-    
-    fig.update_layout( # customize font and legend orientation & position
-        legend={'traceorder':'reversed'}
-    )
-    
-    #fig.update_layout(
-    #    width=700,
-    #    height=600,)
+        df_rank['abundance_all_sample_round']  = df_rank['abundance'].round(2).astype(str) +"%"
+        df_rank['abundance_all_sample_round'] = df_rank['abundance_all_sample_round'] + '<br>' + df_rank['observation_name'].astype(str) + ' clusters'
+
+    def plot_rank_per_target():
+        fig = px.bar(df_rank, x="name", y="abundance", color="Taxonomic rank", # facet_col="name",
+                    template="seaborn",
+                    text="abundance_all_sample_round",
+                    category_orders={"rank_affi":ranks, "name":labels, #"region":regions_analysed,
+                                    'Taxonomic rank':ranks + ["ident or cov < 99%"] }, color_discrete_map=rank2color, )
+        
+        fig.update_layout( # customize font and legend orientation & position
+            legend={'traceorder':'reversed'}
+        )
+        
+        #fig.update_layout(
+        #    width=700,
+        #    height=600,)
+        return fig
 
-    output_base_name = os.path.join(outdir, "taxonomic_ranks_per_target")
+    with measure_stage(metrics, 'render', len(df_rank)):
+        output_base_name = os.path.join(outdir, "taxonomic_ranks_per_target")
+        content_hash = get_content_hash(df_rank, plot="rank_per_target", labels=labels, ranks=ranks, colors=rank2color)
 
-    for extension in output_formats:
-        logging.info(f'Writting {output_base_name}.{extension}')
-        if extension == "html":
-            fig.write_html(f"{output_base_name}.{extension}")
-        else:
-            fig.write_image(f"{output_base_name}.{extension}")
-        
+        exporter.add_figure(output_base_name, content_hash, plot_rank_per_target)
 
     ### PLOT ALL SAMPLES WITH ONE BAR PER SAMPLE
         
 
-    df_rank_by_sample_list =[]
-    for label in labels:
-        filt_name = df['name'] == label
-        
-
+    with measure_stage(metrics, 'aggregate', len(df)):
+        samples_found = []
         for sample in samples:
-
             if str(sample) not in df.columns:
-                logging.warning(f'sample {sample} is not found in the table.')
+                logging.warning(f'sample {sample} is not found in the tables.')
                 continue
+            samples_found.append(str(sample))
 
-            df.loc[filt_name, 'abundance'] = 100 * df.loc[filt_name, f'{sample}']/df.loc[filt_name, f'{sample}'].sum()
-
-
-            df.loc[filt_name, f'sample_sum'] = df.loc[filt_name, f'{sample}']
-
-            df_rank_by_sample = df.loc[filt_name].groupby(['Taxonomic rank', "region", 'name']).agg({f"sample_sum":"sum", 
-                                                    f'abundance':"sum",
-                                                    "observation_name":"count",}).reset_index()
-            df_rank_by_sample['sample'] = str(sample)
-            df_rank_by_sample_list.append(df_rank_by_sample)
-            
-        
-    df_rank = pd.concat(df_rank_by_sample_list)
+        # all tables at once, the abundances being relative to the sequences of each table
+        df_rank = get_rank_abundance_by_sample(df, samples_found)
+        label_order = {label: i for i, label in enumerate(labels)}
+        df_rank = df_rank.sort_values('name', key=lambda names: names.map(label_order), kind='stable')
     
-    # Output tsv
-    table_output_name = os.path.join(outdir, "taxonomic_ranks_per_target_and_per_sample.tsv")
+        # Output tsv
+        table_output_name = os.path.join(outdir, "taxonomic_ranks_per_target_and_per_sample.tsv")
 
-    logging.info(f'Writting ranks table in {table_output_name}')
+        logging.info(f'Writting ranks table in {table_output_name}')
     
-    df_rank.to_csv(table_output_name,  sep='\t', index=False)#, columns=[])
+        df_rank.to_csv(table_output_name,  sep='\t', index=False)#, columns=[])
 
 
-    df_rank["n"] = df_rank["name"]
+        df_rank["n"] = df_rank["name"]
 
-    fig = px.bar(df_rank, x="sample", y="abundance", color="Taxonomic rank", facet_row="n",
-             category_orders={"rank_affi":ranks, "n":labels,  # "dataset":dataset_analysed, "region":regions_analysed,
-                              'Taxonomic rank':ranks + ["ident or cov < 99%"] },
-                              template="seaborn",
-             color_discrete_map=rank2color, )
-    
-    fig.update_layout( # customize font and legend orientation & position
-        legend={'traceorder':'reversed'}
-    )
+    def plot_rank_per_sample(y):
+        fig = px.bar(df_rank, x="sample", y=y, color="Taxonomic rank", facet_row="n",
+                category_orders={"rank_affi":ranks, "n":labels,  # "dataset":dataset_analysed, "region":regions_analysed,
+                                'Taxonomic rank':ranks + ["ident or cov < 99%"] },
+                                template="seaborn",
+                color_discrete_map=rank2color, )
+        
+        fig.update_layout( # customize font and legend orientation & position
+            legend={'traceorder':'reversed'}
+        )
+        return fig
 
-    output_base_name = os.path.join(outdir, "taxonomic_ranks_per_target_and_per_sample")
+    with measure_stage(metrics, 'render', len(df_rank)):
+        output_base_name = os.path.join(outdir, "taxonomic_ranks_per_target_and_per_sample")
+        content_hash = get_content_hash(df_rank, plot="rank_per_sample", y="abundance", labels=labels, ranks=ranks, colors=rank2color)
 
-    for extension in output_formats:
-        logging.info(f'Writting {output_base_name}.{extension}')
-        if extension == "html":
-            fig.write_html(f"{output_base_name}.{extension}")
-        else:
-            fig.write_image(f"{output_base_name}.{extension}")
+        exporter.add_figure(output_base_name, content_hash, lambda: plot_rank_per_sample("abundance"))
 
+        # Raw 
+        output_base_name = os.path.join(outdir, "taxonomic_ranks_per_target_and_per_sample_raw_count")
+        content_hash = get_content_hash(df_rank, plot="rank_per_sample", y="sample_sum", labels=labels, ranks=ranks, colors=rank2color)
 
-    # Raw 
-    fig = px.bar(df_rank, x="sample", y="sample_sum", color="Taxonomic rank", facet_row="n",
-            category_orders={"rank_affi":ranks, "n":labels,  # "dataset":dataset_analysed, "region":regions_analysed,
-                            'Taxonomic rank':ranks + ["ident or cov < 99%"] },
-                            template="seaborn",
-            color_discrete_map=rank2color, )
-    
-    fig.update_layout( # customize font and legend orientation & position
-        legend={'traceorder':'reversed'}
-    )
-
-    output_base_name = os.path.join(outdir, "taxonomic_ranks_per_target_and_per_sample_raw_count")
+        exporter.add_figure(output_base_name, content_hash, lambda: plot_rank_per_sample("sample_sum"))
 
-    for extension in output_formats:
-        logging.info(f'Writting {output_base_name}.{extension}')
-        if extension == "html":
-            fig.write_html(f"{output_base_name}.{extension}")
-        else:
-            fig.write_image(f"{output_base_name}.{extension}")
+        exporter.export()
 
 
 
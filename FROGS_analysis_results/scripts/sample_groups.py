@@ -0,0 +1,202 @@
+# Metadata
+__author__ = 'Mainguy Jean - Plateforme bioinformatique Toulouse'
+__copyright__ = 'Copyright (C) 2020 INRAE'
+__license__ = 'GNU General Public License'
+
+
+import logging
+import re
+import numpy as np
+import pandas as pd
+from scipy import sparse
+
+from frogs_analysis_fct import get_sample_count_matrix
+
+
+# groups of the direct and nested PCR samples, ie D_rpoB_Mock1 and N_rpoB_Mock1
+PCR_GROUP_PATTERNS = {"direct": r"^D_", "nested": r"^N_"}
+
+# suffix of the replicates of a sample, ie D_rpoB_MockLog_rep1
+REPLICATE_PATTERN = r"_rep\d+$"
+
+
+def get_sample_groups_from_patterns(samples, group_patterns):
+    """
+    Named groups of the samples matching a regex, given as a dict group -> pattern.
+
+    A sample may belong to several groups. Groups matching no sample are dropped.
+    """
+    sample_groups = {}
+    for group, pattern in group_patterns.items():
+        group_samples = [s for s in samples if re.search(pattern, s)]
+        if not group_samples:
+            logging.warning(f'No sample matches the pattern {pattern} of group {group}')
+            continue
+        sample_groups[group] = group_samples
+
+    return sample_groups
+
+
+def get_sample_groups_by_key(samples, key_pattern=REPLICATE_PATTERN):
+    """
+    Group the samples whose names are identical once key_pattern is removed.
+
+    With the default pattern, the replicates D_rpoB_MockLog_rep1 and
+    D_rpoB_MockLog_rep2 make the group D_rpoB_MockLog.
+    """
+    sample_groups = {}
+    for sample in samples:
+        sample_groups.setdefault(re.sub(key_pattern, "", sample), []).append(sample)
+
+    return sample_groups
+
+
+def get_group_matrix(samples, sample_groups):
+    """
+    Sparse membership matrix of shape (samples, groups), 1 when the sample belongs to the group.
+    """
+    sample_index = pd.Index(samples)
+
+    sample_codes, group_codes = [], []
+    for i, group_samples in enumerate(sample_groups.values()):
+        codes = sample_index.get_indexer(group_samples)
+        if (codes < 0).any():
+            missing_samples = [s for s, code in zip(group_samples, codes) if code < 0]
+            raise KeyError(f'Samples of group {list(sample_groups)[i]} are not in the table: {missing_samples}')
+        sample_codes.append(codes)
+        group_codes.append(np.full(len(codes), i))
+
+    sample_codes = np.concatenate(sample_codes) if sample_codes else np.array([], dtype=int)
+    group_codes = np.concatenate(group_codes) if group_codes else np.array([], dtype=int)
+
+    return sparse.csr_matrix((np.ones(len(sample_codes)), (sample_codes, group_codes)),
+                             shape=(len(samples), len(sample_groups)))
+
+
+def get_group_sums_by_cluster(df, sample_groups):
+    """
+    Sum the counts of each cluster over the samples of each group.
+
+    All groups are computed with one product of the cluster x sample count
+    matrix with the sample x group membership matrix. Return a DataFrame of
+    shape (clusters, groups) sharing the index of df.
+    """
+    samples = list(dict.fromkeys(s for group_samples in sample_groups.values() for s in group_samples))
+
+    counts = get_sample_count_matrix(df, samples)
+    group_sums = counts @ get_group_matrix(samples, sample_groups)
+
+    if sparse.issparse(group_sums):
+        group_sums = group_sums.toarray()
+
+    return pd.DataFrame(np.asarray(group_sums), index=df.index, columns=list(sample_groups))
+
+
+def get_relative_abundance(df_sums):
+    """Percentage of each value in the sum of its column, 0 for empty columns."""
+    sums = df_sums.to_numpy(dtype=float)
+    totals = sums.sum(axis=0)
+    abundance = np.divide(100 * sums, totals, out=np.zeros_like(sums), where=totals > 0)
+
+    return pd.DataFrame(abundance, index=df_sums.index, columns=df_sums.columns)
+
+
+def get_group_abundance_by_cluster(df, sample_groups):
+    """
+    Counts and relative abundances of each cluster in each sample group.
+
+    This is consider_only_selected_samples for all groups at once, without
+    copying df. Return a table with observation_name and, for each group,
+    the columns <group>_observation_sum and <group>_abundance. Clusters absent
+    from a group have a sum of 0.
+    """
+    df_sums = get_group_sums_by_cluster(df, sample_groups)
+    df_abundance = get_relative_abundance(df_sums)
+
+    df_groups = pd.concat([df_sums.add_suffix("_observation_sum"), df_abundance.add_suffix("_abundance")], axis=1)
+    ordered_columns = [f"{group}_{column}" for group in sample_groups for column in ["observation_sum", "abundance"]]
+
+    return pd.concat([df[["observation_name"]], df_groups[ordered_columns]], axis=1)
+
+
+def get_group_abundance_by_rank(df, sample_groups, groupby_cols=['Taxonomic rank']):
+    """
+    Counts and relative abundances of each sample group by taxonomic rank, or by any groupby_cols.
+
+    The cluster x group sums are aggregated by a rank x cluster indicator
+    matrix. The table has one row per sample group and rank with the columns
+    group_sum, abundance, clusters (number of clusters of the rank found in
+    the group) and sample_group.
+    """
+    df_sums = get_group_sums_by_cluster(df, sample_groups)
+
+    ranks = df.groupby(groupby_cols, observed=True)
+    rank_codes = ranks.ngroup().to_numpy()
+    df_ranks = ranks.size().reset_index()[groupby_cols]
+
+    in_rank = rank_codes >= 0
+    indicator = sparse.csr_matrix((np.ones(in_rank.sum()), (rank_codes[in_rank], np.flatnonzero(in_rank))),
+                                  shape=(len(df_ranks), len(df)))
+
+    group_sums = df_sums.to_numpy(dtype=float)
+    rank_sums = indicator @ group_sums
+    rank_clusters = indicator @ (group_sums > 0)
+
+    totals = group_sums.sum(axis=0)
+    abundance = np.divide(100 * rank_sums, totals, out=np.zeros_like(rank_sums), where=totals > 0)
+
+    nb_groups = len(sample_groups)
+    df_rank_by_group = df_ranks.loc[np.tile(np.arange(len(df_ranks)), nb_groups)].reset_index(drop=True)
+    df_rank_by_group['group_sum'] = rank_sums.T.ravel()
+    df_rank_by_group['abundance'] = abundance.T.ravel()
+    df_rank_by_group['clusters'] = rank_clusters.T.ravel().astype(int)
+    df_rank_by_group['sample_group'] = np.repeat(list(sample_groups), len(df_ranks))
+
+    return df_rank_by_group
+
+
+def get_rank_abundance_by_sample(df, samples, groupby_cols=['Taxonomic rank', "region", 'name'], total_col='name'):
+    """
+    Sum counts and relative abundances of the clusters by taxonomic rank for all samples at once.
+
+    The sums of all groups and samples come from a single product of a
+    group x cluster indicator matrix with the cluster x sample count matrix.
+    Abundances are relative to the sequences of the sample in the clusters
+    sharing the total_col value of the group (the table of plot_taxo_ranks),
+    or in all clusters when total_col is None. total_col must be one of groupby_cols.
+    The table has one row per sample and group with the columns sample_sum,
+    abundance, observation_name (the number of clusters of the group) and sample.
+    """
+    groups = df.groupby(groupby_cols, observed=True)
+    group_codes = groups.ngroup().to_numpy()
+    df_groups = groups.agg({"observation_name":"count"}).reset_index()
+
+    in_group = group_codes >= 0
+    indicator = sparse.csr_matrix((np.ones(in_group.sum()), (group_codes[in_group], np.flatnonzero(in_group))),
+                                  shape=(len(df_groups), len(df)))
+
+    counts = get_sample_count_matrix(df, samples)
+
+    sample_sums = np.asarray((indicator @ counts).todense() if sparse.issparse(counts) else indicator @ counts)
+
+    if total_col is None:
+        table_codes, tables = np.zeros(len(df), dtype=int), [None]
+        group_tables = np.zeros(len(df_groups), dtype=int)
+    else:
+        table_codes, tables = pd.factorize(df[total_col])
+        group_tables = pd.Index(tables).get_indexer(df_groups[total_col])
+
+    table_indicator = sparse.csr_matrix((np.ones(len(df)), (table_codes, np.arange(len(df)))), shape=(len(tables), len(df)))
+    table_totals = table_indicator @ counts
+    table_totals = np.asarray(table_totals.todense() if sparse.issparse(table_totals) else table_totals)
+    sample_totals = table_totals[group_tables]
+
+    abundance = np.divide(100 * sample_sums, sample_totals, out=np.zeros_like(sample_sums), where=sample_totals > 0)
+
+    df_rank_by_sample = df_groups.loc[np.tile(np.arange(len(df_groups)), len(samples)), groupby_cols].reset_index(drop=True)
+    df_rank_by_sample['sample_sum'] = sample_sums.T.ravel()
+    df_rank_by_sample['abundance'] = abundance.T.ravel()
+    df_rank_by_sample['observation_name'] = np.tile(df_groups['observation_name'].to_numpy(), len(samples))
+    df_rank_by_sample['sample'] = np.repeat(samples, len(df_groups))
+
+    return df_rank_by_sample
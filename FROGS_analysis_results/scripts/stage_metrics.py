@@ -0,0 +1,118 @@
+# Metadata
+__author__ = 'Mainguy Jean - Plateforme bioinformatique Toulouse'
+__copyright__ = 'Copyright (C) 2020 INRAE'
+__license__ = 'GNU General Public License'
+
+
+from contextlib import contextmanager
+import json
+import logging
+import resource
+import sys
+import time
+
+
+def get_peak_rss_mb():
+    """
+    Peak resident set size of the process and of its finished children, in MB.
+
+    Children are included for the plots written by a pool of processes.
+    """
+    peak_rss = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+                   resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+
+    # ru_maxrss is in bytes on macOS and in kilobytes elsewhere
+    return peak_rss / 1e6 if sys.platform == "darwin" else peak_rss / 1e3
+
+
+class StageMetrics:
+    """
+    Wall time, rows processed and peak RSS of the named stages of a run.
+
+    A stage run several times, once per chunk for instance, adds up its times
+    and rows. peak_rss_mb is the peak RSS of the process at the end of the
+    stage and peak_rss_growth_mb how much the stage raised it.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.stages = {}
+        self.start = time.perf_counter()
+
+    @contextmanager
+    def stage(self, name, rows=None):
+        """
+        Measure the block as the stage name.
+
+        rows may be given here or set on the yielded record once known.
+        """
+        record = {"rows": rows}
+        peak_rss_before = get_peak_rss_mb()
+        start = time.perf_counter()
+
+        yield record
+
+        elapsed = time.perf_counter() - start
+        peak_rss = get_peak_rss_mb()
+
+        stage = self.stages.setdefault(name, {"stage": name, "calls": 0, "time": 0.0, "rows": 0,
+                                              "peak_rss_mb": 0.0, "peak_rss_growth_mb": 0.0})
+        stage["calls"] += 1
+        stage["time"] += elapsed
+        stage["rows"] += record["rows"] or 0
+        stage["peak_rss_mb"] = peak_rss
+        stage["peak_rss_growth_mb"] += peak_rss - peak_rss_before
+
+        logging.debug(f"Stage {name} done in {elapsed:.3f}s")
+
+    def get_stage_records(self):
+        records = []
+        for stage in self.stages.values():
+            rows_per_s = stage["rows"] / stage["time"] if stage["rows"] and stage["time"] > 0 else None
+            records.append({**stage, "rows_per_s": rows_per_s})
+        return records
+
+    def to_dict(self):
+        return {"name": self.name,
+                "total_time": time.perf_counter() - self.start,
+                "peak_rss_mb": get_peak_rss_mb(),
+                "stages": self.get_stage_records()}
+
+    def write_json(self, output_file):
+        logging.info(f'Writting stage metrics in {output_file}')
+        with open(output_file, "w") as fl:
+            json.dump(self.to_dict(), fl, indent=2)
+
+    def format_table(self):
+        lines = [f"{'stage':<16}{'calls':>7}{'time_s':>10}{'rows':>12}{'rows_per_s':>14}{'peak_rss_mb':>13}"]
+        for stage in self.get_stage_records():
+            rows_per_s = f"{stage['rows_per_s']:.0f}" if stage["rows_per_s"] is not None else "-"
+            lines.append(f"{stage['stage']:<16}{stage['calls']:>7}{stage['time']:>10.3f}{stage['rows']:>12}"
+                         f"{rows_per_s:>14}{stage['peak_rss_mb']:>13.1f}")
+
+        metrics = self.to_dict()
+        lines.append(f"Total {metrics['total_time']:.3f}s, peak RSS {metrics['peak_rss_mb']:.1f} MB")
+        return "\n".join(lines)
+
+
+@contextmanager
+def measure_stage(metrics, name, rows=None):
+    """Measure the block as a stage of metrics, or do nothing when metrics is None."""
+    if metrics is None:
+        yield {"rows": rows}
+    else:
+        with metrics.stage(name, rows) as record:
+            yield record
+
+
+def iter_measured(metrics, name, iterable):
+    """Yield the items of iterable, measuring the production of each one, a chunk of rows, as the stage name."""
+    iterator = iter(iterable)
+    while True:
+        try:
+            with measure_stage(metrics, name) as record:
+                item = next(iterator)
+                record["rows"] = len(item)
+        except StopIteration:
+            return
+        yield item
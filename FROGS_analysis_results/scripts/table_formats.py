@@ -0,0 +1,20 @@
+# Metadata
+__author__ = 'Mainguy Jean - Plateforme bioinformatique Toulouse'
+__copyright__ = 'Copyright (C) 2020 INRAE'
+__license__ = 'GNU General Public License'
+
+
+# format of the tables given by their extension, without importing pandas so
+# that the scripts can check their arguments before loading it
+
+
+def get_table_format(table):
+    if table.endswith(".parquet"):
+        return "parquet"
+    elif table.endswith(".feather"):
+        return "feather"
+    return "tsv"
+
+
+def is_biom_file(affi_abundance_file):
+    return affi_abundance_file.endswith(".biom")
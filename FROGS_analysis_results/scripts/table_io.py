@@ -0,0 +1,184 @@
+# Metadata
+__author__ = 'Mainguy Jean - Plateforme bioinformatique Toulouse'
+__copyright__ = 'Copyright (C) 2020 INRAE'
+__license__ = 'GNU General Public License'
+
+
+import logging
+import os
+
+import pandas as pd
+
+from table_formats import get_table_format
+
+
+# taxonomy and rank columns of the merged table, stored as categories in columnar formats
+CATEGORICAL_COLUMNS = ["blast_taxonomy", "blast_taxonomy_original", "blast_taxonomy_cleaned",
+                       "taxon_affi", "rank_affi", "region", "db", "sp_mock_taxonomy", "mock_species"]
+
+# FROGS columns holding numbers or multi- tags (multi-evalue, multi-alignment-lg), always stored as strings
+MIXED_COLUMNS = ["blast_evalue", "blast_aln_length"]
+
+
+def get_arrow_schema(df):
+    """
+    Arrow schema of a merged table.
+
+    The schema only depends on the dtypes of df, so that chunks of the same table
+    share it: categories are dictionaries with int32 indices and object columns are strings.
+    """
+    import pyarrow as pa
+
+    fields = []
+    for column, dtype in df.dtypes.items():
+        if isinstance(dtype, pd.CategoricalDtype):
+            arrow_type = pa.dictionary(pa.int32(), pa.string())
+        elif dtype == object:
+            arrow_type = pa.string()
+        else:
+            arrow_type = pa.from_numpy_dtype(dtype)
+        fields.append(pa.field(str(column), arrow_type))
+
+    return pa.schema(fields)
+
+
+def prepare_columnar_df(df, categorical_columns, encode_categories=True):
+    """
+    Copy of df with dtypes a columnar table can hold.
+
+    Columns of MIXED_COLUMNS and object columns become strings whatever the
+    values of the chunk, so that all chunks of a table get the same schema.
+    The categorical columns are categories, or strings when encode_categories is False.
+    """
+    df = df.copy()
+    for i, (column, dtype) in enumerate(df.dtypes.items()):
+        values = df.iloc[:, i]
+        if isinstance(dtype, pd.SparseDtype):
+            df.isetitem(i, values.sparse.to_dense())
+        elif column in MIXED_COLUMNS or dtype == object:
+            df.isetitem(i, values.astype(object).where(values.isna(), values.astype(str)))
+
+    # columns are set by position as the default ranks hold Species twice
+    for i, column in enumerate(df.columns):
+        if column in categorical_columns:
+            values = df.iloc[:, i].astype(str)
+            df.isetitem(i, values.astype("category") if encode_categories else values)
+
+    return df
+
+
+def encode_feather_categories(source_file, output, categorical_columns):
+    """
+    Write the Feather table of source_file in output with its categorical columns dictionary encoded.
+
+    The Feather (Arrow IPC) file format allows a single dictionary by column,
+    so chunks written with their own categories cannot be appended to the
+    same file. The chunks are then written with plain strings and encoded
+    once all of them are known, the source table being memory-mapped.
+    """
+    import pyarrow as pa
+
+    with pa.memory_map(source_file) as source:
+        table = pa.ipc.open_file(source).read_all()
+
+        for i, column in enumerate(table.column_names):
+            if column in categorical_columns:
+                table = table.set_column(i, table.field(i).name, table.column(i).dictionary_encode())
+        table = table.unify_dictionaries()
+
+        with pa.ipc.new_file(output, table.schema) as writer:
+            writer.write_table(table)
+
+
+class AffiTableWriter:
+    """
+    Write a merged affiliation table in one go or chunk by chunk.
+
+    The format is given by the extension of the output: Parquet (.parquet),
+    Feather (.feather) or TSV otherwise. In the columnar formats, the taxonomy
+    and rank columns are stored as categories. Feather chunks are first written
+    with plain strings in a temporary file, see encode_feather_categories.
+    """
+
+    def __init__(self, output, categorical_columns=CATEGORICAL_COLUMNS):
+        self.output = output
+        self.format = get_table_format(output)
+        self.categorical_columns = list(categorical_columns)
+        self.writer = None
+        self.nb_chunks = 0
+        self.feather_chunks_file = f"{output}.chunks" if self.format == "feather" else None
+
+    def write(self, df):
+        if self.format == "tsv":
+            df.to_csv(self.output, sep='\t', index=False, mode='w' if self.nb_chunks == 0 else 'a', header=self.nb_chunks == 0)
+        else:
+            self.write_columnar(df)
+
+        self.nb_chunks += 1
+
+    def write_columnar(self, df):
+        import pyarrow as pa
+
+        df = prepare_columnar_df(df, self.categorical_columns, encode_categories=self.format == "parquet")
+
+        if self.writer is None:
+            self.schema = get_arrow_schema(df)
+            if self.format == "parquet":
+                import pyarrow.parquet as pq
+                self.writer = pq.ParquetWriter(self.output, self.schema)
+            else:
+                self.writer = pa.ipc.new_file(self.feather_chunks_file, self.schema)
+
+        self.writer.write_table(pa.Table.from_pandas(df, schema=self.schema, preserve_index=False))
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
+
+            if self.format == "feather":
+                encode_feather_categories(self.feather_chunks_file, self.output, self.categorical_columns)
+                os.remove(self.feather_chunks_file)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def get_table_columns(table):
+    table_format = get_table_format(table)
+    if table_format == "parquet":
+        import pyarrow.parquet as pq
+        return pq.read_schema(table).names
+    elif table_format == "feather":
+        import pyarrow as pa
+        with pa.memory_map(table) as source:
+            return pa.ipc.open_file(source).schema.names
+
+    return list(pd.read_csv(table, sep='\t', nrows=0).columns)
+
+
+def read_affi_table(table, columns=None):
+    """
+    Read a merged affiliation table in TSV, Parquet or Feather format.
+
+    When columns is given, only these columns are read and the ones
+    missing from the table are ignored.
+    """
+    table_format = get_table_format(table)
+
+    if columns is not None:
+        table_columns = set(get_table_columns(table))
+        missing_columns = [c for c in columns if c not in table_columns]
+        if missing_columns:
+            logging.debug(f'Columns not found in {table}: {missing_columns}')
+        columns = [c for c in columns if c in table_columns]
+
+    if table_format == "parquet":
+        return pd.read_parquet(table, columns=columns)
+    elif table_format == "feather":
+        return pd.read_feather(table, columns=columns)
+
+    return pd.read_csv(table, sep='\t', usecols=columns)
@@ -0,0 +1,115 @@
+# Metadata
+__author__ = 'Mainguy Jean - Plateforme bioinformatique Toulouse'
+__copyright__ = 'Copyright (C) 2020 INRAE'
+__license__ = 'GNU General Public License'
+
+
+import logging
+import numpy as np
+import pandas as pd
+
+
+class TaxonomyTree:
+    """
+    Compact taxonomy tree where each distinct lineage node has an integer id.
+
+    Node 0 is the root. For a node, parent[node] is the id of its parent,
+    depth[node] its rank index starting at 1 and taxa[node] its taxon name.
+    paths[code] holds the node ids, from the first to the last rank, of the
+    distinct taxonomy identified by code.
+    """
+
+    def __init__(self, parent, depth, taxa, paths):
+        self.parent = parent
+        self.depth = depth
+        self.taxa = taxa
+        self.paths = paths
+        self._lineages = {}
+
+    def __len__(self):
+        return len(self.parent)
+
+    def get_lineage(self, node, nb_ranks, missing_taxon="Multi-affiliation"):
+        """
+        Lineage of a node joined with ';' and padded with missing_taxon up to nb_ranks.
+
+        The lineage of a node is computed only once.
+        """
+        key = (node, nb_ranks, missing_taxon)
+        if key not in self._lineages:
+            taxa = []
+            while node > 0:
+                taxa.append(self.taxa[node])
+                node = self.parent[node]
+
+            taxa = taxa[::-1] + [missing_taxon] * (nb_ranks - len(taxa))
+            self._lineages[key] = ';'.join(taxa)
+
+        return self._lineages[key]
+
+    def get_common_ancestors(self, taxonomy_codes, group_codes):
+        """
+        Lowest common ancestor of each group of taxonomies, for all groups at once.
+
+        taxonomy_codes gives the code of the taxonomy of each item and
+        group_codes the group of each item, with groups numbered from 0.
+        Return the node id of the common ancestor of each group, 0 (the root)
+        when the taxonomies of a group share no taxon.
+        """
+        taxonomy_codes = np.asarray(taxonomy_codes)
+        group_codes = np.asarray(group_codes)
+        if len(group_codes) == 0:
+            return np.zeros(0, dtype=self.parent.dtype)
+
+        order = np.argsort(group_codes, kind="stable")
+        item_paths = self.paths[taxonomy_codes[order]]
+        group_starts = np.flatnonzero(np.r_[True, np.diff(group_codes[order]) != 0])
+
+        # nodes shared by all taxonomies of a group have the same id at their rank
+        same_node = np.minimum.reduceat(item_paths, group_starts, axis=0) == np.maximum.reduceat(
+            item_paths, group_starts, axis=0
+        )
+        common_depth = np.cumprod(same_node, axis=1).sum(axis=1)
+
+        first_paths = item_paths[group_starts]
+        common_ancestors = first_paths[np.arange(len(group_starts)), np.maximum(common_depth - 1, 0)]
+
+        return np.where(common_depth > 0, common_ancestors, 0)
+
+
+def build_taxonomy_tree(taxonomies, split_taxonomy, nb_ranks=7):
+    """
+    Build a TaxonomyTree from a sequence of taxonomy strings.
+
+    split_taxonomy turns a taxonomy string into its list of nb_ranks taxa and is
+    applied once per distinct taxonomy. Return the tree and the code of each
+    input taxonomy in tree.paths.
+    """
+    codes, distinct_taxonomies = pd.factorize(pd.Series(taxonomies, dtype=object))
+
+    parent = [-1]
+    depth = [0]
+    taxa = [""]
+    child_ids = {}
+
+    paths = np.zeros((len(distinct_taxonomies), nb_ranks), dtype=np.int64)
+
+    for code, taxonomy in enumerate(distinct_taxonomies):
+        node = 0
+        for rank_index, taxon in enumerate(split_taxonomy(taxonomy)):
+            child = child_ids.get((node, taxon))
+            if child is None:
+                child = len(parent)
+                child_ids[(node, taxon)] = child
+                parent.append(node)
+                depth.append(rank_index + 1)
+                taxa.append(taxon)
+
+            paths[code, rank_index] = child
+            node = child
+
+    logging.debug(f"Taxonomy tree built with {len(parent)} nodes from {len(distinct_taxonomies)} distinct taxonomies")
+
+    tree = TaxonomyTree(np.array(parent, dtype=np.int64), np.array(depth, dtype=np.int8), np.array(taxa, dtype=object), paths)
+
+    return tree, codes
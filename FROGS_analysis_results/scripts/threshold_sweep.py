@@ -0,0 +1,137 @@
+# Metadata
+__author__ = 'Mainguy Jean - Plateforme bioinformatique Toulouse'
+__copyright__ = 'Copyright (C) 2020 INRAE'
+__license__ = 'GNU General Public License'
+
+
+import logging
+import numpy as np
+import pandas as pd
+
+
+def get_threshold_levels(values, thresholds):
+    """
+    Number of thresholds that each value reaches (value >= threshold).
+
+    thresholds must be sorted. Missing values reach no threshold. Thresholds
+    are compared in the float dtype of the values, like the threshold flags.
+    """
+    values = np.asarray(values)
+    if values.dtype.kind != "f":
+        values = values.astype(float)
+
+    levels = np.searchsorted(np.asarray(thresholds, dtype=values.dtype), values, side="right")
+    return np.where(np.isnan(values), 0, levels)
+
+
+def sum_valid_by_thresholds(identity, coverage, weights, min_ids, min_covs):
+    """
+    Sum the weights of the valid clusters for every (min_id, min_cov) pair.
+
+    A cluster is valid when its identity >= min_id and its coverage >= min_cov.
+    Clusters are binned once by the number of identity and coverage thresholds
+    they reach, then valid sums of all threshold pairs are cumulative sums of
+    these bins.
+
+    weights is an array of shape (clusters, n). Return an array of shape
+    (len(min_ids), len(min_covs), n) following the order of min_ids and min_covs.
+    """
+    weights = np.asarray(weights, dtype=float)
+    if weights.ndim == 1:
+        weights = weights[:, None]
+
+    id_order = np.argsort(min_ids)
+    cov_order = np.argsort(min_covs)
+    sorted_ids = np.asarray(min_ids, dtype=float)[id_order]
+    sorted_covs = np.asarray(min_covs, dtype=float)[cov_order]
+
+    id_levels = get_threshold_levels(identity, sorted_ids)
+    cov_levels = get_threshold_levels(coverage, sorted_covs)
+
+    nb_id_bins, nb_cov_bins = len(sorted_ids) + 1, len(sorted_covs) + 1
+    bins = id_levels * nb_cov_bins + cov_levels
+
+    binned_weights = np.stack(
+        [np.bincount(bins, weights=weights[:, i], minlength=nb_id_bins * nb_cov_bins) for i in range(weights.shape[1])],
+        axis=-1,
+    ).reshape(nb_id_bins, nb_cov_bins, weights.shape[1])
+
+    # valid[i, j] is the sum of the bins reaching more than i identity thresholds and more than j coverage thresholds
+    valid = binned_weights[::-1, ::-1].cumsum(axis=0).cumsum(axis=1)[::-1, ::-1][1:, 1:]
+
+    # back to the order of the given thresholds
+    valid_in_order = np.empty_like(valid)
+    valid_in_order[np.ix_(id_order, cov_order)] = valid
+
+    return valid_in_order
+
+
+def sum_valid_clusters_and_sequences(df, min_ids, min_covs, samples=()):
+    """
+    Number of valid clusters and of valid sequences of df for every threshold pair.
+
+    Return the valid clusters and the valid sequences as arrays of shape
+    (len(min_ids), len(min_covs), 1 + len(samples)), the first value of the last
+    axis being for the observation_sum of the clusters, and the total number of
+    sequences of observation_sum and of each sample. All these values are sums
+    over clusters, so the values of the chunks of a table add up.
+    """
+    samples = list(samples)
+    counts = df[["observation_sum"] + samples].to_numpy(dtype=float)
+
+    # valid clusters and valid sequences, for all samples and for each sample
+    weights = np.concatenate([counts > 0, counts], axis=1)
+    weights[:, 0] = 1
+
+    valid = sum_valid_by_thresholds(
+        df["blast_perc_identity"], df["blast_perc_query_coverage"], weights, min_ids, min_covs
+    )
+
+    nb_counts = counts.shape[1]
+
+    return valid[:, :, :nb_counts], valid[:, :, nb_counts:], counts.sum(axis=0)
+
+
+def get_threshold_sweep_table(valid_clusters, valid_sequences, total_sequences, min_ids, min_covs, samples=()):
+    """
+    Tidy table of the validity of the affiliations for every threshold pair.
+
+    One row per (min_identity, min_coverage, sample) gives the number of valid
+    clusters, their number of sequences and their relative abundance. Sample 'all'
+    gives these values for the observation_sum of the clusters and the other
+    samples only count the clusters found in them.
+    """
+    samples = list(samples)
+
+    valid_abundance = np.divide(
+        100 * valid_sequences,
+        total_sequences,
+        out=np.zeros_like(valid_sequences),
+        where=total_sequences > 0,
+    )
+
+    ids, covs, sample_names = np.meshgrid(min_ids, min_covs, ["all"] + samples, indexing="ij")
+
+    return pd.DataFrame(
+        {
+            "min_identity": ids.ravel(),
+            "min_coverage": covs.ravel(),
+            "sample": sample_names.ravel(),
+            "valid_clusters": valid_clusters.ravel().astype(int),
+            "valid_sequences": valid_sequences.ravel(),
+            "valid_abundance": valid_abundance.ravel(),
+        }
+    )
+
+
+def sweep_identity_coverage_thresholds(df, min_ids, min_covs, samples=()):
+    """
+    Compute the validity of the affiliations for every identity and coverage threshold pair.
+
+    See get_threshold_sweep_table for the returned table.
+    """
+    valid_clusters, valid_sequences, total_sequences = sum_valid_clusters_and_sequences(df, min_ids, min_covs, samples)
+
+    logging.debug(f"Validity computed for {len(min_ids)}x{len(min_covs)} thresholds on {len(df)} clusters and {len(samples)} samples")
+
+    return get_threshold_sweep_table(valid_clusters, valid_sequences, total_sequences, min_ids, min_covs, samples)
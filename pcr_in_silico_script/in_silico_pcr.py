@@ -0,0 +1,546 @@
+import argparse
+from contextlib import ExitStack
+from functools import partial
+from itertools import islice
+import logging
+from multiprocessing import Pool
+import os
+import re
+
+import numpy as np
+
+__author__ = 'Agoutin Gabryelle - UMR Genphyse'
+__copyright__ = 'Copyright (C) 2024 INRAE'
+__license__ = 'GNU General Public License'
+__version__ = '0.1'
+
+
+# primers of the readme, usable by name on the command line
+PRIMERS = {"rpoB_F": "CAGYTDTCNCARTTYATGGAYCA",
+           "rpoB_R": "AGTTRTARCCDTYCCANGKCAT",
+           "Univ_rpoB_F_deg": "GGYTWYGAAGTNCGHGACGTDCA",
+           "Univ_rpoB_R_deg": "TGACGYTGCATGTTBGMRCCCATMA",
+           "16S_F": "ACGGRAGGCAGCAG",
+           "16S_R": "TACCAGGGTATCTAATCCT"}
+
+# one bit per nucleotide, a degenerate base being the union of its nucleotides
+IUPAC_BITS = {"A": 1, "C": 2, "G": 4, "T": 8, "U": 8,
+              "R": 5, "Y": 10, "S": 6, "W": 9, "K": 12, "M": 3,
+              "B": 14, "D": 13, "H": 11, "V": 7, "N": 15}
+
+# bit code of each byte, 0 for the characters that are not IUPAC codes so that they never match
+IUPAC_LOOKUP = np.zeros(256, dtype=np.uint8)
+for base, bits in IUPAC_BITS.items():
+    IUPAC_LOOKUP[ord(base)] = bits
+    IUPAC_LOOKUP[ord(base.lower())] = bits
+
+COMPLEMENT = str.maketrans("ACGTURYSWKMBDHVNacgturyswkmbdhvn", "TGCAAYRSWMKVHDBNtgcaayrswmkvhdbn")
+
+# fraction of the positions still matching under which a primer is matched on them only
+COMPACT_FRACTION = 0.1
+
+TAXID_PATTERN = re.compile(r"taxid=(\d+);")
+
+# columns of the mismatch table, with outer_mismatches in addition for the nested PCR
+MISMATCH_TABLE_COLUMNS = ["seqID", "taxid", "sequence_length", "min_mismatches", "forward_mismatches", "reverse_mismatches",
+                          "forward_mismatch_positions_from_3p", "reverse_mismatch_positions_from_3p", "strand", "amplicon_length"]
+
+
+def reverse_complement(sequence):
+    return sequence.translate(COMPLEMENT)[::-1]
+
+
+def encode_sequence(sequence):
+    """Bit codes of a sequence as a uint8 array, see IUPAC_BITS."""
+    return IUPAC_LOOKUP[np.frombuffer(sequence.encode("ascii", "replace"), dtype=np.uint8)]
+
+
+def read_fasta(fasta_file):
+    """Yield the header (without '>') and the sequence of each record of a FASTA file."""
+    header, sequence_lines = None, []
+    with open(fasta_file) as fl:
+        for line in fl:
+            if line.startswith('>'):
+                if header is not None:
+                    yield header, "".join(sequence_lines)
+                header, sequence_lines = line[1:].rstrip('\n'), []
+            else:
+                sequence_lines.append(line.strip())
+
+    if header is not None:
+        yield header, "".join(sequence_lines)
+
+
+def iter_batches(iterable, batch_size):
+    iterator = iter(iterable)
+    while True:
+        batch = list(islice(iterator, batch_size))
+        if not batch:
+            return
+        yield batch
+
+
+def encode_batch(sequences):
+    """
+    Bit codes of the concatenated sequences, with the start and the length of each sequence in them.
+
+    Matching a primer on the whole batch at once keeps the work in NumPy.
+    """
+    lengths = np.fromiter((len(sequence) for sequence in sequences), dtype=np.int64, count=len(sequences))
+    starts = np.zeros(len(sequences), dtype=np.int64)
+    np.cumsum(lengths[:-1], out=starts[1:])
+
+    return encode_sequence("".join(sequences)), starts, lengths
+
+
+def find_primer_sites(codes, primer, max_mismatches, starts=None, lengths=None):
+    """
+    Positions of codes where primer matches with at most max_mismatches mismatches, and their number of mismatches.
+
+    A base of the primer matches a base of the sequence when their bit codes
+    share a nucleotide. Mismatches are counted one primer base at a time on all
+    positions until less than COMPACT_FRACTION of them are under the limit,
+    then only on these positions. With the starts and lengths of a batch, the
+    sites overlapping two sequences are dropped.
+    """
+    primer_codes = encode_sequence(primer)
+    primer_length = len(primer_codes)
+    nb_positions = len(codes) - primer_length + 1
+    if nb_positions <= 0:
+        return np.array([], dtype=np.int64), np.array([], dtype=np.uint8)
+
+    mismatches = np.zeros(nb_positions, dtype=np.uint8)
+    for i in range(primer_length):
+        mismatches += (codes[i:i + nb_positions] & primer_codes[i]) == 0
+        if i >= max_mismatches and np.count_nonzero(mismatches <= max_mismatches) < nb_positions * COMPACT_FRACTION:
+            break
+
+    positions = np.flatnonzero(mismatches <= max_mismatches)
+    mismatches = mismatches[positions]
+
+    for i in range(i + 1, primer_length):
+        mismatches += (codes[positions + i] & primer_codes[i]) == 0
+        is_kept = mismatches <= max_mismatches
+        positions, mismatches = positions[is_kept], mismatches[is_kept]
+
+    if starts is not None:
+        sequence_index = np.searchsorted(starts, positions, side="right") - 1
+        is_inside = positions + primer_length <= starts[sequence_index] + lengths[sequence_index]
+        positions, mismatches = positions[is_inside], mismatches[is_inside]
+
+    return positions, mismatches
+
+
+def get_sites_by_sequence(positions, mismatches, starts):
+    """Sites of a batch grouped by sequence index, with positions relative to the sequence start."""
+    sequence_indexes = np.searchsorted(starts, positions, side="right") - 1
+
+    sites_by_sequence = {}
+    for index, position, nb_mismatches in zip(sequence_indexes.tolist(), (positions - starts[sequence_indexes]).tolist(),
+                                              mismatches.tolist()):
+        sites_by_sequence.setdefault(index, []).append((position, nb_mismatches))
+
+    return sites_by_sequence
+
+
+def pair_sites(first_sites, second_sites, first_length, min_length=None, max_length=None):
+    """
+    Pairs of a first site with a second site downstream of it, whose amplicon length,
+    primers excluded, is between min_length and max_length.
+    """
+    pairs = []
+    for first_position, first_mismatches in first_sites:
+        amplicon_start = first_position + first_length
+        for second_position, second_mismatches in second_sites:
+            amplicon_length = second_position - amplicon_start
+            if amplicon_length < 0:
+                continue
+            if min_length is not None and amplicon_length < min_length:
+                continue
+            if max_length is not None and amplicon_length > max_length:
+                continue
+            pairs.append((first_position, first_mismatches, second_position, second_mismatches))
+
+    return pairs
+
+
+def find_amplicons(sequences, forward, reverse, max_mismatches=2, min_length=None, max_length=None):
+    """
+    Amplicons of the primer pair on both strands of a batch of sequences.
+
+    On the direct strand (D), the forward primer matches the sequence and the
+    reverse primer its reverse complement downstream. On the reverse strand
+    (R), it is the other way around. Return, for each sequence index, a list
+    of amplicon dicts with the strand, the matched primer sites and their
+    mismatches, and the amplicon without primers, all in the orientation of the
+    primers, plus the start and end of the PCR product, primers included, on the sequence.
+    """
+    codes, starts, lengths = encode_batch(sequences)
+
+    def get_sites(primer):
+        positions, mismatches = find_primer_sites(codes, primer, max_mismatches, starts, lengths)
+        return get_sites_by_sequence(positions, mismatches, starts)
+
+    forward_length, reverse_length = len(forward), len(reverse)
+
+    # D strand: forward ... reverse complement of reverse, R strand: reverse ... reverse complement of forward
+    strand_primers = {"D": (get_sites(forward), get_sites(reverse_complement(reverse)), forward_length, reverse_length),
+                      "R": (get_sites(reverse), get_sites(reverse_complement(forward)), reverse_length, forward_length)}
+
+    amplicons_by_sequence = {}
+    for strand, (first_sites, second_sites, first_length, second_length) in strand_primers.items():
+        for index in first_sites.keys() & second_sites.keys():
+            sequence = sequences[index]
+            for first_position, first_mismatches, second_position, second_mismatches in pair_sites(
+                    first_sites[index], second_sites[index], first_length, min_length, max_length):
+
+                first_match = sequence[first_position:first_position + first_length]
+                second_match = sequence[second_position:second_position + second_length]
+                amplicon = sequence[first_position + first_length:second_position]
+
+                if strand == "D":
+                    amplicon_info = {"forward_match": first_match, "forward_mismatches": first_mismatches,
+                                     "reverse_match": reverse_complement(second_match), "reverse_mismatches": second_mismatches,
+                                     "amplicon": amplicon}
+                else:
+                    amplicon_info = {"forward_match": reverse_complement(second_match), "forward_mismatches": second_mismatches,
+                                     "reverse_match": first_match, "reverse_mismatches": first_mismatches,
+                                     "amplicon": reverse_complement(amplicon)}
+
+                amplicons_by_sequence.setdefault(index, []).append({"strand": strand, **amplicon_info, "start": first_position,
+                                                                    "end": second_position + second_length})
+
+    return amplicons_by_sequence
+
+
+def get_nested_amplicons(outer_amplicons_by_sequence, inner_amplicons_by_sequence):
+    """
+    Inner amplicons whose PCR product lies within the product of an outer amplicon of the same sequence.
+
+    The product of the outer PCR holds both strands, so the inner primers may
+    amplify it on either strand whatever the strand of the outer amplicon.
+    Each nested amplicon records in outer_mismatches the fewest mismatches an
+    outer amplicon holding it needs, see get_amplicon_mismatches.
+    """
+    nested_amplicons_by_sequence = {}
+    for index in outer_amplicons_by_sequence.keys() & inner_amplicons_by_sequence.keys():
+        nested_amplicons = []
+        for inner in inner_amplicons_by_sequence[index]:
+            outer_mismatches = [get_amplicon_mismatches(outer) for outer in outer_amplicons_by_sequence[index]
+                                if outer["start"] <= inner["start"] and inner["end"] <= outer["end"]]
+            if outer_mismatches:
+                nested_amplicons.append({**inner, "outer_mismatches": min(outer_mismatches)})
+
+        if nested_amplicons:
+            nested_amplicons_by_sequence[index] = nested_amplicons
+
+    return nested_amplicons_by_sequence
+
+
+def get_amplicon_mismatches(amplicon):
+    """
+    Smallest mismatch limit by primer (ecoPCR -e) at which the amplicon is found.
+
+    A nested amplicon also needs its outer amplicon to be found.
+    """
+    return max(amplicon["forward_mismatches"], amplicon["reverse_mismatches"], amplicon.get("outer_mismatches", 0))
+
+
+def get_mismatch_positions(match, primer):
+    """Positions of the mismatches of a primer with its matched site, counted from the 3' end of the primer (1 for its last base)."""
+    is_mismatch = (encode_sequence(match) & encode_sequence(primer)) == 0
+    return sorted((len(primer) - np.flatnonzero(is_mismatch)).tolist())
+
+
+def format_mismatch_row(header, sequence_length, amplicons, forward, reverse, nested=False):
+    """
+    Row of a sequence in the mismatch table, see MISMATCH_TABLE_COLUMNS.
+
+    The row describes the amplicon needing the fewest mismatches, ties being
+    broken by the total number of mismatches. Its mismatch columns are empty
+    when the sequence is not amplified.
+    """
+    identifier, taxid, _ = parse_header(header)
+    row = [identifier.rstrip("|"), taxid, sequence_length]
+
+    if not amplicons:
+        row += [""] * (len(MISMATCH_TABLE_COLUMNS) - len(row) + nested)
+    else:
+        best = min(amplicons, key=lambda amplicon: (get_amplicon_mismatches(amplicon),
+                                                    amplicon["forward_mismatches"] + amplicon["reverse_mismatches"]))
+        row += [get_amplicon_mismatches(best), best["forward_mismatches"], best["reverse_mismatches"],
+                ",".join(map(str, get_mismatch_positions(best["forward_match"], forward))),
+                ",".join(map(str, get_mismatch_positions(best["reverse_match"], reverse))),
+                best["strand"], len(best["amplicon"])]
+        if nested:
+            row.append(best["outer_mismatches"])
+
+    return "\t".join(map(str, row))
+
+
+def parse_header(header):
+    """Identifier, taxid (-1 when missing) and definition of a FASTA header."""
+    identifier, _, definition = header.partition(' ')
+    taxid_match = TAXID_PATTERN.search(header)
+    taxid = int(taxid_match.group(1)) if taxid_match else -1
+
+    return identifier, taxid, definition
+
+
+def format_ecopcr_line(header, sequence_length, amplicon):
+    """
+    Line of an amplicon in the ecoPCR output format.
+
+    The identifier is the first word of the header, so that with the headers of
+    format_fasta_for_ecopcr.py ("1_WP_003723045.1| taxid=1639;") the taxid is the
+    fourth '|' field, as in the ecoPCR results. The taxonomy and Tm columns that
+    need the ecoPCR database are written as ### and -1.
+    """
+    identifier, taxid, definition = parse_header(header)
+
+    columns = [identifier, sequence_length, taxid, "###",
+               -1, "###", -1, "###", -1, "###", -1, "###",
+               amplicon["strand"],
+               amplicon["forward_match"].lower(), amplicon["forward_mismatches"], -1,
+               amplicon["reverse_match"].lower(), amplicon["reverse_mismatches"], -1,
+               len(amplicon["amplicon"]), amplicon["amplicon"].lower(), definition]
+
+    return " | ".join(str(column) for column in columns)
+
+
+def get_ecopcr_header(fasta_file, forward, reverse, max_mismatches, min_length, max_length, outer_primers=None):
+    lines = ["#@ecopcr-v2",
+             "#",
+             f"# in_silico_pcr.py version {__version__}",
+             f"# direct  strand oligo1 : {forward:<32} ; oligo2c : {reverse_complement(reverse):>32}",
+             f"# reverse strand oligo2 : {reverse:<32} ; oligo1c : {reverse_complement(forward):>32}",
+             f"# max error count by oligonucleotide : {max_mismatches}",
+             f"# amplifiat length between [{min_length if min_length is not None else 0},"
+             f"{max_length if max_length is not None else 'inf'}] bp",
+             f"# sequences : {fasta_file}"]
+    if outer_primers is not None:
+        lines.append(f"# nested in the amplicons of oligo1 : {outer_primers[0]} ; oligo2 : {outer_primers[1]}")
+
+    return "\n".join(lines + ["#"])
+
+
+def get_output_files(output_file, results):
+    """Output file of each result, output_file itself for a single result, else output_file suffixed by the result name."""
+    if len(results) == 1:
+        return {results[0]: output_file}
+
+    base, extension = os.path.splitext(output_file)
+    return {result: f"{base}_{result}{extension}" for result in results}
+
+
+def process_batch(records, forward, reverse, max_mismatches=2, min_length=None, max_length=None, outer_primers=None,
+                  sweep_mismatches=None, outer_min_length=None, outer_max_length=None):
+    """
+    ecoPCR lines of the amplicons of a batch of (header, sequence) records, by result.
+
+    A simple PCR has the single result 'amplicons'. A nested PCR, with the
+    outer_primers pair, has the results 'direct' (the primer pair alone on the
+    sequences), 'outer' (the outer pair alone) and 'nested' (the primer pair on
+    the outer PCR products), computed from the same primer sites. The outer
+    amplicons have their own length bounds, outer_min_length and outer_max_length,
+    min_length and max_length bounding the amplicons of the primer pair.
+
+    With sweep_mismatches, primers are matched once with up to the largest of
+    sweep_mismatches and max_mismatches mismatches, the ecoPCR lines keeping the
+    amplicons under max_mismatches, and each result also gets the mismatch table
+    rows of all records and the number of records first amplified at each
+    mismatch limit from 0 to this largest limit.
+
+    Return a dict of the lines, number of amplified records, mismatch rows and
+    mismatch histogram of each result, and the number of records.
+    """
+    scan_mismatches = max(max_mismatches, sweep_mismatches or 0)
+
+    sequences = [sequence for _, sequence in records]
+    amplicons_by_sequence = find_amplicons(sequences, forward, reverse, scan_mismatches, min_length, max_length)
+
+    if outer_primers is None:
+        results = {"amplicons": (amplicons_by_sequence, (forward, reverse))}
+    else:
+        outer_amplicons_by_sequence = find_amplicons(sequences, *outer_primers, scan_mismatches,
+                                                     outer_min_length, outer_max_length)
+        results = {"direct": (amplicons_by_sequence, (forward, reverse)),
+                   "outer": (outer_amplicons_by_sequence, outer_primers),
+                   "nested": (get_nested_amplicons(outer_amplicons_by_sequence, amplicons_by_sequence), (forward, reverse))}
+
+    batch_results = {}
+    for result, (result_amplicons_by_sequence, primers) in results.items():
+        lines, nb_amplified = [], 0
+        for index in sorted(result_amplicons_by_sequence):
+            header, sequence = records[index]
+            amplicons = [amplicon for amplicon in result_amplicons_by_sequence[index] if get_amplicon_mismatches(amplicon) <= max_mismatches]
+            lines += [format_ecopcr_line(header, len(sequence), amplicon) for amplicon in amplicons]
+            nb_amplified += bool(amplicons)
+
+        mismatch_rows, mismatch_histogram = [], None
+        if sweep_mismatches is not None:
+            mismatch_histogram = [0] * (scan_mismatches + 1)
+            for index, (header, sequence) in enumerate(records):
+                amplicons = result_amplicons_by_sequence.get(index, [])
+                mismatch_rows.append(format_mismatch_row(header, len(sequence), amplicons, *primers, nested=result == "nested"))
+                if amplicons:
+                    mismatch_histogram[min(get_amplicon_mismatches(amplicon) for amplicon in amplicons)] += 1
+
+        batch_results[result] = (lines, nb_amplified, mismatch_rows, mismatch_histogram)
+
+    return batch_results, len(records)
+
+
+def get_sweep_summary(mismatch_histograms, nb_sequences):
+    """Number and fraction of the sequences amplified at each mismatch limit, one row per result and limit."""
+    rows = []
+    for result, histogram in mismatch_histograms.items():
+        nb_amplified = 0
+        for max_mismatches, nb_first_amplified in enumerate(histogram):
+            nb_amplified += nb_first_amplified
+            rate = nb_amplified / nb_sequences if nb_sequences else 0
+            rows.append([result, max_mismatches, nb_amplified, nb_sequences, f"{rate:.6f}"])
+
+    return rows
+
+
+def in_silico_pcr(fasta_file, output_file, forward, reverse, max_mismatches=2, min_length=None, max_length=None,
+                  threads=1, batch_size=1000, outer_primers=None, sweep_mismatches=None, mismatch_table=None,
+                  outer_min_length=None, outer_max_length=None):
+    """
+    Simulate the PCR of a primer pair on all the sequences of a FASTA file and write the amplicons in ecoPCR format.
+
+    With outer_primers, the nested PCR is simulated in the same pass and the
+    direct, outer and nested results are written in output_file suffixed by
+    _direct, _outer and _nested, see process_batch for the length bounds. Batches of batch_size
+    sequences are matched by threads processes, the output keeping the order
+    of the FASTA file.
+
+    With sweep_mismatches and mismatch_table, the same pass writes the mismatch
+    table of each result (suffixed like the output files) and, in
+    mismatch_table suffixed by _summary, the amplification rate of each result
+    at every mismatch limit from 0 to sweep_mismatches, or to max_mismatches when larger.
+
+    Return the number of sequences and, for each output file, the number of
+    amplified sequences and of amplicons.
+    """
+    results = ["amplicons"] if outer_primers is None else ["direct", "outer", "nested"]
+    output_files = get_output_files(output_file, results)
+    if sweep_mismatches is None:
+        mismatch_table = None
+    mismatch_tables = get_output_files(mismatch_table, results) if mismatch_table else {}
+
+    process = partial(process_batch, forward=forward, reverse=reverse, max_mismatches=max_mismatches,
+                      min_length=min_length, max_length=max_length, outer_primers=outer_primers,
+                      sweep_mismatches=sweep_mismatches if mismatch_table else None,
+                      outer_min_length=outer_min_length, outer_max_length=outer_max_length)
+    batches = iter_batches(read_fasta(fasta_file), batch_size)
+
+    pool = Pool(threads) if threads > 1 else None
+    batch_results = pool.imap(process, batches) if pool else map(process, batches)
+
+    nb_sequences = 0
+    counts = {output_files[result]: [0, 0] for result in results}
+    mismatch_histograms = {result: [0] * (max(max_mismatches, sweep_mismatches) + 1) for result in mismatch_tables}
+    try:
+        with ExitStack() as stack:
+            f_outs = {result: stack.enter_context(open(output_files[result], 'w')) for result in results}
+            for result, f_out in f_outs.items():
+                if result == "outer":
+                    primers, length_bounds = outer_primers, (outer_min_length, outer_max_length)
+                else:
+                    primers, length_bounds = (forward, reverse), (min_length, max_length)
+                f_out.write(get_ecopcr_header(fasta_file, *primers, max_mismatches, *length_bounds,
+                                              outer_primers if result == "nested" else None) + "\n")
+
+            f_tables = {result: stack.enter_context(open(mismatch_tables[result], 'w')) for result in mismatch_tables}
+            for result, f_table in f_tables.items():
+                f_table.write("\t".join(MISMATCH_TABLE_COLUMNS + (["outer_mismatches"] if result == "nested" else [])) + "\n")
+
+            for results_by_name, batch_sequences in batch_results:
+                nb_sequences += batch_sequences
+                for result, (lines, batch_amplified, mismatch_rows, mismatch_histogram) in results_by_name.items():
+                    counts[output_files[result]][0] += batch_amplified
+                    counts[output_files[result]][1] += len(lines)
+                    if lines:
+                        f_outs[result].write("\n".join(lines) + "\n")
+
+                    if result in f_tables:
+                        f_tables[result].write("\n".join(mismatch_rows) + "\n")
+                        mismatch_histograms[result] = [n + batch_n for n, batch_n in zip(mismatch_histograms[result], mismatch_histogram)]
+    finally:
+        if pool:
+            pool.close()
+            pool.join()
+
+    if mismatch_table:
+        base, extension = os.path.splitext(mismatch_table)
+        summary_file = f"{base}_summary{extension}"
+        with open(summary_file, 'w') as f_summary:
+            f_summary.write("\t".join(["result", "max_mismatches", "amplified", "sequences", "amplification_rate"]) + "\n")
+            for row in get_sweep_summary(mismatch_histograms, nb_sequences):
+                f_summary.write("\t".join(map(str, row)) + "\n")
+        logging.info(f'Amplification rates by mismatch limit written in {summary_file}')
+
+    return nb_sequences, counts
+
+
+def get_primer(primer):
+    """Primer sequence of a primer name of PRIMERS, or the given sequence in upper case."""
+    primer = PRIMERS.get(primer, primer).upper()
+    unknown_bases = set(primer) - set(IUPAC_BITS)
+    if unknown_bases:
+        raise ValueError(f"Primer {primer} has bases that are not IUPAC codes: {unknown_bases}")
+    return primer
+
+
+def main():
+    parser = argparse.ArgumentParser(description='In silico PCR of a primer pair on a FASTA file, with degenerate primers and mismatches. '
+                                     'Amplicons are written in the ecoPCR output format.')
+    parser.add_argument('fasta_file', help='Input FASTA file, like the output of format_fasta_for_ecopcr.py')
+    parser.add_argument('forward_primer', help=f'Forward primer sequence with IUPAC codes, or one of the primer names {", ".join(PRIMERS)}')
+    parser.add_argument('reverse_primer', help='Reverse primer sequence with IUPAC codes, or a primer name')
+    parser.add_argument('-e', '--max_mismatches', type=int, default=2, help='Maximum number of mismatches by primer')
+    parser.add_argument('-l', '--min_length', type=int, default=None, help='Minimum amplicon length, primers excluded')
+    parser.add_argument('-L', '--max_length', type=int, default=None, help='Maximum amplicon length, primers excluded')
+    parser.add_argument('--outer_primers', nargs=2, default=None, metavar=('OUTER_FORWARD', 'OUTER_REVERSE'),
+                        help='Outer primer pair of a nested PCR, amplified first. The direct, outer and nested amplicons are written together '
+                        'in the output file suffixed by _direct, _outer and _nested')
+    parser.add_argument('--outer_min_length', type=int, default=None,
+                        help='Minimum length of the outer amplicons, primers excluded. -l and -L only bound the amplicons of the primer pair')
+    parser.add_argument('--outer_max_length', type=int, default=None, help='Maximum length of the outer amplicons, primers excluded')
+    parser.add_argument('-o', '--output_file', default='in_silico_pcr.ecopcr', help='Output file in ecoPCR format')
+    parser.add_argument('--sweep_mismatches', type=int, default=None,
+                        help='Match the primers once with up to this number of mismatches and write, for each sequence, the fewest mismatches '
+                        'it needs to be amplified in --mismatch_table, with the amplification rates from 0 to this number of mismatches '
+                        '(or to --max_mismatches when larger)')
+    parser.add_argument('--mismatch_table', default='mismatch_table.tsv',
+                        help='Mismatch table written with --sweep_mismatches, its summary being written in the same file suffixed by _summary')
+    parser.add_argument('-t', '--threads', type=int, default=os.cpu_count(), help='Number of processes')
+    parser.add_argument('-b', '--batch_size', type=int, default=1000, help='Number of sequences matched at once by a process')
+    parser.add_argument('-v', '--verbose', action='store_true', help='Increase output verbosity')
+
+    example_command = 'python in_silico_pcr.py concatenated_COG0085_format.fna Univ_rpoB_F_deg Univ_rpoB_R_deg --outer_primers rpoB_F rpoB_R -e 2 -o rpob.ecopcr'
+    parser.epilog = f'Example command: {example_command}'
+
+    args = parser.parse_args()
+
+    logging.basicConfig(format="%(levelname)s: %(message)s", level=logging.INFO if args.verbose else logging.WARNING)
+
+    try:
+        forward, reverse = get_primer(args.forward_primer), get_primer(args.reverse_primer)
+        outer_primers = tuple(get_primer(primer) for primer in args.outer_primers) if args.outer_primers else None
+    except ValueError as error:
+        parser.error(str(error))
+
+    nb_sequences, counts = in_silico_pcr(args.fasta_file, args.output_file, forward, reverse,
+                                         args.max_mismatches, args.min_length, args.max_length,
+                                         args.threads, args.batch_size, outer_primers, args.sweep_mismatches, args.mismatch_table,
+                                         args.outer_min_length, args.outer_max_length)
+
+    for output_file, (nb_amplified, nb_amplicons) in counts.items():
+        logging.info(f'{nb_amplified}/{nb_sequences} sequences amplified, {nb_amplicons} amplicons written in {output_file}')
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,256 @@
+import argparse
+import logging
+import os
+
+import numpy as np
+
+__author__ = 'Agoutin Gabryelle - UMR Genphyse'
+__copyright__ = 'Copyright (C) 2024 INRAE'
+__license__ = 'GNU General Public License'
+__version__ = '0.1'
+
+# prefix -> NCBI ranks, as the {k};{p};{c};{o};{f};{g};{s} format of taxonkit reformat.
+# Recent taxdumps name the superkingdom rank domain.
+LINEAGE_RANKS = [("k", ("superkingdom", "domain")), ("p", ("phylum",)), ("c", ("class",)), ("o", ("order",)),
+                 ("f", ("family",)), ("g", ("genus",)), ("s", ("species",))]
+
+UNASSIGNED = "Unassigned"
+
+DUMP_FILES = ["nodes.dmp", "names.dmp", "merged.dmp"]
+
+CACHE_ARRAYS = ["parent", "rank", "name_offsets", "names", "merged", "rank_names"]
+
+ROOT_TAXID = 1
+
+
+def iter_dump_rows(dump_file):
+    """Yield the fields of each row of an NCBI taxdump file ("a\t|\tb\t|\t...\t|")."""
+    with open(dump_file) as fl:
+        for line in fl:
+            yield line.rstrip('\t|\n').split('\t|\t')
+
+
+def build_taxonomy(taxdump_dir):
+    """
+    Parse nodes.dmp, names.dmp and merged.dmp of an NCBI taxdump into arrays indexed by taxid.
+
+    parent and rank (code in rank_names) are -1 for taxids absent of nodes.dmp.
+    The scientific name of a taxid is names[name_offsets[taxid]:name_offsets[taxid + 1]],
+    names being the UTF-8 bytes of all names. merged gives the current taxid of
+    each taxid, itself when not merged.
+    """
+    nodes = [(int(fields[0]), int(fields[1]), fields[2]) for fields in iter_dump_rows(os.path.join(taxdump_dir, "nodes.dmp"))]
+
+    merged_file = os.path.join(taxdump_dir, "merged.dmp")
+    merged_pairs = [(int(fields[0]), int(fields[1])) for fields in iter_dump_rows(merged_file)] if os.path.exists(merged_file) else []
+
+    size = max([taxid for taxid, _, _ in nodes] + [old_taxid for old_taxid, _ in merged_pairs]) + 1
+
+    rank_names = sorted({rank for _, _, rank in nodes})
+    rank_codes = {rank: code for code, rank in enumerate(rank_names)}
+
+    parent = np.full(size, -1, dtype=np.int32)
+    rank = np.full(size, -1, dtype=np.int16)
+    for taxid, parent_taxid, rank_name in nodes:
+        parent[taxid] = parent_taxid
+        rank[taxid] = rank_codes[rank_name]
+
+    merged = np.arange(size, dtype=np.int32)
+    for old_taxid, taxid in merged_pairs:
+        merged[old_taxid] = taxid
+
+    scientific_names = {}
+    for fields in iter_dump_rows(os.path.join(taxdump_dir, "names.dmp")):
+        if fields[3] == "scientific name":
+            scientific_names[int(fields[0])] = fields[1].encode()
+
+    name_lengths = np.zeros(size + 1, dtype=np.int64)
+    for taxid, name in scientific_names.items():
+        if taxid < size:
+            name_lengths[taxid + 1] = len(name)
+    name_offsets = np.cumsum(name_lengths)
+    names = np.frombuffer(b"".join(scientific_names.get(taxid, b"") for taxid in range(size)), dtype=np.uint8)
+
+    return {"parent": parent, "rank": rank, "name_offsets": name_offsets, "names": names,
+            "merged": merged, "rank_names": np.array(rank_names)}
+
+
+def save_taxonomy(taxonomy, cache_dir):
+    """Save the arrays of the taxonomy as .npy files of cache_dir."""
+    os.makedirs(cache_dir, exist_ok=True)
+    for array_name in CACHE_ARRAYS:
+        np.save(os.path.join(cache_dir, f"{array_name}.npy"), taxonomy[array_name])
+
+
+def load_taxonomy(cache_dir):
+    """Load the arrays of a taxonomy cache, memory-mapped so only the pages read are loaded."""
+    return {array_name: np.load(os.path.join(cache_dir, f"{array_name}.npy"), mmap_mode='r') for array_name in CACHE_ARRAYS}
+
+
+def is_cache_up_to_date(taxdump_dir, cache_dir):
+    """
+    Whether the cache holds all arrays and is more recent than the dump files.
+
+    A complete cache without dump files next to it is up to date, so the dump
+    files can be deleted once the cache is built.
+    """
+    cache_files = [os.path.join(cache_dir, f"{array_name}.npy") for array_name in CACHE_ARRAYS]
+    if not all(os.path.exists(cache_file) for cache_file in cache_files):
+        return False
+
+    dump_files = [os.path.join(taxdump_dir, dump_file) for dump_file in DUMP_FILES]
+    dump_times = [os.path.getmtime(dump_file) for dump_file in dump_files if os.path.exists(dump_file)]
+    if not dump_times:
+        return True
+
+    return min(os.path.getmtime(cache_file) for cache_file in cache_files) >= max(dump_times)
+
+
+def get_taxonomy(taxdump_dir, cache_dir=None):
+    """
+    Taxonomy of an NCBI taxdump, read from its cache (by default in the taxdump directory).
+
+    The dump files are only parsed when the cache is missing or older than them,
+    the cache being then written for the next runs. Raise FileNotFoundError
+    when there is neither a complete cache nor the dump files.
+    """
+    if cache_dir is None:
+        cache_dir = os.path.join(taxdump_dir, "ncbi_taxonomy_cache")
+
+    if not is_cache_up_to_date(taxdump_dir, cache_dir):
+        missing_dump_files = [dump_file for dump_file in ["nodes.dmp", "names.dmp"]
+                              if not os.path.exists(os.path.join(taxdump_dir, dump_file))]
+        if missing_dump_files:
+            raise FileNotFoundError(f'No complete taxonomy cache in {cache_dir} and {", ".join(missing_dump_files)} '
+                                    f'missing from {taxdump_dir} to build it')
+        logging.info(f'Parse the taxdump of {taxdump_dir} and write its cache in {cache_dir}')
+        save_taxonomy(build_taxonomy(taxdump_dir), cache_dir)
+
+    return load_taxonomy(cache_dir)
+
+
+def get_current_taxids(taxonomy, taxids):
+    """Current taxid of each taxid, merged taxids being replaced, and -1 for taxids absent of the taxonomy."""
+    parent, merged = taxonomy["parent"], taxonomy["merged"]
+
+    taxids = np.asarray(taxids, dtype=np.int64)
+    is_in_range = (taxids >= 0) & (taxids < len(merged))
+    current = np.where(is_in_range, merged[np.where(is_in_range, taxids, 0)], -1)
+
+    return np.where((current >= 0) & (parent[np.maximum(current, 0)] >= 0), current, -1)
+
+
+def get_rank_taxids(taxonomy, taxids):
+    """
+    Taxid of each rank of LINEAGE_RANKS in the lineage of each taxid, -1 when the lineage has no such rank.
+
+    The lineages of all taxids are walked up together, one level at a time, so
+    there are as many steps as levels in the deepest lineage. Unknown taxids
+    get no rank.
+    """
+    parent, rank = taxonomy["parent"], taxonomy["rank"]
+    rank_codes = {rank_name: code for code, rank_name in enumerate(taxonomy["rank_names"])}
+
+    current = get_current_taxids(taxonomy, taxids)
+    is_known = current >= 0
+    current = current[is_known]
+
+    rank_taxids = np.full((len(is_known), len(LINEAGE_RANKS)), -1, dtype=np.int64)
+    known_rank_taxids = rank_taxids[is_known]
+    lineage_rank_codes = [[rank_codes[rank_name] for rank_name in rank_names if rank_name in rank_codes]
+                          for _, rank_names in LINEAGE_RANKS]
+
+    while len(current):
+        current_ranks = rank[current]
+        for column, codes in enumerate(lineage_rank_codes):
+            is_rank = np.isin(current_ranks, codes) & (known_rank_taxids[:, column] < 0)
+            known_rank_taxids[is_rank, column] = current[is_rank]
+
+        # the root is its own parent, and a missing parent ends the lineage as well
+        current = np.where(current == ROOT_TAXID, ROOT_TAXID, parent[current])
+        current[current < 0] = ROOT_TAXID
+        if (current == ROOT_TAXID).all():
+            break
+
+    rank_taxids[is_known] = known_rank_taxids
+    return rank_taxids
+
+
+def get_names(taxonomy, taxids):
+    """Scientific name of each taxid."""
+    name_offsets, names = taxonomy["name_offsets"], taxonomy["names"]
+    return [bytes(names[name_offsets[taxid]:name_offsets[taxid + 1]]).decode() for taxid in taxids]
+
+
+def get_lineages(taxonomy, taxids, replace_spaces=True):
+    """
+    Lineage of each taxid in the format of taxonkit reformat -f "{k};{p};{c};{o};{f};{g};{s}" -r Unassigned -P.
+
+    Spaces of the names are replaced by '_' unless replace_spaces is False.
+    """
+    unique_taxids, inverse = np.unique(np.asarray(taxids, dtype=np.int64), return_inverse=True)
+    rank_taxids = get_rank_taxids(taxonomy, unique_taxids)
+
+    named_taxids = np.unique(rank_taxids[rank_taxids >= 0])
+    names = dict(zip(named_taxids.tolist(), get_names(taxonomy, named_taxids)))
+    names[-1] = UNASSIGNED
+
+    unique_lineages = []
+    for row in rank_taxids.tolist():
+        lineage = ";".join(f"{prefix}__{names[taxid] or UNASSIGNED}" for (prefix, _), taxid in zip(LINEAGE_RANKS, row))
+        unique_lineages.append(lineage.replace(" ", "_") if replace_spaces else lineage)
+
+    return [unique_lineages[index] for index in inverse.ravel()]
+
+
+def write_lineages(taxonomy, taxid_file, output_file, replace_spaces=True):
+    """
+    Write the taxid and lineage of each line of taxid_file, in the order of the file.
+
+    Return the number of taxids and of unknown taxids, whose lineage is fully unassigned.
+    """
+    with open(taxid_file) as fl:
+        taxid_strings = [line.strip() for line in fl if line.strip()]
+
+    taxids = [int(taxid) if taxid.isdigit() else -1 for taxid in taxid_strings]
+    lineages = get_lineages(taxonomy, taxids, replace_spaces)
+
+    with open(output_file, 'w') as f_out:
+        for taxid, lineage in zip(taxid_strings, lineages):
+            f_out.write(f"{taxid}\t{lineage}\n")
+
+    nb_unknown = int((get_current_taxids(taxonomy, np.unique(taxids)) < 0).sum())
+    return len(taxids), nb_unknown
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Lineages (k;p;c;o;f;g;s) of a list of taxids from the NCBI taxdump, in the format of '
+                                     'taxonkit lineage | taxonkit reformat -r Unassigned -P. The taxdump is parsed once into a cache '
+                                     'of arrays, which later runs load in a few milliseconds.')
+    parser.add_argument('taxid_file', help='File with one taxid by line')
+    parser.add_argument('output_file', help='Output file with the taxid and its lineage by line')
+    parser.add_argument('-d', '--data_dir', default='ncbi_tax_dumb', help='Directory of nodes.dmp, names.dmp and merged.dmp (new_taxdump)')
+    parser.add_argument('--cache_dir', default=None, help='Directory of the taxonomy cache, by default ncbi_taxonomy_cache in --data_dir')
+    parser.add_argument('--keep_spaces', action='store_true', help='Keep the spaces of the names instead of replacing them by _')
+    parser.add_argument('-v', '--verbose', action='store_true', help='Increase output verbosity')
+
+    example_command = 'python ncbi_taxonomy.py amplified_speciesTAXID.txt amplified_species_wc.taxo -d ncbi_tax_dumb/'
+    parser.epilog = f'Example command: {example_command}'
+
+    args = parser.parse_args()
+
+    logging.basicConfig(format="%(levelname)s: %(message)s", level=logging.INFO if args.verbose else logging.WARNING)
+
+    try:
+        taxonomy = get_taxonomy(args.data_dir, args.cache_dir)
+    except FileNotFoundError as error:
+        parser.error(str(error))
+    nb_taxids, nb_unknown = write_lineages(taxonomy, args.taxid_file, args.output_file, not args.keep_spaces)
+
+    if nb_unknown:
+        logging.warning(f'{nb_unknown} distinct taxids of {args.taxid_file} are not in the taxonomy, their lineage is Unassigned')
+    logging.info(f'{nb_taxids} lineages written in {args.output_file}')
+
+
+if __name__ == "__main__":
+    main()
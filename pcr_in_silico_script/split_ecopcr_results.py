@@ -0,0 +1,117 @@
+import argparse
+import logging
+import re
+
+__author__ = 'Agoutin Gabryelle - UMR Genphyse'
+__copyright__ = 'Copyright (C) 2024 INRAE'
+__license__ = 'GNU General Public License'
+__version__ = '0.1'
+
+TAXID_PATTERN = re.compile(r"taxid=(\d+);")
+
+
+def iter_ecopcr_records(ecopcr_file):
+    """
+    Yield the sequence identifier and taxid of each amplicon line of an ecoPCR result file.
+
+    Fields are split on '|' as the awk command of the readme does, so the
+    identifier is the first field and the taxid the fourth one, both stripped.
+    """
+    with open(ecopcr_file) as fl:
+        for line in fl:
+            if line.startswith('#') or not line.strip():
+                continue
+            fields = line.split('|', 4)
+            yield fields[0].strip(), fields[3].strip()
+
+
+def iter_fasta_headers(fasta_file):
+    """
+    Yield the identifier, taxid and header line of each record of a FASTA file.
+
+    Only header lines are read, so the list of headers (grep ">") works as well.
+    The identifier is the part of the header before the first '|', as in the
+    headers of format_fasta_for_ecopcr.py ("1_WP_003723045.1| taxid=1639;").
+    """
+    with open(fasta_file) as fl:
+        for line in fl:
+            if not line.startswith('>'):
+                continue
+            header = line.rstrip('\n')
+            taxid_match = TAXID_PATTERN.search(header)
+            taxid = taxid_match.group(1) if taxid_match else ''
+            yield header[1:].split('|', 1)[0].strip(), taxid, header
+
+
+def split_ecopcr_results(ecopcr_file, fasta_file, amplified_ids_file, not_amplified_ids_file,
+                         amplified_taxids_file, not_amplified_taxids_file):
+    """
+    Split the sequences of a FASTA file into those amplified, i.e. present in the ecoPCR results, and the others.
+
+    The amplified identifiers are kept in a dict, then the FASTA headers are
+    streamed once, so the split is linear in the number of sequences. Each
+    sequence is written once in its id list and its taxid list, in the order of
+    the FASTA file. The id lines of amplified sequences are built as the awk
+    command of the readme does (">id| taxid=N;"), those of the other sequences
+    are their FASTA header.
+
+    Return the number of amplified and not amplified sequences, and the
+    identifiers of the ecoPCR results missing from the FASTA file.
+    """
+    amplified_taxids = {}
+    for identifier, taxid in iter_ecopcr_records(ecopcr_file):
+        amplified_taxids.setdefault(identifier, taxid)
+
+    found_ids = set()
+    nb_amplified, nb_not_amplified = 0, 0
+    with open(amplified_ids_file, 'w') as f_amplified_ids, open(not_amplified_ids_file, 'w') as f_not_amplified_ids, \
+            open(amplified_taxids_file, 'w') as f_amplified_taxids, open(not_amplified_taxids_file, 'w') as f_not_amplified_taxids:
+        for identifier, taxid, header in iter_fasta_headers(fasta_file):
+            if identifier in amplified_taxids:
+                if identifier in found_ids:
+                    continue
+                found_ids.add(identifier)
+                f_amplified_ids.write(f">{identifier}| taxid={amplified_taxids[identifier]};\n")
+                f_amplified_taxids.write(f"{amplified_taxids[identifier]}\n")
+                nb_amplified += 1
+            else:
+                f_not_amplified_ids.write(f"{header}\n")
+                f_not_amplified_taxids.write(f"{taxid}\n")
+                nb_not_amplified += 1
+
+    missing_ids = [identifier for identifier in amplified_taxids if identifier not in found_ids]
+
+    return nb_amplified, nb_not_amplified, missing_ids
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Split the sequences of a FASTA file into amplified and not amplified sequences '
+                                     'from an ecoPCR result file, and write their id lists and taxid lists.')
+    parser.add_argument('ecopcr_file', help='ecoPCR result file, from ecoPCR or in_silico_pcr.py')
+    parser.add_argument('fasta_file', help='FASTA file given to the PCR, like the output of format_fasta_for_ecopcr.py, or its list of headers')
+    parser.add_argument('--amplified_ids', default='id_amplified.txt', help='Output list of the amplified sequences (">id| taxid=N;")')
+    parser.add_argument('--not_amplified_ids', default='not_amplified.txt', help='Output list of the FASTA headers of the not amplified sequences')
+    parser.add_argument('--amplified_taxids', default='amplified_speciesTAXID.txt', help='Output taxids of the amplified sequences')
+    parser.add_argument('--not_amplified_taxids', default='no_amplified_speciesTAXID.txt', help='Output taxids of the not amplified sequences')
+    parser.add_argument('-v', '--verbose', action='store_true', help='Increase output verbosity')
+
+    example_command = 'python split_ecopcr_results.py nested_1st_PCRrpob.ecopcr ../concatenated_COG0085_format.fna'
+    parser.epilog = f'Example command: {example_command}'
+
+    args = parser.parse_args()
+
+    logging.basicConfig(format="%(levelname)s: %(message)s", level=logging.INFO if args.verbose else logging.WARNING)
+
+    nb_amplified, nb_not_amplified, missing_ids = split_ecopcr_results(args.ecopcr_file, args.fasta_file,
+                                                                       args.amplified_ids, args.not_amplified_ids,
+                                                                       args.amplified_taxids, args.not_amplified_taxids)
+
+    if missing_ids:
+        logging.warning(f'{len(missing_ids)} sequences of the ecoPCR results are not in {args.fasta_file}, '
+                        f'for instance {", ".join(missing_ids[:5])}')
+
+    logging.info(f'{nb_amplified}/{nb_amplified + nb_not_amplified} sequences amplified')
+
+
+if __name__ == "__main__":
+    main()